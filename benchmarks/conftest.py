@@ -0,0 +1,115 @@
+"""
+Shared inputs of the micro benchmarks
+
+Inputs are built once per session from a page of the fixed corpus: its rendered image, its parsed text lines,
+and detected objects made from its region proposals with seeded random classes and scores.
+"""
+import os
+import sys
+import random
+import pytest
+import yaml
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+for path in [BENCHMARKS, os.path.join(ROOT, 'cosmos', 'ingestion'), os.path.join(ROOT, 'cosmos_service', 'src')]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import pypdfium2 as pdfium
+import pandas as pd
+from corpus import build_corpus
+from ingest.utils.rasterize import render_page
+from ingest.utils.pdf_extractor import parse_pages, scale_page_meta
+from ingest.process.proposals.connected_components import get_proposals
+from ingest.process.ocr.ocr import _pool_text_meta
+from ingest.utils.result_writer import page_rows, rows_to_table
+
+MODEL_CONFIG = os.path.join(ROOT, 'cosmos', 'ingestion', 'ingest', 'process', 'configs', 'model_config.yaml')
+
+# pdf name in the corpus -> 1-indexed page benchmarked on its own
+PAGES = {'two_column.pdf': 2, 'three_column.pdf': 1, 'bucky.pdf': 1}
+
+
+@pytest.fixture(scope='session')
+def classes():
+    with open(MODEL_CONFIG) as rf:
+        return yaml.load(rf, yaml.Loader)['CLASSES']
+
+
+@pytest.fixture(scope='session')
+def corpus(tmp_path_factory):
+    """
+    :return: {pdf name: path} of the fixed corpus
+    """
+    return {os.path.basename(path): path for path in build_corpus(str(tmp_path_factory.mktemp('corpus')))}
+
+
+def _detected_objs(proposals, classes, seed):
+    rnd = random.Random(seed)
+    objs = []
+    for bb in proposals:
+        scores = sorted((rnd.random() for _ in classes), reverse=True)
+        objs.append((list(bb), list(zip(scores, rnd.sample(classes, len(classes))))))
+    return objs
+
+
+@pytest.fixture(scope='session', params=sorted(PAGES))
+def page(request, corpus, classes, tmp_path_factory):
+    """
+    :return: page dict with 'img', 'meta', 'height', 'proposals', 'detected_objs' and 'content'
+    """
+    pdf_name = request.param
+    page_num = PAGES[pdf_name]
+    pdf = pdfium.PdfDocument(corpus[pdf_name])
+    try:
+        img = render_page(pdf, page_num - 1)
+    finally:
+        pdf.close()
+    pages_meta, limits = parse_pages(corpus[pdf_name], {page_num - 1})
+    limit = limits[page_num - 1]
+    w, h = img.size
+    meta = scale_page_meta(pages_meta, page_num, w / limit[2], h / limit[3])
+    proposals = get_proposals(img)
+    detected_objs = _detected_objs(proposals, classes, seed=page_num)
+    img_pth = str(tmp_path_factory.mktemp('pages') / f'{pdf_name}_{page_num}.png')
+    img.save(img_pth)
+    return {'pdf_name': pdf_name, 'dataset_id': 'benchmark', 'page_num': page_num, 'img': img, 'pad_img': img_pth,
+            'pdf_limit': limit, 'meta': meta, 'height': h, 'proposals': proposals, 'detected_objs': detected_objs,
+            'content': _pool_text_meta(meta, h, detected_objs, page_num)}
+
+
+@pytest.fixture(scope='session')
+def results(corpus, classes, tmp_path_factory):
+    """
+    Object level results of the whole generated part of the corpus, as make_parquet hands them to aggregate_router
+    :return: Pandas frame with the RESULT_SCHEMA columns
+    """
+    rows = []
+    img_dir = tmp_path_factory.mktemp('results')
+    for pdf_name in ['two_column.pdf', 'three_column.pdf']:
+        pages_meta, limits = parse_pages(corpus[pdf_name])
+        pdf = pdfium.PdfDocument(corpus[pdf_name])
+        try:
+            for page_idx in sorted(limits):
+                page_num = page_idx + 1
+                img = render_page(pdf, page_idx)
+                img_pth = str(img_dir / f'{pdf_name}_{page_num}.png')
+                img.save(img_pth)
+                w, h = img.size
+                meta = scale_page_meta(pages_meta, page_num, w / limits[page_idx][2], h / limits[page_idx][3])
+                detected_objs = _detected_objs(get_proposals(img), classes, seed=page_num)
+                content = _pool_text_meta(meta, h, detected_objs, page_num)
+                rnd = random.Random(page_num)
+                obj = {'pdf_name': pdf_name, 'dataset_id': 'benchmark', 'page_num': page_num, 'pad_img': img_pth,
+                       'pdf_limit': limits[page_idx], 'content': content,
+                       'xgboost_content': [(bb, rnd.choice(classes), text, rnd.random()) for bb, _, text in content]}
+                rows.extend(page_rows(obj))
+        finally:
+            pdf.close()
+    # built the way make_parquet builds the frame it aggregates
+    table = rows_to_table(rows)
+    df = pd.DataFrame(rows)
+    df['detect_cls'] = table['detect_cls'].to_numpy(zero_copy_only=False)
+    df['detect_score'] = table['detect_score'].to_numpy()
+    return df
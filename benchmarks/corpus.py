@@ -0,0 +1,134 @@
+"""
+Fixed PDF corpus for the benchmarks
+
+The corpus is the single page test PDF the end to end tests use, the service test PDF, and generated multi-column
+documents. Generated documents are plain PDF written by hand, with a title across the page, section headers,
+body text in columns and a captioned figure box on every other page, and are the same for the same seed.
+"""
+import os
+import random
+import shutil
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+REAL_PDFS = [os.path.join(ROOT, 'tests', 'one_pdf', 'test.pdf'),
+             os.path.join(ROOT, 'cosmos_service', 'test', 'resources', 'pdfs', 'bucky.pdf')]
+
+# (file name, number of pages, number of columns, seed)
+GENERATED_PDFS = [('two_column.pdf', 8, 2, 0),
+                  ('three_column.pdf', 6, 3, 1)]
+
+WORDS = ['the', 'model', 'results', 'of', 'sample', 'measured', 'data', 'shows', 'a', 'significant', 'increase',
+         'in', 'temperature', 'across', 'all', 'sites', 'we', 'observe', 'that', 'rates', 'were', 'lower', 'than',
+         'expected', 'for', 'each', 'region', 'analysis', 'method', 'estimate', 'table', 'figure', 'values']
+
+PAGE_W, PAGE_H = 612, 792
+MARGIN = 54
+GUTTER = 18
+FONT_SIZE = 10
+LEADING = 12
+
+
+def _sentence(rnd, nwords):
+    words = [rnd.choice(WORDS) for _ in range(nwords)]
+    return ' '.join(words).capitalize() + '.'
+
+
+def _wrap(text, width):
+    # Helvetica averages about half an em per character
+    max_chars = int(width / (FONT_SIZE * 0.5))
+    lines, line = [], ''
+    for word in text.split():
+        if len(line) + len(word) + 1 > max_chars and line:
+            lines.append(line)
+            line = word
+        else:
+            line = f'{line} {word}'.strip()
+    if line:
+        lines.append(line)
+    return lines
+
+
+def _text(font, size, x, y, text):
+    return f'BT /{font} {size} Tf {x:.1f} {y:.1f} Td ({text}) Tj ET'
+
+
+def _page_stream(rnd, page_idx, ncols):
+    ops = []
+    y_top = PAGE_H - MARGIN
+    if page_idx == 0:
+        ops.append(_text('F2', 16, MARGIN, y_top - 16, _sentence(rnd, 6).rstrip('.')))
+        y_top -= 40
+    col_w = (PAGE_W - 2 * MARGIN - GUTTER * (ncols - 1)) / ncols
+    for col in range(ncols):
+        x = MARGIN + col * (col_w + GUTTER)
+        y = y_top
+        if page_idx % 2 == 1 and col == 0:
+            # a figure box with its caption
+            ops.append(f'{x:.1f} {y - 120:.1f} {col_w:.1f} 120 re S')
+            ops.append(f'{x + 10:.1f} {y - 110:.1f} m {x + col_w - 10:.1f} {y - 20:.1f} l S')
+            y -= 120 + LEADING + 2
+            ops.append(_text('F1', 9, x, y, f'Figure {page_idx}. {_sentence(rnd, 5)}'))
+            y -= 2 * LEADING
+        while y > MARGIN + 4 * LEADING:
+            ops.append(_text('F2', 11, x, y, f'{rnd.randint(1, 9)}. {_sentence(rnd, 3).rstrip(".")}'))
+            y -= LEADING + 4
+            for line in _wrap(' '.join(_sentence(rnd, rnd.randint(6, 14)) for _ in range(rnd.randint(3, 8))), col_w):
+                if y < MARGIN:
+                    break
+                ops.append(_text('F1', FONT_SIZE, x, y, line))
+                y -= LEADING
+            y -= LEADING
+    ops.append(_text('F1', 8, PAGE_W / 2 - 5, MARGIN / 2, str(page_idx + 1)))
+    return '\n'.join(ops).encode('latin-1')
+
+
+def write_multicolumn_pdf(path, npages, ncols, seed=0):
+    """
+    Write a generated multi-column document
+    :param path: Output PDF path
+    :param npages: Number of pages
+    :param ncols: Number of text columns per page
+    :param seed: Seed of the generated text
+    :return: path
+    """
+    rnd = random.Random(seed)
+    # 1 catalog, 2 page tree, 3 and 4 fonts, then a page and a content stream per page
+    page_ids = [5 + 2 * i for i in range(npages)]
+    objects = {1: b'<< /Type /Catalog /Pages 2 0 R >>',
+               2: f'<< /Type /Pages /Kids [{" ".join(f"{i} 0 R" for i in page_ids)}] /Count {npages} >>'.encode(),
+               3: b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+               4: b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold >>'}
+    for page_idx, page_id in enumerate(page_ids):
+        stream = _page_stream(rnd, page_idx, ncols)
+        objects[page_id] = (f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_W} {PAGE_H}] '
+                            f'/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> /Contents {page_id + 1} 0 R >>').encode()
+        objects[page_id + 1] = b'<< /Length %d >>\nstream\n' % len(stream) + stream + b'\nendstream'
+    out = bytearray(b'%PDF-1.4\n')
+    offsets = {}
+    for obj_id in sorted(objects):
+        offsets[obj_id] = len(out)
+        out += b'%d 0 obj\n' % obj_id + objects[obj_id] + b'\nendobj\n'
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    for obj_id in sorted(objects):
+        out += b'%010d 00000 n \n' % offsets[obj_id]
+    out += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    with open(path, 'wb') as wf:
+        wf.write(out)
+    return path
+
+
+def build_corpus(directory):
+    """
+    Write the benchmark corpus to a directory
+    :param directory: Output directory, created if needed
+    :return: list of PDF paths, in a fixed order
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for pdf in REAL_PDFS:
+        paths.append(shutil.copy(pdf, os.path.join(directory, os.path.basename(pdf))))
+    for name, npages, ncols, seed in GENERATED_PDFS:
+        paths.append(write_multicolumn_pdf(os.path.join(directory, name), npages, ncols, seed))
+    return paths
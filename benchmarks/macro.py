@@ -0,0 +1,169 @@
+"""
+Macro benchmark of make_parquet.main_process on CPU over the fixed corpus
+
+Each run goes through main_process in a fresh process, so the peak memory of a run is not inflated by the runs
+before it. A run reports pages per second, the peak RSS of the largest process it used and the wall time of each
+stage from the metrics records, and is compared against the stored baseline of its mode.
+
+Modes:
+    propose  render, parse and propose only (JUST_PROPOSE), needs no model weights
+    full     the whole pipeline, needs MODEL_CONFIG, WEIGHTS_PTH, PP_WEIGHTS_PTH and AGGREGATIONS set
+
+Usage:
+    python benchmarks/macro.py --mode propose
+    python benchmarks/macro.py --mode full --repeat 3 --update-baseline
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import multiprocessing
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+for path in [BENCHMARKS, os.path.join(ROOT, 'cosmos', 'ingestion'), os.path.join(ROOT, 'htcosmos')]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from corpus import build_corpus
+
+BASELINE = os.path.join(BENCHMARKS, 'baseline.json')
+FULL_ENV = ['MODEL_CONFIG', 'WEIGHTS_PTH', 'PP_WEIGHTS_PTH', 'AGGREGATIONS']
+
+
+def _peak_rss_bytes(who):
+    peak = resource.getrusage(who).ru_maxrss
+    # bytes on macOS, kilobytes everywhere else
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _run(mode, pdf_dir, work_dir, page_workers, queue):
+    """
+    Body of the process a single run happens in
+    """
+    os.environ.pop('CUDA_VISIBLE_DEVICES', None)
+    os.environ.pop('RESULT_CACHE_DIR', None)
+    os.environ.setdefault('LD_LIBRARY_PATH', '')
+    os.environ['METRICS_DIR'] = os.path.join(work_dir, 'metrics')
+    if page_workers is not None:
+        os.environ['PAGE_WORKERS'] = str(page_workers)
+    if mode == 'propose':
+        os.environ['JUST_PROPOSE'] = '1'
+    with open(os.path.join(work_dir, 'make_parquet.log'), 'w') as log:
+        # make_parquet and its page worker pool log to stdout and stderr a lot, keep it off the report
+        os.dup2(log.fileno(), sys.stdout.fileno())
+        os.dup2(log.fileno(), sys.stderr.fileno())
+        import make_parquet
+        start = time.perf_counter()
+        stats = make_parquet.main_process(pdf_dir, os.path.join(work_dir, 'page_info'), os.path.join(work_dir, 'out'))
+        wall = time.perf_counter() - start
+    queue.put({'wall_s': wall, 'stats': stats,
+               'peak_rss_bytes': max(_peak_rss_bytes(resource.RUSAGE_SELF), _peak_rss_bytes(resource.RUSAGE_CHILDREN))})
+
+
+def run(mode, pdf_dir, npages, page_workers=None):
+    """
+    Run main_process over a directory of PDFs in a fresh process
+    :param mode: 'propose' or 'full'
+    :param pdf_dir: Directory of the corpus
+    :param npages: Number of pages in the corpus
+    :param page_workers: Size of the page worker pool of main_process, None for its default
+    :return: dict of the measurements of the run
+    """
+    from ingest.utils.metrics import read_metrics
+    work_dir = tempfile.mkdtemp(prefix='cosmos-macro-')
+    try:
+        ctx = multiprocessing.get_context('spawn')
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_run, args=(mode, pdf_dir, work_dir, page_workers, queue))
+        proc.start()
+        proc.join()
+        if proc.exitcode != 0:
+            with open(os.path.join(work_dir, 'make_parquet.log')) as rf:
+                tail = rf.readlines()[-20:]
+            raise RuntimeError(f'main_process exited with {proc.exitcode}:\n' + ''.join(tail))
+        result = queue.get()
+        metrics = read_metrics(os.path.join(work_dir, 'metrics'))
+        result['stages'] = metrics.groupby('stage')['wall_s'].sum().round(3).to_dict() if len(metrics) > 0 else {}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    result['pages'] = npages
+    result['pages_per_sec'] = npages / result['wall_s']
+    return result
+
+
+def compare(result, baseline, tolerance):
+    """
+    :param result: Measurements of a run, see run
+    :param baseline: Stored measurements of the same mode
+    :param tolerance: Allowed relative slow down in pages per second and growth in peak memory
+    :return: list of regression messages, empty if there is none
+    """
+    regressions = []
+    if result['pages_per_sec'] < baseline['pages_per_sec'] * (1 - tolerance):
+        regressions.append(f'pages/sec {result["pages_per_sec"]:.2f} is below the baseline {baseline["pages_per_sec"]:.2f}')
+    if result['peak_rss_bytes'] > baseline['peak_rss_bytes'] * (1 + tolerance):
+        regressions.append(f'peak RSS {result["peak_rss_bytes"] / 2**20:.0f} MiB is above the baseline '
+                           f'{baseline["peak_rss_bytes"] / 2**20:.0f} MiB')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=['propose', 'full'], default='propose')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of runs, the fastest one is reported')
+    parser.add_argument('--page-workers', type=int, default=None, help='PAGE_WORKERS of main_process')
+    parser.add_argument('--baseline', default=BASELINE, help='Baseline file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed relative slow down and memory growth before a run counts as a regression')
+    parser.add_argument('--update-baseline', action='store_true', help='Store this run as the baseline of its mode')
+    parser.add_argument('--out', default=None, help='Also write the measurements to this JSON file')
+    args = parser.parse_args()
+
+    if args.mode == 'full':
+        missing = [name for name in FULL_ENV if os.environ.get(name) is None]
+        if missing:
+            parser.error(f'--mode full needs {", ".join(missing)} in the environment')
+
+    from ingest.utils.rasterize import count_pages
+    with tempfile.TemporaryDirectory(prefix='cosmos-corpus-') as pdf_dir:
+        npages = sum(count_pages(pdf) for pdf in build_corpus(pdf_dir))
+        runs = [run(args.mode, pdf_dir, npages, args.page_workers) for _ in range(args.repeat)]
+    result = max(runs, key=lambda r: r['pages_per_sec'])
+    result.update(mode=args.mode, cpus=os.cpu_count(), machine=platform.machine(), python=platform.python_version())
+    print(json.dumps(result, indent=2, default=str))
+    if args.out is not None:
+        with open(args.out, 'w') as wf:
+            json.dump(result, wf, indent=2, default=str)
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as rf:
+            baselines = json.load(rf)
+    if args.update_baseline:
+        baselines[args.mode] = {name: result[name] for name in
+                                ['pages', 'pages_per_sec', 'peak_rss_bytes', 'cpus', 'machine', 'python']}
+        with open(args.baseline, 'w') as wf:
+            json.dump(baselines, wf, indent=2, sort_keys=True)
+            wf.write('\n')
+        print(f'Stored the {args.mode} baseline in {args.baseline}')
+        return 0
+    if args.mode not in baselines:
+        print(f'No {args.mode} baseline in {args.baseline}, run with --update-baseline to store one')
+        return 0
+    baseline = baselines[args.mode]
+    if baseline['pages'] != npages:
+        print(f'The corpus changed since the baseline was stored ({baseline["pages"]} pages, now {npages})')
+    regressions = compare(result, baseline, args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION: {regression}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,56 @@
+"""
+Micro benchmarks of the per-page and per-document stages
+"""
+import pytest
+from ingest.process.proposals.connected_components import get_proposals
+from ingest.process.ocr.group_cls import group_cls
+from ingest.process.ocr.ocr import _pool_text_meta
+from ingest.process.postprocess.xgboost_model.featurizer import get_feat_vec, compute_page_neighbors, load_data_objs
+from ingest.process.aggregation.aggregate import aggregate_router
+from util.parquet_to_json import parquet_to_json
+
+
+def test_get_proposals(benchmark, page):
+    proposals = benchmark(get_proposals, page['img'])
+    assert len(proposals) > 0
+
+
+def _regroup(detected_objs):
+    objs = group_cls(detected_objs, 'Table', do_table_merge=True, merge_over_classes=['Figure', 'Section Header', 'Page Footer', 'Page Header'])
+    return group_cls(objs, 'Figure')
+
+
+def test_group_cls(benchmark, page):
+    benchmark(_regroup, page['detected_objs'])
+
+
+def test_pool_text_meta(benchmark, page):
+    pooled = benchmark(_pool_text_meta, page['meta'], page['height'], page['detected_objs'], page['page_num'])
+    assert len(pooled) == len(page['detected_objs'])
+
+
+def _row_features(predict_list, classes):
+    return [get_feat_vec(predict, predict_list, classes, nbhds)
+            for predict, nbhds in zip(predict_list, compute_page_neighbors(predict_list))]
+
+
+@pytest.mark.benchmark(group='get_feat_vec')
+def test_get_feat_vec(benchmark, page, classes):
+    benchmark(_row_features, page['content'], classes)
+
+
+@pytest.mark.benchmark(group='get_feat_vec')
+def test_load_data_objs(benchmark, page, classes):
+    features = benchmark(load_data_objs, page['content'], classes)
+    assert len(features) == len(page['content'])
+
+
+@pytest.mark.parametrize('aggregate_type', ['pdfs', 'sections', 'tables', 'figures'])
+def test_aggregate_router(benchmark, results, aggregate_type, tmp_path):
+    benchmark(aggregate_router, results, aggregate_type=aggregate_type, write_images_pth=str(tmp_path))
+
+
+def test_parquet_to_json(benchmark, results, tmp_path):
+    path = str(tmp_path / 'benchmark.parquet')
+    results.to_parquet(path, engine='pyarrow', compression='gzip')
+    benchmark(parquet_to_json, path)
@@ -6,27 +6,31 @@ Main file for handling ingestion related activities
 import pickle
 import shutil
 import functools
-import json
+import operator
 import os
-from PIL import Image
-import io
-import subprocess
-import glob
-from ingest.process_page import propose_and_pad, xgboost_postprocess, rules_postprocess
+from ingest.process_page import xgboost_postprocess_batch, batch_page, rules_postprocess
 from ingest.detect import detect
-from dask.distributed import Client, progress, as_completed
-from ingest.utils.preprocess import resize_png
+from dask.distributed import Client, Future, progress, wait, TimeoutError as WaitTimeoutError
+from ingest.utils.rasterize import PageStore, count_pages, page_ranges
+from ingest.utils.visualize import write_regions
+from ingest.process.proposals.connected_components import get_proposals
+from ingest.process.detection.src.preprocess import pad_image
 from ingest.utils.pdf_helpers import get_pdf_names
-from ingest.utils.normalize_text import normalize_text
-from ingest.utils.pdf_extractor import parse_pdf
+from ingest.utils.page_state import load_page
+from ingest.utils.manifest import Manifest
+from ingest.utils.result_cache import ResultCache, cache_key, file_sha1, files_version
+from ingest.utils.result_writer import ParquetAppender, RESULT_SCHEMA, page_rows, rows_to_table
+from ingest.utils.pdf_extractor import iter_pdf_pages, scale_page_meta, has_text
+from ingest.utils.metrics import stage, timed_iter, observe
 from ingest.process.ocr.ocr import regroup, pool_text
 from ingest.process.aggregation.aggregate import aggregate_router
 from ingest.process.representation_learning.compute_word_vecs import make_vecs
 from ingest.process.enrich.context_enrichment import context_enrichment
 import pandas as pd
-import signal
+import pyarrow.parquet as pq
+import time
 import logging
-from itertools import islice
+from collections import deque
 
 
 logging.basicConfig(format='%(levelname)s :: %(filename) :: %(funcName)s :: %(asctime)s :: %(message)s', level=logging.WARNING)
@@ -49,7 +53,8 @@ class Ingest:
     """
     def __init__(self, scheduler_address, use_semantic_detection=False, client=None, tmp_dir=None,
                  use_xgboost_postprocess=False, use_rules_postprocess=False, use_table_context_enrichment=False,
-                 use_qa_table_enrichment=False, use_text_normalization=False):
+                 use_qa_table_enrichment=False, use_text_normalization=False, persist_pages=False,
+                 cache_dir=None, cache_max_bytes=None):
         """
         :param scheduler_address: Address to existing Dask scheduler
         :param use_semantic_detection: Whether or not to run semantic detection
@@ -59,6 +64,11 @@ class Ingest:
         :param use_rules_postprocess: Whether to utilize the rules postprocessing, which is specific to scientific docs
         :param use_table_context_enrichment: If true run semantic enrichment on ingest output parquets
         :param use_qa_table_enrichment: If true and use_table_context_enrichment is True report tables detection stats
+        :param persist_pages: If True, page state is pickled to tmp_dir after every stage, so runs can be inspected or
+        resumed. Otherwise page dicts are passed between stages in memory, spilled to worker local disk by Dask if needed
+        :param cache_dir: Optional directory of a content addressed cache of detection and postprocess outputs, shared
+        across runs and datasets
+        :param cache_max_bytes: Size limit of the cache, least recently used documents are evicted first
         """
         logger.info("Initializing Ingest object")
         self.client = client
@@ -73,6 +83,8 @@ class Ingest:
         self.tmp_dir = tmp_dir
         self.use_table_context_enrichment = use_table_context_enrichment
         self.use_qa_table_enrichment = use_qa_table_enrichment
+        self.persist_pages = persist_pages
+        self.cache = ResultCache(cache_dir, max_bytes=cache_max_bytes) if cache_dir is not None else None
         if tmp_dir is None:
             raise ValueError("tmp_dir must be passed in")
         # Create a subdirectory for tmp files
@@ -97,7 +109,10 @@ class Ingest:
                ngram=1,
                pp_threshold=0.8,
                d_threshold=-10,
-               spans=20):
+               spans=20,
+               pages_per_task=50,
+               postprocess_batch_size=64,
+               max_retries=2):
         """
         Handler for ingestion pipeline.
 
@@ -117,101 +132,80 @@ class Ingest:
         :param skip_ocr: If True, PDFs with no metadata associated will be skipped. If False, OCR will be performed
         :param visualize_proposals: Debugging option, will write images with bounding boxes from proposals to tmp
         :param aggregations: List of aggregations to run over resulting objects
-        :param batch_size: 2000 is a good number
+        :param batch_size: Maximum number of pages in flight past rendering, 2000 is a good number
         :param compute_word_vecs: Whether to compute word vectors over the corpus
         :param ngram: n in ngram for word vecs
         :param pp_threshold: postprocess_score threshold for identifying an object for context enrichment
         :param d_threshold: detect_score threshold
         :param spans: number of words either side of an object coreference to capture for context
+        :param pages_per_task: Large PDFs are rendered, parsed and proposed in shards of this many pages, None for whole PDFs
+        :param postprocess_batch_size: Maximum number of pages, across documents, postprocessed by one XGBoost call
+        :param max_retries: Number of times failed tasks are retried, and shards that timed out are requeued
         also report out table identification statistics, precision, recall and f1. Does nothing if
         use_table_context_enrichment not also True.
         """
         os.makedirs(images_pth, exist_ok=True)
         pdfnames = get_pdf_names(pdf_directory)
         logger.debug(f'loading {len(pdfnames)} pdfs. e.g. {pdfnames[0]}')
-        pdf_to_images = functools.partial(Ingest.pdf_to_images, dataset_id, self.images_tmp)
-        logger.info('Starting ingestion. Converting PDFs to images.')
-        images = [self.client.submit(pdf_to_images, pdf, resources={'process': 1}) for pdf in pdfnames]
-        class TimeOutError(Exception):
-            pass
-        def raise_timeout(var1, var2):
-            raise TimeOutError
-        signal.signal(signal.SIGALRM, raise_timeout)
+        render = functools.partial(Ingest.pdf_to_images, dataset_id, self.images_tmp, visualize=visualize_proposals,
+                                   persist=self.persist_pages)
+        # finished pages and documents are checkpointed, a rerun with the same tmp_dir and dataset_id picks up from there
+        # checkpoints are only reused by a run with the same stages and flags
+        manifest = Manifest(os.path.join(self.tmp_dir, 'checkpoints', dataset_id))
+        document_flags = self._flags(skip_ocr, aggregations)
+        todo = [pdf for pdf in pdfnames if not manifest.is_done(os.path.basename(pdf), document_flags)]
+        logger.info(f'Skipping {len(pdfnames) - len(todo)} documents finished by an earlier run')
+        logger.info('Starting ingestion. Converting PDFs to images and proposing regions.')
+        shards = self.client.gather(self.client.map(Ingest.page_shards, todo, pages_per_task=pages_per_task, skip_ocr=skip_ocr, resources={'process': 1}))
+        cache_keys = self._cache_keys(todo, skip_ocr)
+        documents = []
+        for pdf, pages_list, key in zip(todo, shards, cache_keys):
+            finished = manifest.finished_pages(os.path.basename(pdf), self._stages(), self._flags(skip_ocr))
+            pages_list = [pages if pages is None else [p for p in pages if p not in finished] for pages in pages_list]
+            documents.append((pdf, [pages for pages in pages_list if pages is None or len(pages) > 0], finished, key))
+        logger.info('Streaming pages through detection and text extraction as they are rendered')
+        try:
+            for pdf_name, rows, npages, failure in self._stream_documents(render, documents, skip_ocr, manifest,
+                                                                          max_in_flight=batch_size, max_retries=max_retries,
+                                                                          postprocess_batch_size=postprocess_batch_size):
+                # each document is written, and aggregated, as soon as its last page is done
+                outputs = self._write_document(pdf_name, rows, manifest, aggregations, images_pth)
+                if failure is None:
+                    manifest.document_done(pdf_name, outputs, npages, document_flags)
+                else:
+                    logger.warning(f'{pdf_name} did not finish ({failure}), it will be retried on the next run')
+                    manifest.document_failed(pdf_name, failure, outputs)
+        finally:
+            manifest.close()
 
+        result_file = os.path.join(result_path, f'{dataset_id}.parquet')
+        writer = ParquetAppender(result_file, schema=RESULT_SCHEMA)
+        aggregate_writers = {aggregation: ParquetAppender(os.path.join(result_path, f'{dataset_id}_{aggregation}.parquet'))
+                             for aggregation in aggregations}
         try:
-            for _ in as_completed(images):
-                signal.alarm(0)
-                signal.alarm(180)
-        except TimeOutError:
-            images = [i for i in images if i.status == 'finished']
-            pass
-        else:
-            signal.alarm(0)
-        logger.info('Done converting to images. Starting detection and text extraction')
-        images = [i.result() for i in images]
-        images = [i for i in images if i is not None]
-        images_queue = [i for il in images for i in il]
-        logger.debug(f'images queue length:{len(images_queue)}')
-        images = []
-        iterator = iter(images_queue)
-        while chunk := list(islice(iterator, batch_size)):
-            partial_propose = functools.partial(propose_and_pad, visualize=visualize_proposals)
-            chunk = self.client.map(partial_propose, chunk, resources={'process': 1}, priority=8)
-            if self.use_semantic_detection:
-                chunk = self.client.map(detect, chunk, resources={'GPU': 1}, priority=8)
-                chunk = self.client.map(regroup, chunk, resources={'process': 1})
-                pool_text_ocr_opt = functools.partial(pool_text, skip_ocr=skip_ocr)
-                chunk = self.client.map(pool_text_ocr_opt, chunk, resources={'process': 1})
-                if self.use_xgboost_postprocess:
-                    chunk = self.client.map(xgboost_postprocess, chunk, resources={'process': 1})
-                    chunk = [i for i in chunk if i.result() != '']
-                    if self.use_rules_postprocess:
-                        chunk = self.client.map(rules_postprocess, chunk, resources={'process': 1})
-                        chunk = [i for i in chunk if i.result() != '']
-            progress(chunk)
-            images.extend([i.result() for i in chunk])
-        results = []
-        for i in images:
-            with open(i, 'rb') as rf:
-                obj = pickle.load(rf)
-                for ind, c in enumerate(obj['content']):
-                    bb, cls, text = c
-                    if self.use_text_normalization:
-                        text = normalize_text(text)
-                    scores, classes = zip(*cls)
-                    scores = list(scores)
-                    classes = list(classes)
-                    postprocess_cls = postprocess_score = None
-                    if 'xgboost_content' in obj:
-                        _, postprocess_cls, _, postprocess_score = obj['xgboost_content'][ind]
-                        if 'rules_content' in obj:
-                            _, postprocess_cls, _, postprocess_score = obj['rules_content'][ind]
-                    final_obj = {'pdf_name': obj['pdf_name'],
-                                 'dataset_id': obj['dataset_id'],
-                                 'page_num': obj['page_num'],
-                                 'img_pth': obj['pad_img'],
-                                 'pdf_dims': list(obj['pdf_limit']),
-                                 'bounding_box': list(bb),
-                                 'classes': classes,
-                                 'scores': scores,
-                                 'content': text,
-                                 'postprocess_cls': postprocess_cls,
-                                 'postprocess_score': postprocess_score
-                                }
-                    results.append(final_obj)
-        if len(results) == 0:
+            # documents are assembled in pdf order, whichever run produced them. Documents that did not finish
+            # are left out of the results, they are retried on the next run
+            for pdf in pdfnames:
+                if not manifest.is_done(os.path.basename(pdf), document_flags):
+                    continue
+                outputs = manifest.outputs(os.path.basename(pdf))
+                if 'objects' in outputs:
+                    writer.write_table(pq.read_table(outputs['objects']))
+                for aggregation in aggregations:
+                    if aggregation in outputs:
+                        aggregate_writers[aggregation].write_table(pq.read_table(outputs[aggregation]))
+        finally:
+            writer.close()
+            for aggregate_writer in aggregate_writers.values():
+                aggregate_writer.close()
+        if writer.num_rows == 0:
             logger.info('No objects found')
             return
-        result_df = pd.DataFrame(results)
-        result_df['detect_cls'] = result_df['classes'].apply(lambda x: x[0])
-        result_df['detect_score'] = result_df['scores'].apply(lambda x: x[0])
-        for aggregation in aggregations:
-            aggregate_df = aggregate_router(result_df, aggregate_type=aggregation, write_images_pth=images_pth)
-            name = f'{dataset_id}_{aggregation}.parquet'
-            aggregate_df.to_parquet(os.path.join(result_path, name), engine='pyarrow', compression='gzip')
+        for aggregate_writer in aggregate_writers.values():
+            if aggregate_writer.num_rows == 0:
+                pd.DataFrame().to_parquet(aggregate_writer.path, engine='pyarrow', compression='gzip')
         if compute_word_vecs:
-            make_vecs(result_df, ngram)
-        result_df.to_parquet(os.path.join(result_path, f'{dataset_id}.parquet'), engine='pyarrow', compression='gzip')
+            make_vecs(pq.read_table(result_file, columns=['content']).to_pandas(), ngram)
 
         if self.use_table_context_enrichment:
             logger.info('BEGIN ENRICH PROCESS')
@@ -223,6 +217,325 @@ class Ingest:
                                client=self.client,
                                use_qa_table_enrichment=self.use_qa_table_enrichment)
 
+    @staticmethod
+    def _model_version(*env_vars):
+        """
+        Version of a model loaded by a worker plugin, runs on a worker so it sees the worker's environment
+        :param env_vars: Environment variables holding the weights and config paths of the model
+        :return: see files_version
+        """
+        return files_version(*[os.environ.get(var) for var in env_vars])
+
+    def _cache_keys(self, pdfnames, skip_ocr):
+        """
+        Result cache key of every document
+        :param pdfnames: Paths to the PDFs
+        :param skip_ocr: If True, PDFs with no metadata associated will be skipped. If False, OCR will be performed
+        :return: list of keys, Nones if caching is off
+        """
+        if self.cache is None or not self.use_semantic_detection:
+            return [None] * len(pdfnames)
+        detect_version = self.client.submit(Ingest._model_version, 'WEIGHTS_PTH', 'MODEL_CONFIG',
+                                            resources={'GPU': 1}, pure=False).result()
+        postprocess_version = None
+        if self.use_xgboost_postprocess:
+            postprocess_version = self.client.submit(Ingest._model_version, 'PP_WEIGHTS_PTH', 'CLASSES_PTH',
+                                                     resources={'process': 1}, pure=False).result()
+        config = {'skip_ocr': skip_ocr,
+                  'xgboost_postprocess': self.use_xgboost_postprocess,
+                  'rules_postprocess': self.use_rules_postprocess}
+        hashes = self.client.gather(self.client.map(file_sha1, pdfnames, resources={'process': 1}))
+        return [cache_key(pdf_hash, detect_version, postprocess_version, config) for pdf_hash in hashes]
+
+    @staticmethod
+    def _page_nums(pages):
+        """
+        :param pages: Output of Ingest.pdf_to_images
+        :return: page number of every page
+        """
+        return [page[2] if isinstance(page, tuple) else page['page_num'] for page in pages or []]
+
+    def _shard_pages(self, shard):
+        """
+        Pages of a rendered shard
+        :param shard: Finished future of Ingest.pdf_to_images
+        :return: list of (page_num, page), pages being pickle paths or futures of the page dicts, which stay on the workers
+        """
+        if self.persist_pages:
+            pages = shard.result()
+            if pages is None:
+                return []
+            return [(page_num, f'{os.path.join(tmp_dir, pdf_name)}_{page_num}.pkl') for tmp_dir, pdf_name, page_num in pages]
+        page_nums = self.client.submit(Ingest._page_nums, shard).result()
+        return [(page_num, self.client.submit(operator.getitem, shard, i)) for i, page_num in enumerate(page_nums)]
+
+    def _stages(self):
+        """
+        :return: Names of the stages every page goes through
+        """
+        stages = ['render', 'propose']
+        if self.use_semantic_detection:
+            stages += ['detect', 'regroup', 'pool_text']
+            if self.use_xgboost_postprocess:
+                stages.append('xgboost_postprocess')
+                if self.use_rules_postprocess:
+                    stages.append('rules_postprocess')
+        return stages
+
+    def _flags(self, skip_ocr, aggregations=None):
+        """
+        Settings that change the results of a run besides its stages, checkpoints recorded with other flags are not reused
+        :param skip_ocr: If True, PDFs with no metadata associated will be skipped. If False, OCR will be performed
+        :param aggregations: List of aggregations run over each document, None for the flags of a page
+        :return: {name: value}
+        """
+        flags = {'skip_ocr': skip_ocr}
+        if aggregations is not None:
+            flags.update({'stages': self._stages(), 'aggregations': sorted(aggregations),
+                          'text_normalization': self.use_text_normalization})
+        return flags
+
+    def _submit_pages(self, pages, skip_ocr, retries=0):
+        """
+        Submit the stages of a batch of pages, each stage of a page starts as soon as its previous stage is done.
+        XGBoost postprocessing runs once over the whole batch, so the pages are postprocessed with one model call
+        :param pages: Paths to the page pickles written by pdf_to_images, or futures of the page dicts
+        :param skip_ocr: If True, PDFs with no metadata associated will be skipped. If False, OCR will be performed
+        :param retries: Number of times Dask retries a failed stage
+        :return: list of (future of the page after the last stage, future of the page before postprocessing or None
+        if it is not postprocessed), in the order they were given
+        """
+        pooled = []
+        for page in pages:
+            page = self.client.submit(detect, page, resources={'GPU': 1}, priority=8, retries=retries)
+            page = self.client.submit(regroup, page, resources={'process': 1}, retries=retries)
+            page = self.client.submit(pool_text, page, skip_ocr=skip_ocr, resources={'process': 1}, retries=retries)
+            pooled.append(page)
+        if not self.use_xgboost_postprocess:
+            return [(page, None) for page in pooled]
+        return list(zip(self._submit_postprocess(pooled, retries=retries), pooled))
+
+    def _submit_postprocess(self, pages, retries=0):
+        """
+        Submit the postprocessing of a batch of pages with one XGBoost call. A page that fails to be postprocessed
+        only fails its own future, but a page whose earlier stages failed fails the whole batch
+        :param pages: futures of the pages after pool_text
+        :param retries: Number of times Dask retries a failed stage
+        :return: futures of the pages after the last stage, in the order they were given
+        """
+        batch = self.client.submit(xgboost_postprocess_batch, *pages, resources={'process': 1}, retries=retries)
+        futures = [self.client.submit(batch_page, batch, i) for i in range(len(pages))]
+        if self.use_rules_postprocess:
+            futures = [self.client.submit(rules_postprocess, page, resources={'process': 1}, retries=retries)
+                       for page in futures]
+        return futures
+
+    def _checkpoint_page(self, pdf_name, page_num, page, manifest, skip_ocr):
+        """
+        Record a finished page in the manifest
+        :param page: Finished page, pickle path or page dict
+        :param skip_ocr: If True, PDFs with no metadata associated will be skipped. If False, OCR will be performed
+        :return: the page dict
+        """
+        obj = load_page(page)
+        if isinstance(page, str):
+            # pages that are done are not rendered again, so the pickle of the last stage can serve as checkpoint
+            path = page
+        else:
+            path = manifest.page_path(pdf_name, page_num)
+            with open(path, 'wb') as wf:
+                pickle.dump(obj, wf)
+        manifest.page_done(pdf_name, page_num, path, self._stages(), self._flags(skip_ocr))
+        return obj
+
+    def _stream_documents(self, render, documents, skip_ocr, manifest, max_in_flight=2000, render_timeout=180,
+                          max_retries=2, postprocess_batch_size=64):
+        """
+        Run every page through the page stages as soon as the shard it belongs to is rendered,
+        so detection overlaps with the rendering of later shards. Results are collected as pages finish,
+        and a document is handed back as soon as all of its pages are done.
+        :param render: Ingest.pdf_to_images with everything but the filename and pages bound
+        :param documents: list of (pdf path, list of page shards, {page_num: checkpoint} of pages finished earlier,
+        result cache key or None)
+        :param skip_ocr: If True, PDFs with no metadata associated will be skipped. If False, OCR will be performed
+        :param manifest: Manifest finished pages are recorded in
+        :param max_in_flight: Maximum number of pages submitted to the page stages and not finished yet
+        :param render_timeout: Shards still rendering after this many seconds without any shard finishing are cancelled
+        :param max_retries: Number of times a cancelled shard is requeued, and a failed task is retried by Dask
+        :param postprocess_batch_size: Maximum number of pages, across documents, postprocessed by one model call
+        :return: generator of (pdf_name, rows in page order, number of pages, None or the reason the document failed),
+        documents in the order they finish
+        """
+        docs = []
+        for pdf, _, finished, key in documents:
+            # pages finished by an earlier run are only read back from their checkpoint once the document is done
+            docs.append({'name': os.path.basename(pdf), 'shards_left': 0, 'pages_left': 0,
+                         'pages': dict(finished), 'failure': None, 'key': key, 'start': time.time()})
+        rendering = {}
+        ready = deque()
+        in_flight = {}
+
+        def submit_shard(doc_idx, pages, attempt):
+            shard = self.client.submit(render, documents[doc_idx][0], pages=pages, resources={'process': 1},
+                                       retries=max_retries, pure=attempt == 0)
+            rendering[shard] = (doc_idx, pages, attempt)
+
+        def fail(doc_idx, reason):
+            if docs[doc_idx]['failure'] is None:
+                docs[doc_idx]['failure'] = reason
+
+        def finish_page(doc_idx, page_num, page, cached=None):
+            doc = docs[doc_idx]
+            if isinstance(page, Future):
+                page = page.result()
+            if cached is not None:
+                page = load_page(page)
+                page.update(cached)
+            obj = self._checkpoint_page(doc['name'], page_num, page, manifest, skip_ocr)
+            if doc['key'] is not None and cached is None:
+                self.cache.put(doc['key'], page_num, obj)
+            doc['pages'][page_num] = page_rows(obj, self.use_text_normalization)
+
+        def completed():
+            for doc_idx, doc in enumerate(docs):
+                if doc is None or doc['shards_left'] > 0 or doc['pages_left'] > 0:
+                    continue
+                docs[doc_idx] = None
+                pages = doc['pages']
+                rows = [row for page_num in sorted(pages)
+                        for row in (pages[page_num] if isinstance(pages[page_num], list) else self._page_rows(pages[page_num]))]
+                observe('document', doc['start'], pdf_name=doc['name'], pages=len(pages), objects=len(rows),
+                        status='ok' if doc['failure'] is None else 'error', failure=doc['failure'])
+                yield doc['name'], rows, len(pages), doc['failure']
+
+        for doc_idx, (_, shards, _, _) in enumerate(documents):
+            docs[doc_idx]['shards_left'] = len(shards)
+            for pages in shards:
+                submit_shard(doc_idx, pages, 0)
+        last_rendered = time.monotonic()
+        while rendering or ready or in_flight:
+            batch = []
+            while ready and len(in_flight) + len(batch) < max_in_flight:
+                doc_idx, page_num, page = ready.popleft()
+                key = docs[doc_idx]['key']
+                cached = self.cache.get(key, page_num) if key is not None else None
+                if self.use_semantic_detection and cached is None:
+                    batch.append((doc_idx, page_num, page))
+                else:
+                    # pages in the result cache skip detection and postprocessing
+                    finish_page(doc_idx, page_num, page, cached)
+                    docs[doc_idx]['pages_left'] -= 1
+            # pages that became ready together are postprocessed together
+            for start in range(0, len(batch), postprocess_batch_size):
+                pages = batch[start:start + postprocess_batch_size]
+                futures = self._submit_pages([page for _, _, page in pages], skip_ocr, retries=max_retries)
+                for (future, pooled), (doc_idx, page_num, _) in zip(futures, pages):
+                    # pages of a batch that failed on another page are postprocessed again on their own
+                    in_flight[future] = (doc_idx, page_num, pooled if len(pages) > 1 else None)
+            yield from completed()
+            if not (rendering or in_flight):
+                continue
+            try:
+                done, _ = wait(list(rendering) + list(in_flight), timeout=render_timeout if rendering else None,
+                               return_when='FIRST_COMPLETED')
+            except WaitTimeoutError:
+                done = set()
+            if rendering and time.monotonic() - last_rendered > render_timeout and not any(s in done for s in rendering):
+                logger.warning(f'Cancelling {len(rendering)} PDF shards that did not finish rendering in time')
+                timed_out = rendering
+                rendering = {}
+                self.client.cancel(list(timed_out))
+                for doc_idx, pages, attempt in timed_out.values():
+                    if attempt < max_retries:
+                        submit_shard(doc_idx, pages, attempt + 1)
+                    else:
+                        docs[doc_idx]['shards_left'] -= 1
+                        fail(doc_idx, 'timeout')
+                last_rendered = time.monotonic()
+                continue
+            for future in done:
+                if future in rendering:
+                    doc_idx, _, _ = rendering.pop(future)
+                    last_rendered = time.monotonic()
+                    docs[doc_idx]['shards_left'] -= 1
+                    try:
+                        pages = self._shard_pages(future)
+                    except Exception as e:
+                        logger.error(str(e), exc_info=True)
+                        fail(doc_idx, 'error')
+                        continue
+                    for page_num, page in pages:
+                        docs[doc_idx]['pages_left'] += 1
+                        ready.append((doc_idx, page_num, page))
+                elif future in in_flight:
+                    doc_idx, page_num, pooled = in_flight.pop(future)
+                    docs[doc_idx]['pages_left'] -= 1
+                    try:
+                        page = future.result()
+                    except Exception as e:
+                        if pooled is not None and pooled.status != 'error':
+                            # the batch may have failed on a page of another document, only this page's own failure
+                            # fails its document
+                            logger.warning(f'Postprocessing page {page_num} of {docs[doc_idx]["name"]} on its own: {e}')
+                            retry, = self._submit_postprocess([pooled], retries=max_retries)
+                            in_flight[retry] = (doc_idx, page_num, None)
+                            docs[doc_idx]['pages_left'] += 1
+                            continue
+                        logger.error(str(e), exc_info=True)
+                        fail(doc_idx, 'error')
+                        continue
+                    # postprocess stages return an empty string for pages they drop
+                    if page == '':
+                        continue
+                    finish_page(doc_idx, page_num, page)
+        yield from completed()
+
+    def _write_document(self, pdf_name, rows, manifest, aggregations, images_pth):
+        """
+        Write the outputs of a single document to the checkpoint directory
+        :param pdf_name: Name of the pdf
+        :param rows: Result rows of the document, in page order
+        :param manifest: Manifest of the run, decides where outputs are written
+        :param aggregations: List of aggregations to run over the document
+        :param images_pth: Path aggregations write their images to
+        :return: {output name: parquet path}, 'objects' for the object level output
+        """
+        outputs = {}
+        if len(rows) == 0:
+            return outputs
+        with stage('write_parquet', pdf_name=pdf_name, output='objects') as record:
+            table = rows_to_table(rows)
+            outputs['objects'] = manifest.part_path(pdf_name, 'objects')
+            with ParquetAppender(outputs['objects'], schema=RESULT_SCHEMA) as writer:
+                writer.write_table(table)
+            record['objects'] = table.num_rows
+        if len(aggregations) > 0:
+            doc_df = pd.DataFrame(rows)
+            doc_df['detect_cls'] = table['detect_cls'].to_numpy(zero_copy_only=False)
+            doc_df['detect_score'] = table['detect_score'].to_numpy()
+            for aggregation in aggregations:
+                with stage('aggregate', pdf_name=pdf_name, aggregation=aggregation) as record:
+                    aggregate_df = aggregate_router(doc_df, aggregate_type=aggregation, write_images_pth=images_pth)
+                    record['objects'] = 0 if aggregate_df is None else len(aggregate_df)
+                if aggregate_df is None or len(aggregate_df) == 0:
+                    continue
+                outputs[aggregation] = manifest.part_path(pdf_name, aggregation)
+                with stage('write_parquet', pdf_name=pdf_name, output=aggregation) as record:
+                    with ParquetAppender(outputs[aggregation]) as writer:
+                        writer.write_frame(aggregate_df)
+                    record['objects'] = len(aggregate_df)
+        return outputs
+
+    def _page_rows(self, page):
+        """
+        Flatten the objects of a finished page into result rows
+        :param page: Page dict, path to the page pickle, or finished future of either
+        :return: list of result dicts, one per page object
+        """
+        if isinstance(page, Future):
+            page = page.result()
+        return page_rows(load_page(page), self.use_text_normalization)
+
     def write_images_for_annotation(self, pdf_dir, img_dir):
         """
         Helper function that will write images from PDFs for annotation.
@@ -231,105 +544,144 @@ class Ingest:
         """
         logger.info(f"Converting PDFs to images and writing to target directory: {img_dir}")
         pdfnames = get_pdf_names(pdf_dir)
-        pdf_to_images = functools.partial(Ingest.pdf_to_images, 'na', self.images_tmp)
-        images = [self.client.submit(pdf_to_images, pdf, resources={'process': 1}) for pdf in pdfnames]
+        images = [self.client.submit(Ingest.write_pages, img_dir, pdf, resources={'process': 1}) for pdf in pdfnames]
         progress(images)
-        images = [i.result() for i in images]
-        images = [i for i in images if i is not None]
-        images = [i for il in images for i in il]
-        paths = [f'{tmp_dir}/{pdf_name}_{pn}' for tmp_dir, pdf_name, pn in images]
-        for path in paths:
-            bname = os.path.basename(path)
-            new_bname = bname + '.png'
-            shutil.copy(path, os.path.join(img_dir, new_bname))
+        for i in images:
+            for path in i.result():
+                shutil.move(path, path + '.png')
         logger.info('Done.')
         shutil.rmtree(self.tmp_dir)
 
+    @staticmethod
+    def write_pages(out_dir, filename):
+        """
+        Render every page of a PDF into out_dir
+        :param out_dir: Output directory
+        :param filename: Path to PDF file
+        :return: [paths of the written pages]
+        """
+        if filename is None:
+            return []
+        try:
+            with PageStore(filename) as store:
+                return store.save_pages(out_dir, os.path.basename(filename))
+        except Exception as e:
+            logger.warning(str(e), exc_info=True)
+            logger.warning(f'Rendering error pdf: {filename}')
+            return []
+
+    @staticmethod
+    def page_shards(filename, pages_per_task=None, skip_ocr=True):
+        """
+        Split a PDF into page ranges that can be rendered, parsed and proposed independently
+        :param filename: Path to PDF file
+        :param pages_per_task: Maximum number of pages in a shard, None for a single shard
+        :param skip_ocr: If True, PDFs with no metadata associated will be skipped. If False, OCR will be performed
+        :return: list of ranges of 1-indexed page numbers, [None] (the whole PDF) if the pages cannot be counted,
+        [] if the PDF is skipped
+        """
+        if filename is None:
+            return [None]
+        try:
+            # shards only see their own pages, whether the document has any text is decided once here
+            if skip_ocr and not has_text(filename):
+                logger.warning(f'parse_pdf returned None for pdf: {filename}')
+                return []
+            return page_ranges(count_pages(filename), pages_per_task)
+        except Exception as e:
+            logger.warning(str(e), exc_info=True)
+            logger.warning(f'Could not count pages of pdf: {filename}')
+            return [None]
+
     @classmethod
-    def pdf_to_images(cls, dataset_id, tmp_dir, filename):
+    def pdf_to_images(cls, dataset_id, tmp_dir, filename, visualize=False, pages=None, persist=True):
         """
         Convert PDFs to images, and log image-pdf provenance. Writes pickle files that will be handled later.
+        Pages are rendered in process at the pipeline resolution, then proposed and padded in memory.
         :param dataset_id: Dataset id for this PDF set
         :param tmp_dir: tmp directory where images and pickle files will be written
         :param filename: Path to PDF file
-        :return: [(tmp_dir, pdf_name, page_num)], list of each pdf and the pages associated with it
+        :param visualize: Debugging option, will write images with bounding boxes from proposals to tmp
+        :param pages: Optional range of 1-indexed page numbers, only these pages are handled
+        :param persist: If False, page dicts are returned instead of being pickled to tmp_dir
+        :return: [(tmp_dir, pdf_name, page_num)], list of each pdf and the pages associated with it, or page dicts.
+        Errors rendering or parsing the pages are raised, so the shard is retried and its document fails
         """
         if filename is None:
             return None
         pdf_name = os.path.basename(filename)
-        limit = None
-
+        objs = []
         try:
-            meta, limit = parse_pdf(filename)
-            logger.debug(f'Limit: {limit}')
-        except TypeError as te:
-            logger.error(str(te), exc_info=True)
-            logger.error(f'Logging TypeError for pdf: {pdf_name}')
-            return []
+            store = PageStore(filename)
         except Exception as e:
-            logger.warning(str(e), exc_info=True)
-            logger.warning(f'Logging parsing error for pdf: {pdf_name}')
-            return []
-        if meta is None or limit is None:
-            logger.warning(f'parse_pdf returned None for pdf: {pdf_name}')
-            return []
-
-        subprocess.run(['gs', '-dBATCH',
-                        '-dNOPAUSE',
-                        '-sDEVICE=png16m',
-                        '-dGraphicsAlphaBits=4',
-                        '-dTextAlphaBits=4',
-                        '-r600',
-                        f'-sOutputFile="{tmp_dir}/{pdf_name}_%d"',
-                        filename
-                        ], stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
-        objs = []
-        names = glob.glob(f'{tmp_dir}/{pdf_name}_*[0-9]')
-        for image in names:
-            try:
-                page_num = int(image.split("_")[-1])
-            except ValueError:
-                raise Exception(f'{image}')
-            with open(image, 'rb') as bimage:
-                bstring = bimage.read()
-            bytesio = io.BytesIO(bstring)
+            logger.error(str(e), exc_info=True)
+            logger.error(f'Rendering error pdf: {pdf_name}')
+            raise
+        # each page is parsed, rendered and proposed before the next one, so only one page is held in memory.
+        # Pages are parsed in page order and rendered in the same order
+        labels = {'dataset_id': dataset_id, 'pdf_name': pdf_name}
+        parsed = timed_iter('parse_pdf', iter_pdf_pages(filename, pages=None if pages is None else {p - 1 for p in pages}),
+                            labels, item_labels=lambda item: {'page_num': item[0] + 1, 'lines': len(item[1]['text'])})
+        rendered = timed_iter('render', store.iter_pages(pages), labels, item_labels=lambda item: {'page_num': item[0]})
+        with store, stage('pdf_to_images', **labels) as record:
             try:
-                img = Image.open(bytesio).convert('RGB')
+                for (page_num, img), (page_idx, lines, limit) in zip(rendered, parsed):
+                    assert page_num == page_idx + 1, f'rendered page {page_num} while parsing page {page_idx + 1}'
+                    logger.debug(f'Limit: {limit}')
+                    # pages are rendered at the pipeline resolution, proposals and padding work on them in memory
+                    w, h = img.size
+                    dims = [0, 0, w, h]
+                    orig_w = limit[2]
+                    orig_h = limit[3]
+                    scale_w = w / orig_w
+                    scale_h = h / orig_h
+                    logger.debug(f'Original w: {orig_w}')
+                    logger.debug(f'Original h: {orig_h}')
+                    logger.debug(f'New w: {w}')
+                    logger.debug(f'New h: {h}')
+                    # pages without text have no metadata, their text comes from OCR unless it is skipped
+                    meta2 = scale_page_meta({page_idx: lines}, page_num, scale_w, scale_h) if len(lines['text']) > 0 else None
+                    obj = {'orig_w': orig_w, 'orig_h': orig_h, 'dataset_id': dataset_id, 'pdf_name': pdf_name, 'meta': meta2, 'dims': dims, 'pdf_limit': limit, 'page_num': page_num}
+                    objs.append(cls._propose_page(obj, img, tmp_dir, visualize, persist))
+            except TypeError as te:
+                logger.error(str(te), exc_info=True)
+                logger.error(f'Logging TypeError for pdf: {pdf_name}')
+                raise
             except Exception as e:
-                logger.error(str(e), exc_info=True)
-                logger.error(f'Image opening error pdf: {pdf_name}')
-                return []
+                logger.warning(str(e), exc_info=True)
+                logger.warning(f'Logging parsing error for pdf: {pdf_name}')
+                raise
+            record['pages'] = len(objs)
+        return objs
 
-            orig_w, orig_h = img.size
-            meta2 = None
-            img, img_size = resize_png(img, return_size=True)
-            w, h = img_size
-            dims = [0, 0, w, h]
-            if meta is not None:
-                orig_w = limit[2]
-                orig_h = limit[3]
-                scale_w = w / orig_w
-                scale_h = h / orig_h
-                logger.debug(f'Original w: {orig_w}')
-                logger.debug(f'Original h: {orig_h}')
-                logger.debug(f'New w: {w}')
-                logger.debug(f'New h: {h}')
-                meta2 = meta.copy()
-                meta2.loc[meta2.page == (page_num-1), 'x1'] = meta2.x1 * scale_w
-                meta2.loc[meta2.page == (page_num-1), 'x2'] = meta2.x2 * scale_w
-                meta2.loc[meta2.page == (page_num-1), 'y1'] = meta2.y1 * scale_h
-                meta2.loc[meta2.page == (page_num-1), 'y2'] = meta2.y2 * scale_h
-                meta2 = meta2.to_dict()
-                meta2 = json.dumps(meta2)
-                meta2 = json.loads(meta2)
-
-            # Convert it back to bytes
-            img.save(image, format='PNG')
-            obj = {'orig_w': orig_w, 'orig_h': orig_h, 'dataset_id': dataset_id, 'pdf_name': pdf_name, 'meta': meta2, 'dims': dims, 'pdf_limit': limit, 'page_num': page_num}
-            if tmp_dir is not None:
+    @staticmethod
+    def _propose_page(obj, img, tmp_dir, visualize, persist):
+        """
+        Propose regions of a rendered page, and write its padded image
+        :param obj: Page dict
+        :param img: Page image at the pipeline resolution
+        :param tmp_dir: tmp directory where images and pickle files will be written
+        :param visualize: Debugging option, will write images with bounding boxes from proposals to tmp
+        :param persist: If False, the page dict is returned instead of being pickled to tmp_dir
+        :return: (tmp_dir, pdf_name, page_num) or the page dict
+        """
+        pdf_name = obj['pdf_name']
+        page_num = obj['page_num']
+        obj['id'] = '0'
+        with stage('get_proposals', dataset_id=obj['dataset_id'], pdf_name=pdf_name, page_num=page_num) as record:
+            obj['proposals'] = get_proposals(img)
+            record['objects'] = len(obj['proposals'])
+        obj['page_id'] = f'{pdf_name}_{page_num}'
+        if tmp_dir is not None:
+            # The padded page is the only image written, detection and aggregation read it back
+            d = f'{tmp_dir}/{pdf_name}_{page_num}_pad'
+            pad_image(img).save(d, format='PNG', compress_level=1)
+            obj['pad_img'] = d
+            obj['page_path'] = d
+            if visualize:
+                write_regions(d, obj['proposals'])
+            if persist:
                 with open(os.path.join(tmp_dir, pdf_name) + f'_{page_num}.pkl', 'wb') as wf:
                     pickle.dump(obj, wf)
-                objs.append((tmp_dir, pdf_name, page_num))
-            else:
-                objs.append(obj)
-        return objs
+                return (tmp_dir, pdf_name, page_num)
+        return obj
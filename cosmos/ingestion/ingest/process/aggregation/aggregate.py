@@ -5,6 +5,17 @@ import uuid
 import os
 from .reaggregate_equations import split_equation_system
 
+def apply_groups(df, key, func):
+    """
+    Run func over each group of df. Unlike groupby().apply, every group keeps the grouping column
+    :param df: Pandas frame
+    :param key: Column to group by
+    :param func: Function of a group frame
+    :return: list of func results, in group order
+    """
+    return [func(group) for _, group in df.groupby(key)]
+
+
 def check_y_overlap(bb1, bb2):
     _, x1, _, x2 = bb1
     _, y1, _, y2 = bb2
@@ -174,9 +185,8 @@ def group_section(obj_list):
 
 def aggregate_sections(pdf):
     pdf = pdf[pdf['postprocess_cls'].isin(['Body Text', 'Section Header'])]
-    grouped = pdf.groupby('page_num').apply(order_page)
     final_ordering = []
-    for ind, order in grouped.iteritems():
+    for order in apply_groups(pdf, 'page_num', order_page):
         final_ordering.extend(order)
     sections = [[]]
     for item in final_ordering:
@@ -191,9 +201,8 @@ def aggregate_sections(pdf):
 def aggregate_tables(pdf, write_images_pth):
     pdf = pdf[pdf['postprocess_cls'].isin(['Table', 'Table Caption'])]
     tc_associate = functools.partial(caption_associate, caption_class='Table Caption', write_images_pth=write_images_pth)
-    grouped = pdf.groupby('page_num').apply(tc_associate)
     final_ordering = []
-    for ind, order in grouped.iteritems():
+    for order in apply_groups(pdf, 'page_num', tc_associate):
         final_ordering.extend(order)
     return final_ordering
 
@@ -201,9 +210,8 @@ def aggregate_tables(pdf, write_images_pth):
 def aggregate_figures(pdf, write_images_pth):
     pdf = pdf[pdf['postprocess_cls'].isin(['Figure', 'Figure Caption'])]
     tc_associate = functools.partial(caption_associate, caption_class='Figure Caption', write_images_pth=write_images_pth)
-    grouped = pdf.groupby('page_num').apply(tc_associate)
     final_ordering = []
-    for ind, order in grouped.iteritems():
+    for order in apply_groups(pdf, 'page_num', tc_associate):
         final_ordering.extend(order)
     return final_ordering
 
@@ -246,9 +254,8 @@ def aggregate_router(ddf, aggregate_type, write_images_pth):
 def full_page_aggregate(ddf, aggregate_type, write_images_pth):
     if aggregate_type == 'equations':
         ae = functools.partial(aggregate_equations, write_images_pth=write_images_pth)
-        result = ddf.groupby('pdf_name').apply(ae)
         results = []
-        for pdf_name, sections in result.iteritems():
+        for sections in apply_groups(ddf, 'pdf_name', ae):
             for section in sections:
                 results.append(section)
         results_df = pd.DataFrame(results)
@@ -257,18 +264,14 @@ def full_page_aggregate(ddf, aggregate_type, write_images_pth):
 
 def stream_aggregate(ddf, aggregate_type):
     if aggregate_type == 'sections':
-        result = ddf.groupby('pdf_name').apply(aggregate_sections)
         results = []
-        for pdf_name, sections in result.iteritems():
+        for sections in apply_groups(ddf, 'pdf_name', aggregate_sections):
             for section in sections:
                 results.append(section)
         results_df = pd.DataFrame(results)
         return results_df
     if aggregate_type == 'pdfs':
-        result = ddf.groupby('pdf_name').apply(aggregate_pdf)
-        results = []
-        for pdf_name, item in result.iteritems():
-            results.append(item)
+        results = apply_groups(ddf, 'pdf_name', aggregate_pdf)
         result_df = pd.DataFrame(results)
         return result_df
 
@@ -276,18 +279,16 @@ def stream_aggregate(ddf, aggregate_type):
 def association_aggregate(ddf, aggregate_type, write_images_pth):
     if aggregate_type == 'tables':
         atab = functools.partial(aggregate_tables, write_images_pth=write_images_pth)
-        result = ddf.groupby('pdf_name').apply(atab)
         results = []
-        for pdf_name, tables in result.iteritems():
+        for tables in apply_groups(ddf, 'pdf_name', atab):
             for table in tables:
                 results.append(table)
         results_df = pd.DataFrame(results)
         return results_df
     if aggregate_type == 'figures':
         afig = functools.partial(aggregate_figures, write_images_pth=write_images_pth)
-        result = ddf.groupby('pdf_name').apply(afig)
         results = []
-        for pdf_name, tables in result.iteritems():
+        for tables in apply_groups(ddf, 'pdf_name', afig):
             for table in tables:
                 results.append(table)
         results_df = pd.DataFrame(results)
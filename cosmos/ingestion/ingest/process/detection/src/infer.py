@@ -3,7 +3,6 @@ from ingest.process.detection.src.torch_model.model.utils.config_manager import
 import torch
 from ingest.process.detection.src.torch_model.inference.inference import InferenceHelper
 from ingest.process.detection.src.torch_model.inference.data_layer.inference_loader import InferenceLoader
-from ingest.process.detection.src.utils.ingest_images import ImageDB
 import logging
 logger = logging.getLogger(__name__)
 
@@ -21,7 +20,7 @@ def get_model(model_config, weights, device_str):
     model.to(device)
     return model
 
-def run_inference(model, page_objs, model_config, device_str, session):
+def run_inference(model, page_objs, model_config, device_str, session=None, batch_size=None, cache_features=None):
     """
     Main function to run inference. Writes a bunch of XMLs to out_dir
     :param page_objs: List of page objects
@@ -30,17 +29,20 @@ def run_inference(model, page_objs, model_config, device_str, session):
     :param out_dir: Path to output directory
     :param pdf_name: Name of the pdf
     :param device_str: Device config
+    :param session: Unused. Inference no longer stages objects in a database, kept for older callers
+    :param batch_size: Max number of objects per forward pass. Defaults to INFERENCE_BATCH_SIZE from the model config,
+    or one object at a time if the config does not set it
+    :param cache_features: Whether to featurize each proposal window once per page and build neighborhoods from the
+    cached maps. Defaults to INFERENCE_CACHE_FEATURES from the model config, or False
     """
     cfg = ConfigManager(model_config)
-    ingest_objs = ImageDB.initialize_and_ingest(page_objs,
-                                                         cfg.WARPED_SIZE,
-                                                         'test',
-                                                         cfg.EXPANSION_DELTA,
-                                                         session)
-    loader = InferenceLoader(ingest_objs, cfg.CLASSES, session)
+    if batch_size is None:
+        batch_size = getattr(cfg, 'INFERENCE_BATCH_SIZE', 1)
+    if cache_features is None:
+        cache_features = getattr(cfg, 'INFERENCE_CACHE_FEATURES', False)
+    loader = InferenceLoader(page_objs, cfg.WARPED_SIZE, cfg.EXPANSION_DELTA, cfg.CLASSES)
     device = torch.device(device_str)
-    infer_session = InferenceHelper(model, loader, device)
+    infer_session = InferenceHelper(model, loader, device, batch_size=batch_size, cache_features=cache_features)
     results, softmax_results = infer_session.run()
-    ImageDB.cleanup(ingest_objs, session)
     return results, softmax_results
 
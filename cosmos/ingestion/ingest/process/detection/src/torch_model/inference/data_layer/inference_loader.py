@@ -1,57 +1,138 @@
 """
 Utilities for loading inference data into the model
+Windows for every object live in one contiguous tensor and neighborhoods are kept as index arrays (CSR),
+so inference needs no database session and no pickling
 """
-# TODO refactor so xml_loader and inference_loader import from a utilities directory
-from ingest.process.detection.src.utils.ingest_images import load_image, load_proposal, get_example_for_uuid, ImageDB
+from ingest.process.detection.src.utils.ingest_images import load_proposal_obj, unpack_page
+from ingest.utils.box_overlap import neighbor_index
 from torch.utils.data import Dataset
 import torch
-import os
-from os.path import splitext
-from ingest.process.detection.src.torch_model.train.data_layer.xml_loader import XMLLoader
-from torchvision.transforms import ToTensor
-from ingest.process.detection.src.torch_model.train.data_layer.transforms import NormalizeWrapper
+import numpy as np
+import io
+from PIL import Image
+from ingest.process.detection.src.torch_model.train.data_layer.xml_loader import XMLLoader, Example, get_colorfulness, get_radii, get_angles
 from collections import namedtuple
+import logging
+logger = logging.getLogger(__name__)
 
-normalizer = NormalizeWrapper(mean=[0.485, 0.456, 0.406],std=[0.229, 0.224, 0.225])
-tens = ToTensor()
 Document = namedtuple("Document", ["windows", "proposals", "identifier"])
+# windows: [N x 3 x H x W], bbs: [N x 4], neighbors: list of N index tensors into windows
+Page = namedtuple("Page", ["page_id", "windows", "bbs", "neighbors"])
+# Stand in for the DB example the helper used to receive, index is the position in the dataset
+ObjectRef = namedtuple("ObjectRef", ["page_id", "index"])
 
-class InferenceLoader(XMLLoader):
+
+def compute_neighbor_index(bbs, page_ptr, expansion_delta, orig_size=1920):
+    """
+    Compute the neighborhood of every object, in CSR form.
+    A neighbor is any other object on the same page overlapping the object's box expanded by expansion_delta,
+    in page order, as in ingest_images.compute_neighborhoods
+    :param bbs: [N x 4] object boxes, objects of a page are contiguous
+    :param page_ptr: [P+1] offsets of each page's objects
+    :param expansion_delta: Neighborhood expansion parameter
+    :param orig_size: original size of the image
+    :return: indptr [N+1], indices [nnz] long tensors. Neighbors of object i are indices[indptr[i]:indptr[i+1]]
+    """
+    indptrs = [np.zeros(1, dtype=np.int64)]
+    indices = [np.zeros(0, dtype=np.int64)]
+    nnz = 0
+    for start, end in zip(page_ptr[:-1], page_ptr[1:]):
+        page_indptr, page_indices = neighbor_index(bbs[start:end], expansion_delta, orig_size)
+        indptrs.append(page_indptr[1:] + nnz)
+        indices.append(page_indices + start)
+        nnz += len(page_indices)
+    return torch.from_numpy(np.concatenate(indptrs)), torch.from_numpy(np.concatenate(indices))
+
+
+class InferenceLoader(Dataset):
     """
-    Inference dataset object, based on XMLLoader
+    Inference dataset object. Produces the same examples and batches as XMLLoader over an ingested DB
     """
 
-    def __init__(self, ingest_objs, classes, session):
+    def __init__(self, objs, warped_size, expansion_delta, classes):
         """
         Init function
-        :param session: DB Session
-        :param ingest_objs: Database statistics object
+        :param objs: List of page objects, each with an id, proposals and either an img or padded_bytes
+        :param warped_size: Size to warp each proposal window to
+        :param expansion_delta: Neighborhood expansion parameter
         :param classes: List of classes
         """
-        super().__init__(ingest_objs, classes, session)
+        self.classes = classes
+        windows = []
+        bbs = []
+        self.page_ids = []
+        page_ptr = [0]
+        for obj in objs:
+            if 'img' in obj:
+                image = obj['img']
+            else:
+                image = Image.open(io.BytesIO(obj['padded_bytes']))
+            proposals = load_proposal_obj(obj)
+            if proposals is None or proposals.shape[0] == 0:
+                continue
+            pts, _, _ = unpack_page([image, None, proposals, None], warped_size)
+            windows.extend(pt.ex_window for pt in pts)
+            bbs.extend(pt.ex_proposal for pt in pts)
+            self.page_ids.extend([str(obj['id'])] * len(pts))
+            page_ptr.append(len(bbs))
+        self.page_ptr = page_ptr
+        self.windows = torch.stack(windows) if len(windows) > 0 else torch.zeros(0, 3, warped_size, warped_size)
+        self.bbs = torch.stack(bbs) if len(bbs) > 0 else torch.zeros(0, 4)
+        self.nbr_ptr, self.nbr_idx = compute_neighbor_index(self.bbs, page_ptr, expansion_delta)
+        logger.debug(f"# of proposals:{len(self.page_ids)}")
+
+    def __len__(self):
+        return len(self.page_ids)
+
+    def neighbors(self, item):
+        """
+        :param item: object index
+        :return: long tensor of neighbor object indices
+        """
+        return self.nbr_idx[self.nbr_ptr[item]:self.nbr_ptr[item+1]]
 
     @staticmethod
     def collate(batch):
         """
         collation function to be used with this dataset class
-        :param batch:
-        :return:
+        :param batch: list of (XMLLoader example, ObjectRef) pairs
+        :return: collated Batch, list of ObjectRefs, [B x M] mask of real (non padding) neighbors
         """
-        if len(batch) > 1:
-            raise ValueError(f"Inference classes are only meant to be used with a batch size of 1, got {len(batch)}")
-        example = [batch[0][0]]
-        collated = XMLLoader.collate(example)
-        return collated, batch[0][1]
+        examples = [ex for ex, _ in batch]
+        collated = XMLLoader.collate(examples)
+        neighbor_counts = torch.tensor([len(ex.neighbor_boxes) for ex in examples])
+        max_neighbors = collated.neighbor_windows.shape[1]
+        neighbor_mask = torch.arange(max_neighbors).unsqueeze(0) < neighbor_counts.unsqueeze(1)
+        return collated, [ref for _, ref in batch], neighbor_mask
 
     def __getitem__(self, item):
         """
         Get an item
-        :param item: UUID index
-        :return: XMLLoader exmaple, as well as InferenceLoader example
+        :param item: object index
+        :return: XMLLoader example, as well as an ObjectRef for the object
         """
-        example = super(InferenceLoader, self).__getitem__(item)
-        uuid = self.uuids[item]
-        ex_db = get_example_for_uuid(uuid, self.session)
-        return example, ex_db
+        window = self.windows[item]
+        bbox = self.bbs[item]
+        nbrs = self.neighbors(item)
+        colorfulness = get_colorfulness(window)
+        if len(nbrs) == 0:
+           neighbor_boxes = [torch.zeros(4), torch.zeros(4)]
+           neighbor_windows = [torch.zeros(window.shape), torch.zeros(window.shape)]
+           neighbor_radii = torch.tensor([-1*torch.ones(1)] *2)
+           neighbor_angles = neighbor_radii
+        else:
+           neighbor_boxes = list(self.bbs[nbrs])
+           neighbor_windows = list(self.windows[nbrs])
+           neighbor_radii = get_radii(bbox, self.bbs[nbrs])
+           neighbor_angles = get_angles(bbox, self.bbs[nbrs])
+        example = Example(bbox, None, window, neighbor_boxes, neighbor_windows, neighbor_radii, neighbor_angles, colorfulness)
+        return example, ObjectRef(self.page_ids[item], item)
 
-#
+    def iter_pages(self):
+        """
+        Iterate over the objects of this dataset page by page, with neighborhoods as indices into the page
+        :return: generator of Page tuples, objects in dataset order
+        """
+        for start, end in zip(self.page_ptr[:-1], self.page_ptr[1:]):
+            neighbors = [self.neighbors(i) - start for i in range(start, end)]
+            yield Page(self.page_ids[start], self.windows[start:end], self.bbs[start:end], neighbors)
@@ -1,4 +1,5 @@
 from torch.utils.data import DataLoader
+from torch.nn.utils.rnn import pad_sequence
 import torch
 from ingest.process.detection.src.torch_model.train.data_layer.xml_loader import get_colorfulness, get_radii, get_angles
 from pascal_voc_writer import Writer
@@ -9,15 +10,22 @@ import logging
 logger = logging.getLogger(__name__)
 
 class InferenceHelper:
-    def __init__(self, model, dataset, device):
+    def __init__(self, model, dataset, device, batch_size=1, cache_features=False):
         """
         initialize an inference object
         :param model: a MMFasterRCNN model, expected to have weights loaded
         :param dataset: an inference_loader dataset
+        :param batch_size: maximum number of objects classified in one forward pass.
+        Objects are padded to the largest neighborhood in the batch, and batches may span pages
+        :param cache_features: If true, run the backbone once per proposal window per page and build every
+        neighborhood from those cached maps. Each window is then normalized on its own, so when batch norm runs on
+        batch statistics neighbor features (and scores) differ slightly from the default path
         """
         self.model = model
         self.dataset = dataset
         self.device = device
+        self.batch_size = batch_size
+        self.cache_features = cache_features
         self.cls = [val for val in model.cls_names]
 
     def run(self):
@@ -27,34 +35,106 @@ class InferenceHelper:
         :return:
 
         """
-        loader = DataLoader(self.dataset, batch_size=1, collate_fn=self.dataset.collate)
+        if self.cache_features:
+            return self._run_cached()
+        loader = DataLoader(self.dataset, batch_size=self.batch_size, collate_fn=self.dataset.collate)
         pred_dict = defaultdict(list)
         s_pred_dict = defaultdict(list)
         for ex in loader:
-            batch, db_ex = ex
-            windows = batch.neighbor_windows.to(self.device)
-            ex = batch.center_windows.to(self.device)
-            ex_color = get_colorfulness(ex).to(self.device).reshape(-1,1)
-            radii = get_radii(batch.center_bbs[0],batch.neighbor_boxes[0]).to(self.device).reshape(-1,1)
-            angles = get_angles(batch.center_bbs[0], batch.neighbor_boxes[0]).to(self.device).reshape(-1,1)
-            windows_sub = windows[0]
-            ex_sub = ex[0].unsqueeze(0)
-            rois, cls_scores = self.model(ex_sub, windows_sub,radii, angles, ex_color, batch.center_bbs, self.device)
-            bb = batch.center_bbs[0] 
-            probs, pred_idxs = torch.sort(cls_scores, dim=1, descending=True)
-            sprobs = torch.softmax(probs, dim=1)
-            sprobs = sprobs.tolist()[0]
-            pred_idxs = pred_idxs.tolist()[0]
-            pred_cls = [self.cls[i] for i in pred_idxs]
-            prediction = list(zip(probs.tolist()[0], pred_cls))
-            softmax_prediction = list(zip(sprobs, pred_cls))
+            batch, refs, neighbor_mask = ex
+            if len(refs) == 1:
+                cls_scores = self._score_object(batch)
+            else:
+                cls_scores = self._score_batch(batch, neighbor_mask)
+            self._add_predictions(pred_dict, s_pred_dict, [ref.page_id for ref in refs], batch.center_bbs, cls_scores)
+
+        return pred_dict, s_pred_dict
+
+    def _run_cached(self):
+        """
+        run inference page by page from a per-page cache of backbone maps
+        :return: same as run
+        """
+        pred_dict = defaultdict(list)
+        s_pred_dict = defaultdict(list)
+        for page_id, windows, bbs, neighbors in self.dataset.iter_pages():
+            windows = windows.to(self.device)
+            # objects without neighbors attend over two blank windows, which get an extra cache slot
+            blank_idx = windows.shape[0]
+            if any(len(n) == 0 for n in neighbors):
+                windows = torch.cat([windows, torch.zeros_like(windows[:1])])
+            maps = torch.cat([self.model.featurize_windows(windows[i:i+self.batch_size], self.device)
+                              for i in range(0, windows.shape[0], self.batch_size)])
+            nbr_bbs = torch.cat([bbs, torch.zeros_like(bbs[:1])])
+            for start in range(0, bbs.shape[0], self.batch_size):
+                center_idxs = range(start, min(start + self.batch_size, bbs.shape[0]))
+                nbr_idxs = [neighbors[i] if len(neighbors[i]) > 0 else torch.tensor([blank_idx, blank_idx]) for i in center_idxs]
+                neighbor_mask = pad_sequence([torch.ones(len(n), dtype=torch.bool) for n in nbr_idxs], batch_first=True)
+                padded_idxs = pad_sequence(nbr_idxs, batch_first=True)
+                radii = pad_sequence([get_radii(bbs[i], nbr_bbs[n]) for i, n in zip(center_idxs, nbr_idxs)], batch_first=True, padding_value=-1)
+                angles = pad_sequence([get_angles(bbs[i], nbr_bbs[n]) for i, n in zip(center_idxs, nbr_idxs)], batch_first=True, padding_value=-1)
+                ex_color = torch.stack([get_colorfulness(windows[i].unsqueeze(0)) for i in center_idxs]).to(self.device).reshape(-1,1)
+                center_bbs = bbs[start:start + len(center_idxs)]
+                neighbor_mask = neighbor_mask.to(self.device)
+                neighbor_maps = maps[padded_idxs.to(self.device)]
+                rois, cls_scores = self.model.forward_maps(maps[start:start + len(center_idxs)], neighbor_maps, radii.to(self.device),
+                                                           angles.to(self.device), ex_color, center_bbs, self.device, neighbor_mask)
+                self._add_predictions(pred_dict, s_pred_dict, [page_id] * len(center_idxs), center_bbs, cls_scores)
+        return pred_dict, s_pred_dict
+
+    def _add_predictions(self, pred_dict, s_pred_dict, page_ids, bbs, cls_scores):
+        """
+        Record ranked class predictions for a batch of objects
+        :param pred_dict: page id -> [(bb, [(score, cls)])] raw score predictions
+        :param s_pred_dict: page id -> [(bb, [(score, cls)])] softmax predictions
+        :param page_ids: page id of each object
+        :param bbs: [B x 4] object boxes
+        :param cls_scores: [B x ncls] class scores
+        """
+        probs, pred_idxs = torch.sort(cls_scores, dim=1, descending=True)
+        sprobs = torch.softmax(probs, dim=1)
+        for bb, ex_probs, ex_sprobs, ex_pred_idxs, page_id in zip(bbs, probs.tolist(), sprobs.tolist(), pred_idxs.tolist(), page_ids):
+            pred_cls = [self.cls[i] for i in ex_pred_idxs]
+            prediction = list(zip(ex_probs, pred_cls))
+            softmax_prediction = list(zip(ex_sprobs, pred_cls))
             pred_tuple = (bb.tolist(), prediction)
-            s_pred_tuple = (bb.tolist(), softmax_prediction) 
-            page_id = db_ex.page_id
+            s_pred_tuple = (bb.tolist(), softmax_prediction)
             pred_dict[page_id].append(pred_tuple)
             s_pred_dict[page_id].append(s_pred_tuple)
 
-        return pred_dict, s_pred_dict
+    def _score_object(self, batch):
+        """
+        Score a single object with one forward pass
+        :param batch: collated Batch holding one object
+        :return: [1 x ncls] class scores
+        """
+        windows = batch.neighbor_windows.to(self.device)
+        ex = batch.center_windows.to(self.device)
+        ex_color = get_colorfulness(ex).to(self.device).reshape(-1,1)
+        radii = get_radii(batch.center_bbs[0],batch.neighbor_boxes[0]).to(self.device).reshape(-1,1)
+        angles = get_angles(batch.center_bbs[0], batch.neighbor_boxes[0]).to(self.device).reshape(-1,1)
+        windows_sub = windows[0]
+        ex_sub = ex[0].unsqueeze(0)
+        rois, cls_scores = self.model(ex_sub, windows_sub,radii, angles, ex_color, batch.center_bbs, self.device)
+        return cls_scores
+
+    def _score_batch(self, batch, neighbor_mask):
+        """
+        Score a padded batch of objects with one forward pass
+        :param batch: collated Batch
+        :param neighbor_mask: [B x M] mask of real neighbors
+        :return: [B x ncls] class scores
+        """
+        windows = batch.neighbor_windows.to(self.device)
+        ex = batch.center_windows.to(self.device)
+        neighbor_counts = neighbor_mask.sum(dim=1).tolist()
+        # colorfulness, radii and angles are computed object by object, exactly as _score_object does
+        ex_color = torch.stack([get_colorfulness(w.unsqueeze(0)) for w in ex]).to(self.device).reshape(-1,1)
+        radii = pad_sequence([get_radii(bb, nbrs[:n]) for bb, nbrs, n in zip(batch.center_bbs, batch.neighbor_boxes, neighbor_counts)], batch_first=True, padding_value=-1)
+        angles = pad_sequence([get_angles(bb, nbrs[:n]) for bb, nbrs, n in zip(batch.center_bbs, batch.neighbor_boxes, neighbor_counts)], batch_first=True, padding_value=-1)
+        rois, cls_scores = self.model(ex, windows, radii.to(self.device), angles.to(self.device), ex_color, batch.center_bbs, self.device,
+                                      neighbor_mask=neighbor_mask.to(self.device))
+        return cls_scores
 
     def _get_predictions(self, windows, proposals):
         """
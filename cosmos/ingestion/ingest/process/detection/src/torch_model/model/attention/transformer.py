@@ -7,19 +7,24 @@ import torch
 from torch import nn
 from torch.nn.functional import softmax
 
-# TODO this code does not yet support batching
-
 class ScaledDotProductAttention(nn.Module):
     def __init__(self):
         super(ScaledDotProductAttention, self).__init__()
 
-    def forward(self, Q, K, V):
+    def forward(self, Q, K, V, mask=None):
         """
         Scaled Dot Product Attention for Images
         Q = [1 x Dims]
         K = [M x Dims]
         V = [M x H x W x 3]
+        or, for a padded batch of B objects
+        Q = [B x Dims]
+        K = [B x M x Dims]
+        V = [B x M x H x W x 3]
+        mask = [B x M], False for padded neighbors
         """
+        if K.dim() == 3:
+            return self._forward_batch(Q, K, V, mask)
         neighbors, dim = K.shape
         logits = torch.matmul(Q, K.t())
         logits = torch.div(logits, dim)
@@ -31,6 +36,16 @@ class ScaledDotProductAttention(nn.Module):
         del weighted_V
         return torch.sum(V, dim=0)
 
+    def _forward_batch(self, Q, K, V, mask):
+        B, neighbors, dim = K.shape
+        logits = torch.bmm(K, Q.unsqueeze(2)).squeeze(2)
+        logits = torch.div(logits, dim)
+        if mask is not None:
+            logits = logits.masked_fill(~mask, float('-inf'))
+        weights = softmax(logits, dim=1)
+        weights = weights.view(B, neighbors, *([1] * (V.dim() - 2)))
+        return torch.sum(V * weights, dim=1)
+
 
 
 class MultiHeadAttention(nn.Module):
@@ -42,8 +57,17 @@ class MultiHeadAttention(nn.Module):
         self.Q_heads = nn.ModuleList([nn.Linear(emb_dim, emb_dim) for i in range(nheads)])
         self.K_heads = nn.ModuleList([nn.Linear(emb_dim, emb_dim) for i in range(nheads)])
 
-    def forward(self, Q, K,V):
+    def forward(self, Q, K,V, mask=None):
+        """
+        :param Q: [1 x Dims] query, or [B x Dims] for a padded batch
+        :param K: [M x Dims] keys, or [B x M x Dims] for a padded batch
+        :param V: [M x D x H x W] values, or [B x M x D x H x W] for a padded batch
+        :param mask: [B x M] neighbor mask, only used for padded batches
+        :return: [nheads x D x H x W], or [B x nheads x D x H x W] for a padded batch
+        """
         new_qs = [Q_head(Q) for Q_head in self.Q_heads]
         new_ks = [K_head(K) for K_head in self.K_heads]
-        head_results = torch.stack([self.attention(new_qs[i], new_ks[i], V) for i in range(self.nheads)])
+        # batched results keep the batch dimension first
+        stack_dim = 1 if K.dim() == 3 else 0
+        head_results = torch.stack([self.attention(new_qs[i], new_ks[i], V, mask) for i in range(self.nheads)], dim=stack_dim)
         return head_results
@@ -2,6 +2,8 @@
 Class to build and manage featurization backbones
 Author: Josh McGrath
 """
+from contextlib import contextmanager
+import torch
 from torch import nn
 
 from ..connected_components.cc_layer import CCLayer
@@ -27,9 +29,62 @@ class Featurizer(nn.Module):
         return self._forward_CC(*input, **kwargs)
 
 
-    def _forward_CC(self, img_windows,device):
-        windows = self.backbone(img_windows)
+    def _forward_CC(self, img_windows,device, segments=None):
+        """
+        :param img_windows: [N x 3 x H x W] windows to featurize
+        :param device: Device config
+        :param segments: Optional [N] tensor of group ids. When set, batch norm layers running on batch
+        statistics compute those statistics per group, so one call gives the same maps as one call per group
+        :return: [N x D x H' x W'] convolutional maps
+        """
+        if segments is None:
+            return self.backbone(img_windows)
+        with segmented_batch_norm(self.backbone, segments):
+            windows = self.backbone(img_windows)
         return windows
 
     def get_RPN_outputs(self):
         return self.RPN_history
+
+
+def _segmented_batch_norm_forward(bn, segments, x):
+    """
+    Batch norm over [N x C x H x W] input, with statistics computed separately for each segment
+    :param bn: The BatchNorm2d module providing eps and the affine parameters
+    :param segments: [N] tensor of group ids in [0, G)
+    :param x: input maps
+    :return: normalized maps
+    """
+    N, C, H, W = x.shape
+    nsegments = int(segments.max()) + 1
+    counts = torch.bincount(segments, minlength=nsegments).to(x.dtype) * (H * W)
+    sums = x.new_zeros(nsegments, C).index_add_(0, segments, x.sum(dim=(2, 3)))
+    mean = sums / counts.unsqueeze(1)
+    centered = x - mean[segments].view(N, C, 1, 1)
+    sq_sums = x.new_zeros(nsegments, C).index_add_(0, segments, centered.pow(2).sum(dim=(2, 3)))
+    # batch norm normalizes with the biased variance
+    var = sq_sums / counts.unsqueeze(1)
+    out = centered / torch.sqrt(var[segments].view(N, C, 1, 1) + bn.eps)
+    if bn.affine:
+        out = out * bn.weight.view(1, C, 1, 1) + bn.bias.view(1, C, 1, 1)
+    return out
+
+
+@contextmanager
+def segmented_batch_norm(module, segments):
+    """
+    Temporarily switch every BatchNorm2d in module that uses batch statistics to per segment statistics.
+    Layers in eval mode already normalize each window independently and are left alone.
+    :param module: Module to patch
+    :param segments: [N] tensor of group ids for the next forward passes
+    """
+    patched = []
+    for m in module.modules():
+        if isinstance(m, nn.BatchNorm2d) and (m.training or m.running_mean is None):
+            m.forward = lambda x, bn=m: _segmented_batch_norm_forward(bn, segments, x)
+            patched.append(m)
+    try:
+        yield
+    finally:
+        for m in patched:
+            del m.forward
@@ -42,7 +42,7 @@ class MMFasterRCNN(nn.Module):
         self.cls_names = cfg.CLASSES
 
 
-    def forward(self, input_windows,neighbor_windows, radii, angles, colors,proposals, device):
+    def forward(self, input_windows,neighbor_windows, radii, angles, colors,proposals, device, neighbor_mask=None):
         """
         Process an Image through the network
         :param input_windows: Tensor representing target window pixels
@@ -52,8 +52,12 @@ class MMFasterRCNN(nn.Module):
         :param colors: Color input
         :param proposals: proposals list
         :param device: Device config
+        :param neighbor_mask: [B x M] mask of real neighbors. When passed, the inputs are a padded batch of B objects:
+        input_windows [B x 3 x H x W], neighbor_windows [B x M x 3 x H x W], radii and angles [B x M], colors [B x 1]
         :return: proposals, associated class scores
         """
+        if neighbor_mask is not None:
+            return self._forward_batch(input_windows, neighbor_windows, radii, angles, colors, proposals, device, neighbor_mask)
         maps = self.featurizer(input_windows, device)
         V = self.featurizer(neighbor_windows, device)
         Q = self.embedder(maps, torch.tensor([[0.0]]).to(device),torch.tensor([[0.0]]).to(device))
@@ -62,7 +66,55 @@ class MMFasterRCNN(nn.Module):
         cls_scores = self.head(maps, attn_maps,colors, proposals)
         return proposals, cls_scores
 
- 
+    def _forward_batch(self, input_windows, neighbor_windows, radii, angles, colors, proposals, device, neighbor_mask):
+        """
+        Padded batch version of forward. Every center window and every real neighbor window goes through the
+        backbone in a single call. Batch norm statistics are computed per center window and per neighborhood,
+        matching one forward call per object.
+        :return: proposals, [B x ncls] class scores
+        """
+        B, M = neighbor_mask.shape
+        flat_neighbors = neighbor_windows[neighbor_mask]
+        neighbor_rows = neighbor_mask.nonzero()[:, 0]
+        segments = torch.cat([torch.arange(B, device=neighbor_rows.device), B + neighbor_rows]).to(device)
+        all_maps = self.featurizer(torch.cat([input_windows, flat_neighbors]), device, segments=segments)
+        maps = all_maps[:B]
+        V = all_maps.new_zeros(B, M, *all_maps.shape[1:])
+        V[neighbor_mask] = all_maps[B:]
+        return self.forward_maps(maps, V, radii, angles, colors, proposals, device, neighbor_mask)
+
+    def featurize_windows(self, windows, device):
+        """
+        Run the backbone over a set of proposal windows, normalizing each window on its own.
+        The resulting maps do not depend on which other windows share the call, so they can be cached per page.
+        :param windows: [N x 3 x H x W] windows
+        :param device: Device config
+        :return: [N x D x H' x W'] maps
+        """
+        segments = torch.arange(windows.shape[0], device=windows.device)
+        return self.featurizer(windows, device, segments=segments)
+
+    def forward_maps(self, maps, neighbor_maps, radii, angles, colors, proposals, device, neighbor_mask):
+        """
+        Classify a padded batch of objects from precomputed backbone maps
+        :param maps: [B x D x H x W] center object maps
+        :param neighbor_maps: [B x M x D x H x W] neighbor maps
+        :param radii: [B x M] neighborhood embedding radii
+        :param angles: [B x M] neighborhood angle input
+        :param colors: [B x 1] Color input
+        :param proposals: proposals list
+        :param device: Device config
+        :param neighbor_mask: [B x M] mask of real neighbors
+        :return: proposals, [B x ncls] class scores
+        """
+        B, M = neighbor_mask.shape
+        zeros = torch.zeros(B, 1, device=device)
+        Q = self.embedder(maps, zeros, zeros)
+        K = self.embedder(neighbor_maps.reshape(B * M, *neighbor_maps.shape[2:]), radii.reshape(-1, 1), angles.reshape(-1, 1)).view(B, M, -1)
+        attn_maps = self.attention(Q, K, neighbor_maps, neighbor_mask)
+        cls_scores = self.head(maps, attn_maps, colors, proposals)
+        return proposals, cls_scores
+
     def set_weights(self,mean, std):
         '''
         Set weights
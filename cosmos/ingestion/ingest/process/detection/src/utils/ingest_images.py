@@ -1,6 +1,6 @@
 import sqlalchemy
 import numpy as np
-from ingest.process.detection.src.evaluate.evaluate import calculate_iou
+from ingest.utils.box_overlap import neighbor_index
 from collections import namedtuple
 import torch
 from PIL import Image
@@ -294,21 +294,17 @@ def compute_neighborhoods(partition, expansion_delta, session, orig_size=1920):
     logger.debug('Computing neighborhoods')
     avg_nbhd_size = 0.0
     nbhds = 0.0
-    partition_filter = session.query(Ex).filter(Ex.partition == partition)
-    for ex in partition_filter:
-        orig_bbox = ex.bbox
-        nbhd_bbox = [max(0, orig_bbox[0]-expansion_delta), max(0, orig_bbox[1]-expansion_delta), min(orig_size, orig_bbox[2]+expansion_delta), min(orig_size, orig_bbox[3]+expansion_delta)]
-        # Get all the examples on the same page
-        nbhd = []
-        for page_ex in session.query(Ex).filter(Ex.partition == ex.partition).filter(Ex.page_id == ex.page_id).filter(Ex.object_id != ex.object_id):
-            target_bbox = page_ex.bbox
-            iou = calculate_iou(nbhd_bbox, target_bbox)
-            if iou > 0:
-                nbhr = Neighbor(center_object_id=ex.object_id, neighbor_object_id=page_ex.object_id)
-                nbhd.append(nbhr)
-        nbhds += 1.0
-        avg_nbhd_size += len(nbhd)
-        session.add_all(nbhd)
+    # Group the partition by page, keeping the query order within each page
+    pages = {}
+    for ex in session.query(Ex).filter(Ex.partition == partition):
+        pages.setdefault(ex.page_id, []).append(ex)
+    for page_exs in pages.values():
+        indptr, indices = neighbor_index([ex.bbox.tolist() for ex in page_exs], expansion_delta, orig_size)
+        for idx, ex in enumerate(page_exs):
+            nbhd = [Neighbor(center_object_id=ex.object_id, neighbor_object_id=page_exs[j].object_id) for j in indices[indptr[idx]:indptr[idx+1]]]
+            nbhds += 1.0
+            avg_nbhd_size += len(nbhd)
+            session.add_all(nbhd)
     session.commit()
     logger.debug("=== Done Computing Neighborhoods ===")
     if nbhds != 0.0:
@@ -1,6 +1,8 @@
 """
 Group classes
 """
+import numpy as np
+from ingest.utils.box_overlap import pairwise_iou
 
 def calculate_iou(box1, box2, contains=False):
     # Shamelessly adapted from
@@ -57,6 +59,60 @@ def check_overlap_bb(bb, box):
     iou = calculate_iou(bb, box)
     return iou > 0
 
+def _union_box(box1, box2):
+    return [min(box1[0], box2[0]), min(box1[1], box2[1]), max(box1[2], box2[2]), max(box1[3], box2[3])]
+
+
+def _overlapping(boxes1, boxes2):
+    """
+    :return: [N x M] mask of the pairs of boxes with a positive IoU
+    """
+    if len(boxes1) == 0 or len(boxes2) == 0:
+        return np.zeros((len(boxes1), len(boxes2)), dtype=bool)
+    return pairwise_iou(boxes1, boxes2) > 0
+
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def _merge_overlapping(nbhds):
+    """
+    Merge intersecting neighborhoods until no two neighborhoods intersect. Each round joins the connected
+    components of the intersection graph with union-find and replaces each component by its bounding box,
+    which can in turn intersect other boxes
+    :param nbhds: [(coords, [(score, cls)])]
+    :return: merged neighborhoods, ordered by their first member. A merged neighborhood keeps the class list
+    with the highest top score
+    """
+    while len(nbhds) > 1:
+        overlaps = _overlapping([bb for bb, _ in nbhds], [bb for bb, _ in nbhds])
+        np.fill_diagonal(overlaps, False)
+        if not overlaps.any():
+            break
+        parent = list(range(len(nbhds)))
+        for i, j in zip(*np.nonzero(np.triu(overlaps))):
+            ri, rj = _find(parent, i), _find(parent, j)
+            if ri != rj:
+                parent[max(ri, rj)] = min(ri, rj)
+        components = {}
+        for i in range(len(nbhds)):
+            components.setdefault(_find(parent, i), []).append(i)
+        merged = []
+        for members in components.values():
+            box, cls_list = nbhds[members[0]]
+            for m in members[1:]:
+                box = _union_box(box, nbhds[m][0])
+                if nbhds[m][1][0][0] > cls_list[0][0]:
+                    cls_list = nbhds[m][1]
+            merged.append((box, cls_list))
+        nbhds = merged
+    return nbhds
+
+
 def group_cls(obj_list, g_cls, do_table_merge=False, merge_over_classes=None):
     """
     Group bounding boxes of the ground truth class if they do not overlap with other classes
@@ -65,6 +121,11 @@ def group_cls(obj_list, g_cls, do_table_merge=False, merge_over_classes=None):
     :param do_table_merge: flag to do special table case.
     :param merge_over_classes: Optional list of classes to ignore when considering merging
     """
+    ccls = [g_cls]
+    if merge_over_classes is not None:
+        ccls.extend(merge_over_classes)
+    # a neighborhood can only grow over objects of the classes in ccls
+    blockers = [coords for coords, cls_list in obj_list if cls_list[0][1] not in ccls]
     nbhds = []
     for obj in obj_list:
         coords, cls_list = obj
@@ -72,16 +133,13 @@ def group_cls(obj_list, g_cls, do_table_merge=False, merge_over_classes=None):
             if len(nbhds) == 0:
                 nbhds.append((coords, cls_list))
                 continue
+            # construct a bounding box over this object and every neighborhood, and test them all at once
+            new_boxes = [_union_box(nbhd_bb, coords) for nbhd_bb, _ in nbhds]
+            blocked = _overlapping(new_boxes, blockers).any(axis=1)
             new_nbhd_list = []
             added = False
-            for nbhd_bb in nbhds:
-                # construct a bounding box over this table and the neighborhood
-                nbhd_bb, cls_list2 = nbhd_bb
-                new_box = [min(nbhd_bb[0], coords[0]), min(nbhd_bb[1], coords[1]), max(nbhd_bb[2], coords[2]), max(nbhd_bb[3], coords[3])]
-                ccls = [g_cls]
-                if merge_over_classes is not None:
-                    ccls.extend(merge_over_classes)
-                if check_overlap(obj_list, new_box, check_cls=ccls):
+            for (nbhd_bb, cls_list2), new_box, is_blocked in zip(nbhds, new_boxes, blocked):
+                if not is_blocked:
                     new_nbhd_list.append((new_box, cls_list2 if cls_list2[0][0] >= cls_list[0][0] and cls_list2[0][1] == g_cls else cls_list))
                     added = True
                 else:
@@ -92,55 +150,17 @@ def group_cls(obj_list, g_cls, do_table_merge=False, merge_over_classes=None):
             nbhds = new_nbhd_list
     # During a table merge, there is a chance that multiple neighborhoods are intersecting. In this case, we merge the intersecting neighborhoods
     if do_table_merge:
-        while True:
-            new_nbhds = []
-            merged_nbhds = []
-            # Now we check for intersecting table neighborhoods
-            for nbhd in nbhds:
-                nbhd, cls_list = nbhd
-                for nbhd2 in nbhds:
-                    nbhd2, cls_list2 = nbhd2
-                    if nbhd2 == nbhd:
-                        continue
-                    iou = calculate_iou(nbhd, nbhd2)
-                    if iou > 0:
-                        # merge the neighborhoods
-                        new_box = [min(nbhd[0], nbhd2[0]), min(nbhd[1], nbhd2[1]), max(nbhd[2], nbhd2[2]), max(nbhd[3], nbhd2[3])]
-                        if new_box in new_nbhds:
-                            continue
-                        # keep track of the original neighborhoods we merge
-                        merged_nbhds.append(nbhd)
-                        merged_nbhds.append(nbhd2)
-                        new_nbhds.append((new_box, cls_list2 if cls_list2[0][0] >= cls_list[0][0] else cls_list))
-            for nbhd in nbhds:
-                nbhd, cls_list = nbhd
-                if nbhd not in merged_nbhds:
-                    new_nbhds.append((nbhd, cls_list))
-            # continue until convergence
-            if new_nbhds == nbhds:
-                break
-            nbhds = new_nbhds
-
-    filter_objs = []
-    # now we need to check for other overlaps
-    for nbhd in nbhds:
-        nbhd, cls_list = nbhd
-        for obj in obj_list:
-            coords, cls_list = obj
-            obj_iou = calculate_iou(coords, nbhd)
-            if obj_iou > 0:
-                filter_objs.append(obj)
-    # Filter the objects we merged over
-    obj_list = [o for o in obj_list if o not in filter_objs]
+        nbhds = _merge_overlapping(nbhds)
+
+    # Filter the objects we merged over, and any other object overlapping a neighborhood
+    covered = _overlapping([coords for coords, _ in obj_list], [nbhd for nbhd, _ in nbhds]).any(axis=1)
     new_obj_list = []
-    for obj in obj_list:
+    for obj, is_covered in zip(obj_list, covered):
         coords, cls_list = obj
-        if cls_list[0][1] != g_cls:
+        if not is_covered and cls_list[0][1] != g_cls:
             new_obj_list.append(obj)
     for nbhd in nbhds:
         nbhd, cls_list = nbhd
         assert cls_list[0][1] == g_cls
         new_obj_list.append((nbhd, cls_list))
     return new_obj_list
-
-
@@ -2,86 +2,75 @@
 Run OCR over docs, also merge
 """
 
-import functools
 import json
 import logging
 import pytesseract
 from .group_cls import group_cls
 import pandas as pd
+import numpy as np
 from PIL import Image
-import pickle
-from ingest.process.detection.src.evaluate.evaluate import calculate_iou
+from ingest.utils.box_overlap import pairwise_iou
+from ingest.utils.page_state import load_page, save_page
+from ingest.utils.metrics import stage, page_labels
 
 logging.basicConfig(format='%(levelname)s :: %(filename) :: %(funcName)s :: %(asctime)s :: %(message)s', level=logging.ERROR)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.ERROR)
 
 
-def regroup(pkl_path):
-    with open(pkl_path, 'rb') as rf:
-        obj = pickle.load(rf)
-    l = group_cls(obj['detected_objs'], 'Table', do_table_merge=True, merge_over_classes=['Figure', 'Section Header', 'Page Footer', 'Page Header'])
-    obj['detected_objs'] = group_cls(l, 'Figure')
-    with open(pkl_path, 'wb') as wf:
-        pickle.dump(obj, wf)
-    return pkl_path
+def regroup(page):
+    obj = load_page(page)
+    with stage('regroup', **page_labels(obj)) as record:
+        l = group_cls(obj['detected_objs'], 'Table', do_table_merge=True, merge_over_classes=['Figure', 'Section Header', 'Page Footer', 'Page Header'])
+        obj['detected_objs'] = group_cls(l, 'Figure')
+        record['objects'] = len(obj['detected_objs'])
+    return save_page(page, obj)
 
 
-def pool_text(pkl_path, skip_ocr=True):
-    with open(pkl_path, 'rb') as rf:
-        obj = pickle.load(rf)
+def pool_text(page, skip_ocr=True):
+    obj = load_page(page)
     meta_df = obj['meta']
     detect_objs = obj['detected_objs']
-    if meta_df is not None:
-        text_map = _pool_text_meta(meta_df, obj['dims'][3], detect_objs, obj['page_num'])
-    elif not skip_ocr:
-        text_map = _pool_text_ocr(obj['page_path'], detect_objs)
-    else:
-        text_map = _placeholder_map(detect_objs)
+    with stage('pool_text', **page_labels(obj)) as record:
+        if meta_df is not None:
+            text_map = _pool_text_meta(meta_df, obj['dims'][3], detect_objs, obj['page_num'])
+            record['source'] = 'meta'
+        elif not skip_ocr:
+            text_map = _pool_text_ocr(obj['page_path'], detect_objs)
+            record['source'] = 'ocr'
+        else:
+            text_map = _placeholder_map(detect_objs)
+            record['source'] = 'none'
+        record['objects'] = len(text_map)
     obj['content'] = text_map
-    with open(pkl_path, 'wb') as wf:
-        pickle.dump(obj, wf)
-    return pkl_path
-
-
-def check_overlap(b2, row):
-    b1 = (row['x1'], row['y1'], row['x2'], row['y2'])
-    iou = calculate_iou(b1, b2)
-    return iou != 0.0
+    return save_page(page, obj)
 
 
 def _pool_text_meta(meta_df, height, detect_objs, page_num):
     text_df = pd.DataFrame(meta_df)
     logger.debug(f'Page number: {page_num}')
+    # Only lines on this page can be pooled, filter before doing any overlap work
+    text_df = text_df[text_df['page'] == page_num-1]
     # Switch coordinate systems to bottom left is the origin
-    text_df['y1'] = height - text_df['y1']
-    text_df['y2'] = height - text_df['y2']
-    text_df['y3'] = text_df['y1']
-    text_df['y1'] = text_df['y2']
-    text_df['y2'] = text_df['y3']
-    pooled = []
-    for dobj in detect_objs:
-        bb, scrs = dobj
-        bb = tuple(bb)
+    text_df = text_df.assign(y1=height - text_df['y2'], y2=height - text_df['y1'])
+    # Pooled text is read top to bottom, left to right. The sort is stable, so sorting once
+    # and then selecting each object's lines keeps the same order as sorting every selection
+    text_df = text_df.sort_values(by=['y2', 'x1'])
+    texts = np.array(text_df['text'].tolist(), dtype=object)
+    obj_boxes = []
+    for bb, _ in detect_objs:
         tl_x, tl_y, br_x, br_y = bb
         # have to feather a bit, pdfs dont have tight bounding boxes usually
-        tl_x -= 10
-        br_x += 10
-        tl_y -= 10
-        br_y += 10
-        go = functools.partial(check_overlap, (tl_x, tl_y, br_x, br_y))
-        text_df['overlap'] = text_df.apply(go, axis=1)
+        obj_boxes.append((tl_x - 10, tl_y - 10, br_x + 10, br_y + 10))
+    # [lines x objects] overlap mask
+    overlaps = pairwise_iou(text_df[['x1', 'y1', 'x2', 'y2']].to_numpy(), obj_boxes) != 0.0
+    pooled = []
+    for idx, (bb, scrs) in enumerate(detect_objs):
+        bb = tuple(bb)
+        text_pool = ' '.join(texts[overlaps[:, idx]])
         logger.debug(f'Bounding box: {bb}')
-        df = text_df[text_df['overlap'] == True]
-        logger.debug(f'Overlap: {df[["overlap", "x1", "y1", "x2", "y2", "text"]]}')
-        logger.debug(f'Number of overlaps: {text_df.overlap[text_df.overlap == True].count()}')
-        text_pool = text_df.loc[(text_df['page'] == page_num-1) & (text_df['overlap'] == True)]
-        #text_pool = text_df.loc[(text_df['page'] == page_num-1) & (text_df['x2'] <= br_x) & (text_df['y1'] >= tl_y) &
-        #                        (text_df['x1'] >= tl_x) & (text_df['y2'] <= br_y)]
-        text_pool = text_pool.sort_values(by=['y2', 'x1'])
-        text_pool = ' '.join(text_pool['text'].tolist())
+        logger.debug(f'Number of overlaps: {overlaps[:, idx].sum()}')
         logger.debug(f'Text pool: {text_pool}')
-        logger.debug('-------')
         pooled.append((bb, scrs, text_pool))
     return pooled
 
@@ -6,36 +6,58 @@ from bs4 import BeautifulSoup
 import codecs
 import re
 import ast
+from ingest.utils.box_overlap import as_boxes, neighborhood_overlaps
 
 expansion_delta = 50
 orig_size=1920
+max_nhds = 15
+
+# caption patterns, compiled once instead of on every object
+fig_pattern = re.compile(r'^(figure|fig)(?:\.)? (?:(\d+\w+(?:\.)?)|(\d+))', flags=re.IGNORECASE|re.MULTILINE)
+table_pattern = re.compile(r'^(table|tbl|tab)(?:\.)? (?:(\d+\w+(?:\.)?)|(\d+))', flags=re.IGNORECASE|re.MULTILINE)
+
+def class_index(classes):
+    """
+    :param classes: list of class names, or a dict built by an earlier call
+    :return: dict mapping each class name to its position in classes, like classes.index
+    """
+    if isinstance(classes, dict):
+        return classes
+    index = {}
+    for i, cls in enumerate(classes):
+        index.setdefault(cls, i)
+    return index
 
 def get_width_height(bbox):
     return bbox[2]-bbox[0], bbox[3]-bbox[1]
 
-def compute_neighbors(center, predict_list):
-    center_bbox,_,_ = center
-    nbhds = []
-    for cand in predict_list:
-        if(center != cand):
-            nbhd_bbox,_,_ = cand
-            nbhd_bbox = [max(0, nbhd_bbox[0]-expansion_delta), max(0, nbhd_bbox[1]-expansion_delta), min(orig_size, nbhd_bbox[2]+expansion_delta), min(orig_size, nbhd_bbox[3]+expansion_delta)] 
-            iou = calculate_iou(nbhd_bbox, center_bbox)
-            if iou >0:
-                nbhds.append([cand, iou])
+def compute_page_neighbors(predict_list):
+    """
+    Neighborhoods of every prediction on a page, from one overlap matrix over the page
+    :param predict_list: list of predictions, each with its bounding box first
+    :return: list with, for each prediction, [[cand, iou]] for every other prediction whose expanded box overlaps it
+    """
+    if len(predict_list) == 0:
+        return []
+    boxes = [predict[0] for predict in predict_list]
+    # entry (cand, center) is the iou of the expanded candidate box with the center box
+    overlaps = neighborhood_overlaps(boxes, expansion_delta, orig_size)
+    nbhds = [[] for _ in predict_list]
+    for center_idx, cand_idx in zip(*np.nonzero(overlaps.T > 0)):
+        center = predict_list[center_idx]
+        cand = predict_list[cand_idx]
+        if center != cand:
+            nbhds[center_idx].append([cand, float(overlaps[cand_idx, center_idx])])
     return nbhds
 
+def compute_neighbors(center, predict_list):
+    """
+    Neighborhood of a single prediction, see compute_page_neighbors
+    """
+    return compute_page_neighbors([center] + list(predict_list))[0]
+
 def compute_neighbors_train(center, predict_list):
-    center_bbox,_,_,_,_ = center
-    nbhds = []
-    for cand in predict_list:
-        if(center != cand):
-            nbhd_bbox,_,_,_,_ = cand
-            nbhd_bbox = [max(0, nbhd_bbox[0]-expansion_delta), max(0, nbhd_bbox[1]-expansion_delta), min(orig_size, nbhd_bbox[2]+expansion_delta), min(orig_size, nbhd_bbox[3]+expansion_delta)] 
-            iou = calculate_iou(nbhd_bbox, center_bbox)
-            if iou >0:
-                nbhds.append([cand, iou])
-    return nbhds
+    return compute_neighbors(center, predict_list)
 
 
 def not_ocr(text):
@@ -81,31 +103,33 @@ def process_html(html_file):
         html_list = process_body(soup)    
         return html_list
 
-def get_feat_vec(predict, predict_list, classes):
+def get_feat_vec(predict, predict_list, classes, nbhds=None):
     max_nhds = 15
     feat_vec = []
+    classes = class_index(classes)
     p_bb, p_cls_scores, text = predict
     p_score, p_cls = p_cls_scores[0]
     
     # Neighborhood features
-    nbhds = compute_neighbors(predict, predict_list)
+    if nbhds is None:
+        nbhds = compute_neighbors(predict, predict_list)
     nbhds_sorted = sorted(nbhds, key=lambda nbhds: (nbhds[0]))
     feat_nbhd1 = []
     nbhr_count = 1
     for nbhr in nbhds:
         nbhr_bb, nbhr_cls_scores, _ = nbhr[0]
         nbhr_score, nbhr_cls = nbhr_cls_scores[0]
-        feat_nbhd1.append(classes.index(nbhr_cls))
+        feat_nbhd1.append(classes[nbhr_cls])
         if nbhr_count == 15:
             break
         nbhr_count += 1
     feat_nbhd1.extend([-1] * (max_nhds - len(feat_nbhd1)))
     width, height = get_width_height(p_bb)  
         
-    feat_vec.append(classes.index(p_cls))
+    feat_vec.append(classes[p_cls])
     feat_vec.append(p_score)
 
-    sorted_cls_scores = sorted(p_cls_scores, key=lambda ele: classes.index(ele[1])) # Predicted Confidence scores of all classes sorted based on classes
+    sorted_cls_scores = sorted(p_cls_scores, key=lambda ele: classes[ele[1]]) # Predicted Confidence scores of all classes sorted based on classes
     sorted_scores = [row[0] for row in sorted_cls_scores]
     feat_vec.extend(sorted_scores)
     
@@ -117,34 +141,36 @@ def get_feat_vec(predict, predict_list, classes):
     
     #Textual features
     
-    fig_matches = 1 if len(re.findall('^(figure|fig)(?:\.)? (?:(\d+\w+(?:\.)?)|(\d+))', text, flags=re.IGNORECASE|re.MULTILINE)) > 0 else 0
-    table_matches = 1 if len(re.findall('^(table|tbl|tab)(?:\.)? (?:(\d+\w+(?:\.)?)|(\d+))', text, flags=re.IGNORECASE|re.MULTILINE)) > 0 else 0  
+    fig_matches = 1 if fig_pattern.search(text) is not None else 0
+    table_matches = 1 if table_pattern.search(text) is not None else 0
     feat_vec.append(fig_matches)
     feat_vec.append(table_matches)
    
     return feat_vec
 
-def get_feat_vec_train(predict, predict_list, classes):
+def get_feat_vec_train(predict, predict_list, classes, nbhds=None):
     max_nhds = 15
     feat_vec = []    
+    classes = class_index(classes)
     p_bb, cls_scores, p_score, p_cls, text = predict
     
     # Neighbhorhood features
-    nbhds = compute_neighbors_train(predict, predict_list)
+    if nbhds is None:
+        nbhds = compute_neighbors_train(predict, predict_list)
     if len(nbhds) > max_nhds:
         max_nhds = len(nbhds)
     nbhds_sorted = sorted(nbhds, key=lambda nbhds: (nbhds[0]))
     feat_nbhd1 = []
     for nbhd in nbhds:
-        nbhd_bb, cls_scores, nbhd_score, nbhd_cls, _ = nbhd[0]
+        nbhd_bb, nbhd_cls_scores, nbhd_score, nbhd_cls, _ = nbhd[0]
         nbhd_score = 0.1
         nbhd_bb = tuple(nbhd_bb)
-        feat_nbhd1.append(classes.index(nbhd_cls))
+        feat_nbhd1.append(classes[nbhd_cls])
     feat_nbhd1.extend([-1] * (15 - len(feat_nbhd1)))
 
     width, height = get_width_height(p_bb)  
         
-    feat_vec.append(classes.index(p_cls))
+    feat_vec.append(classes[p_cls])
     feat_vec.append(p_score)
 
     feat_vec.extend(ast.literal_eval(cls_scores))
@@ -157,14 +183,107 @@ def get_feat_vec_train(predict, predict_list, classes):
 
     #Textual features
     
-    fig_matches = 1 if len(re.findall('^(figure|fig)(?:\.)? (?:(\d+\w+(?:\.)?)|(\d+))', str(text), flags=re.IGNORECASE|re.MULTILINE)) > 0 else 0
-    table_matches = 1 if len(re.findall('^(table|tbl|tab)(?:\.)? (?:(\d+\w+(?:\.)?)|(\d+))', str(text), flags=re.IGNORECASE|re.MULTILINE)) > 0 else 0 
+    fig_matches = 1 if fig_pattern.search(str(text)) is not None else 0
+    table_matches = 1 if table_pattern.search(str(text)) is not None else 0
     feat_vec.append(fig_matches)
     feat_vec.append(table_matches)   
    
     return feat_vec      
 
 
+def _duplicates(boxes, top_cls, top_score, scores, texts):
+    """
+    [N x N] mask of predictions that are equal to each other, they are left out of each other's neighborhoods.
+    Only predictions sharing a box can be equal, so the other fields are only compared for those
+    """
+    n = len(boxes)
+    same = np.eye(n, dtype=bool)
+    groups = {}
+    for i, box in enumerate(boxes.tolist()):
+        groups.setdefault(tuple(box), []).append(i)
+    for members in groups.values():
+        if len(members) == 1:
+            continue
+        for a in members:
+            for b in members:
+                same[a, b] = top_cls[a] == top_cls[b] and top_score[a] == top_score[b] and texts[a] == texts[b] \
+                    and np.array_equal(scores[a], scores[b], equal_nan=True)
+    return same
+
+
+def page_features(boxes, top_cls, top_score, scores, texts):
+    """
+    Feature matrix of all predictions on a page, built column by column. Row i equals the feature vector
+    get_feat_vec builds for prediction i
+    :param boxes: [N x 4] boxes
+    :param top_cls: [N] class index of the predicted class of each object
+    :param top_score: [N] score of the predicted class
+    :param scores: [N x C] score of every class, columns in class order, nan for classes an object has no score for
+    :param texts: N texts
+    :return: [N x F] float64 feature matrix
+    """
+    boxes = as_boxes(boxes)
+    top_cls = np.asarray(top_cls, dtype=np.float64)
+    top_score = np.asarray(top_score, dtype=np.float64)
+    scores = np.asarray(scores, dtype=np.float64).reshape(len(boxes), -1)
+    n = len(boxes)
+
+    # neighborhood features, class of the first max_nhds neighbors in page order, -1 padded
+    # entry (center, cand) of the transposed overlaps is the iou of the expanded candidate box with the center box
+    adjacency = neighborhood_overlaps(boxes, expansion_delta, orig_size).T > 0
+    adjacency &= ~_duplicates(boxes, top_cls, top_score, scores, texts)
+    rank = np.cumsum(adjacency, axis=1) - 1
+    centers, cands = np.nonzero(adjacency & (rank < max_nhds))
+    nbhd = np.full((n, max_nhds), -1.0)
+    nbhd[centers, rank[centers, cands]] = top_cls[cands]
+
+    # scores of the classes an object has, in class order
+    present = ~np.isnan(scores)
+    sorted_scores = scores[present].reshape(n, -1) if n > 0 else np.empty((0, 0))
+
+    width = boxes[:, 2] - boxes[:, 0]
+    height = boxes[:, 3] - boxes[:, 1]
+    fig_matches = [1 if fig_pattern.search(text) is not None else 0 for text in texts]
+    table_matches = [1 if table_pattern.search(text) is not None else 0 for text in texts]
+    return np.column_stack([top_cls, top_score, sorted_scores, boxes, width, height, width * height, nbhd,
+                            fig_matches, table_matches]).astype(np.float64)
+
+
+def predict_columns(predict_list, classes):
+    """
+    Columns of detected page objects, the input of page_features
+    :param predict_list: list of (bounding box, [(score, class)] best first, text)
+    :param classes: list of class names
+    :return: boxes, top_cls, top_score, scores, texts
+    """
+    classes = class_index(classes)
+    boxes = np.array([predict[0] for predict in predict_list], dtype=np.float64).reshape(-1, 4)
+    top_cls = np.array([classes[predict[1][0][1]] for predict in predict_list], dtype=np.float64)
+    top_score = np.array([predict[1][0][0] for predict in predict_list], dtype=np.float64)
+    scores = np.full((len(predict_list), max(classes.values(), default=-1) + 1), np.nan)
+    for i, predict in enumerate(predict_list):
+        for score, cls in predict[1]:
+            scores[i, classes[cls]] = score
+    texts = [predict[2] for predict in predict_list]
+    return boxes, top_cls, top_score, scores, texts
+
+
+def train_columns(predict_list, classes):
+    """
+    Columns of the objects read from an html page by process_html, the input of page_features
+    :param predict_list: list of (bounding box, str list of class scores in class order, score, class, text)
+    :param classes: list of class names
+    :return: boxes, top_cls, top_score, scores, texts
+    """
+    classes = class_index(classes)
+    boxes = np.array([predict[0] for predict in predict_list], dtype=np.float64).reshape(-1, 4)
+    top_cls = np.array([classes[predict[3]] for predict in predict_list], dtype=np.float64)
+    top_score = np.array([float(predict[2]) for predict in predict_list], dtype=np.float64)
+    scores = np.array([ast.literal_eval(predict[1]) for predict in predict_list], dtype=np.float64)
+    texts = [str(predict[4]) for predict in predict_list]
+    return boxes, top_cls, top_score, scores.reshape(len(predict_list), -1), texts
+
+
 def get_target(predict, list_map, classes):
     p_bb,_ , p_score, p_cls,_ = predict
     p_score = 0.1
@@ -178,47 +297,48 @@ def get_target(predict, list_map, classes):
 
 
 def load_data_objs(predict_list, classes):
-    features = []
-    for predict in predict_list:
-        features.append(get_feat_vec(predict, predict_list, classes))
-    f = np.asarray(features)
-    return f
+    if len(predict_list) == 0:
+        return np.empty((0, 0))
+    return page_features(*predict_columns(predict_list, classes))
+
+
+def _load_html_page(input_dir, f, classes):
+    """
+    Features and targets of the objects of one html page that match a target object
+    :return: ([M x F] feature matrix or None if no object matched, M targets)
+    """
+    predict_list = process_html(f)
+    target_path = os.path.splitext(os.path.basename(f))[0]
+    target_path = os.path.join(input_dir, "target/{}.xml".format(target_path))
+    target_list = xml2list(target_path)
+
+    list_map = match_lists(predict_list, target_list)
+    keep = []
+    targets = []
+    for ind, predict in enumerate(predict_list):
+        target = get_target(predict, list_map, classes)
+        if target == -1:
+            continue
+        keep.append(ind)
+        targets.append(target)
+    if len(keep) == 0:
+        return None, targets
+    return page_features(*train_columns(predict_list, classes))[keep], targets
 
 
 def load_data_train(input_dir, classes):
     features = []
     targets = []
     for f in glob.glob(os.path.join(input_dir, "html/*.html")):
-        predict_list = process_html(f)
-        target_path = os.path.splitext(os.path.basename(f))[0]
-        target_path = os.path.join(input_dir, "target/{}.xml".format(target_path))
-        target_list = xml2list(target_path)
-
-        list_map = match_lists(predict_list, target_list)
-        for predict in predict_list:
-            target = get_target(predict, list_map, classes)
-            if target == -1:
-                continue
-            targets.append(target)
-            features.append(get_feat_vec_train(predict, predict_list, classes))
-    return np.array(features), np.array(targets)
+        page_x, page_y = _load_html_page(input_dir, f, classes)
+        if page_x is None:
+            continue
+        features.append(page_x)
+        targets.extend(page_y)
+    if len(features) == 0:
+        return np.array(features), np.array(targets)
+    return np.concatenate(features), np.array(targets)
 
 #Use this function to load data for training the model
 def load_data(input_dir, classes):
-    features = []
-    targets = []
-    for f in glob.glob(os.path.join(input_dir, "html/*.html")):
-        predict_list = process_html(f)
-        target_path = os.path.splitext(os.path.basename(f))[0]
-        target_path = os.path.join(input_dir, "target/{}.xml".format(target_path))
-        target_list = xml2list(target_path)
-
-        list_map = match_lists(predict_list, target_list)
-        for predict in predict_list:
-            target = get_target(predict, list_map, classes)
-            if target == -1:
-                continue
-            targets.append(target)
-            features.append(get_feat_vec_train(predict, predict_list, classes))
-    return np.array(features), np.array(targets)
-
+    return load_data_train(input_dir, classes)
@@ -1,4 +1,4 @@
-from ingest.process.postprocess.xgboost_model.featurizer import load_data_objs
+from ingest.process.postprocess.xgboost_model.featurizer import load_data_objs, class_index
 import yaml
 import joblib
 import xgboost
@@ -25,3 +25,33 @@ def run_inference(model, classes, page_objs):
     pred_cls = [classes[p] for p in pred_idxs]
     return list(zip(p_bb, pred_cls, texts, pred_scores))
 
+
+def run_inference_batch(model, classes, pages_objs):
+    """
+    Postprocess the objects of many pages with a single predict_proba call, the per call overhead of the model
+    dominates at the size of a single page
+    :param model: XGBoost classifier
+    :param classes: list of class names
+    :param pages_objs: list with, for each page, the page objects run_inference takes
+    :return: list with, for each page, the output of run_inference on that page
+    """
+    index = class_index(classes)
+    features = [load_data_objs(page_objs, index) for page_objs in pages_objs if len(page_objs) > 0]
+    if len(features) == 0:
+        return ['' for _ in pages_objs]
+    prob = model.predict_proba(np.concatenate(features))
+
+    pred_scores = np.max(prob, axis=1).tolist()
+    pred_cls = [classes[p] for p in np.argmax(prob, axis=1)]
+    results = []
+    start = 0
+    for page_objs in pages_objs:
+        if len(page_objs) == 0:
+            logger.error('run_inference_batch (postprocess) was passed a page with 0 page_objs')
+            results.append('')
+            continue
+        end = start + len(page_objs)
+        p_bb, _, texts = zip(*page_objs)
+        results.append(list(zip(p_bb, pred_cls[start:end], texts, pred_scores[start:end])))
+        start = end
+    return results
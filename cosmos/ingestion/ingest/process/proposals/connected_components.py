@@ -15,69 +15,73 @@ def balance_margins(bmap, img):
     :param img: Map of original image (np nd array)
     :return: Adjusted bmap, Adjusted img, left margin difference (must adjust downstream)
     """
-    img_height = bmap.shape[0]
-    zero_col = np.zeros(img_height)
-    left_w, right_w = 0, 0
-    stop_left, stop_right = False, False
-    for i in range(1, bmap.shape[1]):
-        left = bmap[:, i]
-        right = bmap[:, bmap.shape[1]-i]
-        if not (left == zero_col).all():
-            stop_left = True
-        if not (right == zero_col).all():
-            stop_right = True
-        if stop_left and stop_right:
-            diff = abs(left_w - right_w)
-            if left_w < right_w:
-                img = img[:, :bmap.shape[1]-diff, :]
-                bmap = bmap[:, :bmap.shape[1]-diff]
-            else:
-                img = img[:, diff:, :]
-                bmap = bmap[:, diff:]
-            break
-        elif stop_left:
-            right_w += 1
-        elif stop_right:
-            left_w += 1
+    width = bmap.shape[1]
+    # Margins are measured over columns 1 .. width-1, from the left and from the right
+    nonblank = np.flatnonzero(bmap[:, 1:].any(axis=0)) + 1
+    if len(nonblank) == 0:
+        left_w = right_w = max(width - 1, 0)
+    else:
+        left_w = nonblank[0] - 1
+        right_w = width - nonblank[-1] - 1
+        diff = abs(left_w - right_w)
+        if left_w < right_w:
+            img = img[:, :width-diff, :]
+            bmap = bmap[:, :width-diff]
         else:
-            right_w += 1
-            left_w += 1
-    l_diff = left_w - right_w if left_w > right_w else 0
+            img = img[:, diff:, :]
+            bmap = bmap[:, diff:]
+    l_diff = int(left_w - right_w) if left_w > right_w else 0
     return bmap, img, l_diff
 
 
-def get_blank_rows(inp_np, blank_row_h):
+def blank_projection(inp_np):
+    """
+    Row projection of a binary map
+    :param inp_np: Input nd_array
+    :return: Prefix sums of non blank rows, [H+1]. Rows a..b-1 are blank when the difference of entries b and a is 0
+    """
+    nonblank = inp_np.any(axis=1) if inp_np.shape[1] > 0 else np.zeros(inp_np.shape[0], dtype=bool)
+    return np.concatenate([[0], np.cumsum(nonblank)])
+
+
+def get_blank_rows(inp_np, blank_row_h, projection=None):
     """
     Helper function to get blank rows in input nd array
     :param inp_np: Input nd_array
     :param blank_row_h: Blank row height
+    :param projection: Optional blank_projection(inp_np), so it can be shared across blank row heights
     :return: [integer denoting separation locations via y axis]
     """
-    blank_row = np.zeros((blank_row_h, inp_np.shape[1]))
-    curr_top = 0
-    curr_bot = blank_row_h
+    if projection is None:
+        projection = blank_projection(inp_np)
+    height = inp_np.shape[0]
+    # one window of blank_row_h rows starting at each top coordinate 0 .. nwindows-1
+    nwindows = height - 1 - blank_row_h
+    if nwindows <= 0:
+        return []
+    blank = projection[blank_row_h:blank_row_h+nwindows] == projection[:nwindows]
     white_rows = []
-    while curr_bot < inp_np.shape[0]-1:
-        sub_img = inp_np[curr_top:curr_bot, :]
-        if (sub_img == blank_row).all():
-            if len(white_rows) == 0:
-                white_rows.append(curr_bot)
-                curr_top += 1
-                curr_bot = curr_top + blank_row_h
-                continue
-            last_white_bot = white_rows[len(white_rows)-1]
-            if last_white_bot >= curr_top:
-                white_rows[len(white_rows)-1] = curr_bot
-            else:
-                white_rows.append(curr_bot)
-        elif curr_top == 0:
-            white_rows.append(0)
-        elif curr_bot == inp_np.shape[0]-2:
-            white_rows.append(inp_np.shape[0]-1)
-        curr_top += 1
-        curr_bot = curr_top + blank_row_h
+    if not blank[0]:
+        white_rows.append(0)
+    # Every run of blank windows ends a separation at the bottom of its last window. A run that starts
+    # while the previous separation still covers its top extends that separation instead
+    edges = np.diff(blank.astype(np.int8))
+    run_starts = np.flatnonzero(edges == 1) + 1
+    run_ends = np.flatnonzero(edges == -1)
+    if blank[0]:
+        run_starts = np.concatenate([[0], run_starts])
+    if blank[-1]:
+        run_ends = np.concatenate([run_ends, [nwindows-1]])
+    for run_start, run_end in zip(run_starts.tolist(), run_ends.tolist()):
+        if len(white_rows) > 0 and white_rows[-1] >= run_start:
+            white_rows[-1] = run_end + blank_row_h
+        else:
+            white_rows.append(run_end + blank_row_h)
+    if nwindows > 1 and not blank[-1]:
+        white_rows.append(height-1)
     return white_rows
 
+
 def get_proposals(img, white_thresh=245, blank_row_height=15, filter_thres=5, max_obj_count = 19):
     """
      Function that handles writing of object proposals
@@ -95,16 +99,48 @@ def get_proposals(img, white_thresh=245, blank_row_height=15, filter_thres=5, ma
     bmap_np = np.array(img.convert('L').point(remove_fn, mode='1')).astype(np.uint8)
 
     bmap_np, img_np, left_shave = balance_margins(bmap_np, img_np)
-    white_rows = get_blank_rows(bmap_np, blank_row_height)
+    # The segmentation only depends on the blank row height, so the binary map and its row projection
+    # are computed once and reused while the height grows to bring the object count down
+    projection = blank_projection(bmap_np)
+    while True:
+        block_coords2, obj_count = _segment(bmap_np, projection, blank_row_height)
+        if obj_count <= max_obj_count:
+            break
+        blank_row_height += 5
+
+    block_coords = set()
+    for key in block_coords2:
+        coords_list = block_coords2[key]
+        for ind2, bc in enumerate(coords_list):
+            tl_y1, tl_x1, br_y1, br_x1 = bc
+            # Filter objs that are too small
+            height = br_y1 - tl_y1
+            width = br_x1 - tl_x1
+            if height <= filter_thres or width <= filter_thres:
+                continue
+            adjusted = (left_shave + tl_x1, tl_y1, left_shave + br_x1, br_y1)
+            block_coords.add(adjusted)
+
+    block_coords = list(block_coords)
+    return block_coords
+
+
+def _segment(bmap_np, projection, blank_row_height):
+    """
+    Split a binary map into rows, columns and objects
+    :param bmap_np: Binary map, margins balanced
+    :param projection: blank_projection(bmap_np)
+    :param blank_row_height: row height parameter
+    :return: {(number of columns, column index): [(y1, x1, y2, x2)]} object coordinates, number of objects
+    """
+    white_rows = get_blank_rows(bmap_np, blank_row_height, projection)
     rows = []
     for i in range(len(white_rows)-1):
         curr = white_rows[i]
         nxt = white_rows[i+1]
         rows.append((bmap_np[curr:nxt, :], curr, nxt))
-    block_coords = set()
     block_coords2 = {}
     obj_count = 0
-    obj_heights = 0
     for row, top_coord, bottom_coord in rows:
         blocks = coords = col_idx = num_cols = None
         # Old way
@@ -114,13 +150,14 @@ def get_proposals(img, white_thresh=245, blank_row_height=15, filter_thres=5, ma
         else:
             # New way
             rowT = row.T
+            col_projection = blank_projection(rowT)
             col_height = blank_row_height
-            white_cols = get_blank_rows(rowT, col_height)
+            white_cols = get_blank_rows(rowT, col_height, col_projection)
             num_cols = len(white_cols)
             # This should be something reasonable, like less than 6
             while num_cols > 5:
                 col_height += 5
-                white_cols = get_blank_rows(rowT, col_height)
+                white_cols = get_blank_rows(rowT, col_height, col_projection)
                 num_cols = len(white_cols)
 
             blocks = []
@@ -130,10 +167,7 @@ def get_proposals(img, white_thresh=245, blank_row_height=15, filter_thres=5, ma
             for i in range(len(white_cols)-1):
                 curr = white_cols[i]
                 nxt = white_cols[i+1]
-
-                spl = rowT[curr:nxt, :]
-                spl = spl.T
-                blocks.append(spl)
+                blocks.append(row[:, curr:nxt])
                 coords.append((curr, nxt))
                 col_idx.append(i)
 
@@ -142,52 +176,28 @@ def get_proposals(img, white_thresh=245, blank_row_height=15, filter_thres=5, ma
             column_index = col_idx[ind]
 
             white_rows = get_blank_rows(b, blank_row_height)
-            rows2 = []
             for i in range(len(white_rows)-1):
-                curr = white_rows[i]
-                nxt = white_rows[i+1]
-                rows2.append((b[curr:nxt, :], curr, nxt))
-            for r, c2, n in rows2:
-                # Replacing components with finding the proper pixel vals
-                one_inds = np.argwhere(r)
-                if len(one_inds) == 0:
+                c2 = white_rows[i]
+                r = b[c2:white_rows[i+1], :]
+                # Bounding box of the set pixels, from the row and column projections
+                ys = np.flatnonzero(r.any(axis=1))
+                if len(ys) == 0:
                     continue
-                h_one_inds = np.hsplit(one_inds, 2)
-
-                x1 = int(np.min(h_one_inds[1]))
-                y1 = int(np.min(h_one_inds[0]))
-                x2 = int(np.max(h_one_inds[1]))
-                y2 = int(np.max(h_one_inds[0]))
+                xs = np.flatnonzero(r.any(axis=0))
+                x1 = int(xs[0])
+                y1 = int(ys[0])
+                x2 = int(xs[-1])
+                y2 = int(ys[-1])
 
                 key = (num_cols, column_index)
                 val = (top_coord + c2 + y1, c[0] + x1, top_coord + c2 + y2, c[0]+x2)
                 obj_count += 1
-                obj_heights += y2 - y1
 
                 if key in block_coords2:
                     block_coords2[key].append(val)
                 else:
                     block_coords2[key] = [val]
-
-    if obj_count > 0:
-        if obj_count > max_obj_count:
-            block_coords = get_proposals(
-                img, white_thresh=white_thresh, blank_row_height=5 + blank_row_height, filter_thres=filter_thres, max_obj_count=max_obj_count)
-        else:
-            for key in block_coords2:
-                coords_list = block_coords2[key]
-                for ind2, bc in enumerate(coords_list):
-                    tl_y1, tl_x1, br_y1, br_x1 = bc
-                    # Filter objs that are too small
-                    height = br_y1 - tl_y1
-                    width = br_x1 - tl_x1
-                    if height <= filter_thres or width <= filter_thres:
-                        continue
-                    adjusted = (left_shave + tl_x1, tl_y1, left_shave + br_x1, br_y1)
-                    block_coords.add(adjusted)
-
-    block_coords = list(block_coords)
-    return block_coords
+    return block_coords2, obj_count
 
 
 def get_columns_for_row(row):
@@ -199,6 +209,7 @@ def get_columns_for_row(row):
     # 3/100 width = test width. We need half that for later
     test_width = int(math.ceil(row.shape[1] / 200))
     half_test_width = int(math.ceil(test_width / 2))
+    col_nonblank = row.any(axis=0)
     curr_c = 1
     for c in range(2, 4):
         # Attempt to divide rows into c columns
@@ -208,9 +219,7 @@ def get_columns_for_row(row):
         for i in range(1, c):
             test_points.append(int(row_w / c * i))
         def mark_empty_block(p):
-            block = row[:, p-half_test_width:p+half_test_width]
-            test_col = np.zeros((block.shape[0], block.shape[1]))
-            return (block == test_col).all()
+            return not col_nonblank[p-half_test_width:p+half_test_width].any()
         test_blocks = [mark_empty_block(p) for p in test_points]
         if False not in test_blocks:
             curr_c = c
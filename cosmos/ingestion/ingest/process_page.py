@@ -8,7 +8,10 @@ from ingest.utils.visualize import write_regions
 from ingest.process.proposals.connected_components import get_proposals
 from ingest.process.detection.src.preprocess import pad_image
 from ingest.process.postprocess.xgboost_model.inference import run_inference as postprocess
+from ingest.process.postprocess.xgboost_model.inference import run_inference_batch as postprocess_batch
 from ingest.process.postprocess.pp_rules import apply_rules as postprocess_rules
+from ingest.utils.page_state import load_page, save_page
+from ingest.utils.metrics import stage, page_labels
 from dask.distributed import get_worker
 import pickle
 import logging
@@ -51,9 +54,7 @@ def propose_and_pad(obj, visualize=False):
     return pkl_path
 
 
-def xgboost_postprocess(pkl_path):
-    with open(pkl_path, 'rb') as rf:
-        obj = pickle.load(rf)
+def _process_plugin():
     try:
         worker = get_worker()
         dp = None
@@ -66,24 +67,100 @@ def xgboost_postprocess(pkl_path):
     except Exception as e:
         logger.error(str(e), exc_info=True)
         raise e
+    return dp
+
+
+def xgboost_postprocess(page):
+    obj = load_page(page)
+    dp = _process_plugin()
 
-    objects = obj['content']
-    objects = postprocess(dp.postprocess_model, dp.classes, objects)
-    # remove empty strings returned from postprocess
-    objects = [i for i in objects if i != '']
+    with stage('xgboost_postprocess', **page_labels(obj)) as record:
+        objects = obj['content']
+        objects = postprocess(dp.postprocess_model, dp.classes, objects)
+        # remove empty strings returned from postprocess
+        objects = [i for i in objects if i != '']
+        record['objects'] = len(objects)
 
     obj['xgboost_content'] = objects
-    with open(pkl_path, 'wb') as wf:
-        pickle.dump(obj, wf)
-    return pkl_path
+    return save_page(page, obj)
 
 
-def rules_postprocess(pkl_path):
-    with open(pkl_path, 'rb') as rf:
-        obj = pickle.load(rf)
-    objects = obj['xgboost_content']
-    objects = postprocess_rules(objects)
+def _postprocess_contents(model, classes, contents):
+    """
+    Postprocess the contents of many pages with one model call. If the call fails, the pages are postprocessed
+    one at a time, so only the pages that cannot be postprocessed fail
+    :param contents: {index: page objects}
+    :return: {index: postprocessed objects, or the error the page failed with}
+    """
+    try:
+        return dict(zip(contents, postprocess_batch(model, classes, list(contents.values()))))
+    except Exception as e:
+        logger.error(f'Batched postprocessing failed, postprocessing {len(contents)} pages one at a time: {e}')
+    results = {}
+    for i, objects in contents.items():
+        try:
+            results[i] = postprocess_batch(model, classes, [objects])[0]
+        except Exception as e:
+            logger.error(str(e), exc_info=True)
+            results[i] = e
+    return results
+
+
+def xgboost_postprocess_batch(*pages):
+    """
+    xgboost_postprocess over a batch of pages, possibly from different documents, with one model call.
+    A page that fails does not fail the rest of the batch, see batch_page
+    :param pages: Page dicts or paths to page pickles
+    :return: list of pages, or of the error each page failed with, in the order they were given
+    """
+    results = [None] * len(pages)
+    objs = {}
+    contents = {}
+    for i, page in enumerate(pages):
+        try:
+            objs[i] = load_page(page)
+            contents[i] = objs[i]['content']
+        except Exception as e:
+            logger.error(str(e), exc_info=True)
+            results[i] = e
+    dp = _process_plugin()
+
+    with stage('xgboost_postprocess_batch') as record:
+        batch = _postprocess_contents(dp.postprocess_model, dp.classes, contents)
+        record['pages'] = len(contents)
+        record['objects'] = sum(len(objects) for objects in contents.values())
+    for i, objects in batch.items():
+        if isinstance(objects, Exception):
+            results[i] = objects
+            continue
+        # remove empty strings returned from postprocess
+        objs[i]['xgboost_content'] = [o for o in objects if o != '']
+        try:
+            results[i] = save_page(pages[i], objs[i])
+        except Exception as e:
+            logger.error(str(e), exc_info=True)
+            results[i] = e
+    return results
+
+
+def batch_page(batch, i):
+    """
+    A single page of the output of xgboost_postprocess_batch
+    :param batch: Output of xgboost_postprocess_batch
+    :param i: Index of the page in the batch
+    :return: the page, raises the error the page failed with
+    """
+    page = batch[i]
+    if isinstance(page, Exception):
+        raise page
+    return page
+
+
+def rules_postprocess(page):
+    obj = load_page(page)
+    with stage('rules_postprocess', **page_labels(obj)) as record:
+        objects = obj['xgboost_content']
+        objects = postprocess_rules(objects)
+        record['objects'] = len(objects)
     obj['rules_content'] = objects
-    with open(pkl_path, 'wb') as wf:
-        pickle.dump(obj, wf)
-    return pkl_path
+    return save_page(page, obj)
@@ -25,6 +25,8 @@ import os
 @click.option('--pp_threshold', type=float, default=0.8, help='postprocess_score threshold for identifying an object for table context enrichment')
 @click.option('--d_threshold', type=float, default=-10, help='detect_score threshold for identifying an object for table context enrichment')
 @click.option('--spans', type=int, default=20, help='number of words either side of a table coreference to capture for context')
+@click.option('--cache-dir', type=click.Path(), default=None, help='directory of a result cache shared across runs and datasets')
+@click.option('--cache-max-bytes', type=int, default=None, help='size limit of the result cache')
 def ingest_documents(cluster,
                      tmp_dir,
                      use_semantic_detection,
@@ -44,7 +46,9 @@ def ingest_documents(cluster,
                      ngram,
                      pp_threshold,
                      d_threshold,
-                     spans):
+                     spans,
+                     cache_dir,
+                     cache_max_bytes):
     ingest = Ingest(cluster,
                     tmp_dir=tmp_dir,
                     use_semantic_detection=use_semantic_detection,
@@ -52,7 +56,9 @@ def ingest_documents(cluster,
                     use_rules_postprocess=use_rules_postprocess,
                     use_table_context_enrichment=use_table_context_enrichment,
                     use_qa_table_enrichment=use_qa_table_enrichment,
-                    use_text_normalization=use_text_normalization)
+                    use_text_normalization=use_text_normalization,
+                    cache_dir=cache_dir,
+                    cache_max_bytes=cache_max_bytes)
     ingest.ingest(input_path,
                   dataset_id,
                   output_path,
@@ -6,17 +6,14 @@ import numpy as np
 import pickle
 from ingest.process.detection.src.infer import get_model
 from ingest.process.postprocess.xgboost_model.model import PostProcessTrainer
-from ingest.process.postprocess.xgboost_model.featurizer import get_feat_vec
+from ingest.process.postprocess.xgboost_model.featurizer import load_data_objs
 from xgboost import XGBClassifier
 import yaml
 from ingest.process.detection.src.converters.xml2list import xml2list
 from ingest.process.ocr.ocr import run as ocr
 from joblib import Parallel, delayed
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 import glob
 from ingest.process.detection.src.infer import run_inference
-from ingest.process.detection.src.torch_model.train.data_layer.sql_types import Base
 import os
 from PIL import Image, ImageFile
 from tqdm import tqdm
@@ -65,14 +62,15 @@ def calculate_iou(box1, box2, contains=False):
 def load_data_gt(predict_list, classes, gt_map):
     features = []
     targets = []
-    for predict in predict_list:
+    page_features = load_data_objs(predict_list, classes)
+    for predict, feat_vec in zip(predict_list, page_features):
         bb = predict[0]
         bb = tuple(bb)
         if bb in gt_map:
             if gt_map[bb] is None:
                 continue
             targets.append(classes.index(gt_map[bb]))
-            features.append(get_feat_vec(predict, predict_list, classes))
+            features.append(feat_vec.tolist())
     try:
         pickle.dumps(features)
         pickle.dumps(targets)
@@ -117,11 +115,6 @@ def featurize_obj(obj, xml_dir, classes):
 def featurize_images(image_dir, proposals_dir, xml_dir, model, model_config, device_str, classes, num_processes):
     results = []
     for f in tqdm(glob.glob(os.path.join(image_dir, '*'))):
-        engine = create_engine('sqlite:///:memory:', echo=False)  
-        Session = sessionmaker()
-        Session.configure(bind=engine)
-        Base.metadata.create_all(engine)
-        session = Session()
         id = os.path.basename(f)[:-4]
         ppath = f'{id}.csv'
         with open(os.path.join(proposals_dir, ppath), 'r') as rf:
@@ -133,10 +126,9 @@ def featurize_images(image_dir, proposals_dir, xml_dir, model, model_config, dev
                 proposals.append(coords)
         img = Image.open(f).convert('RGB')
         obj = {'img': img, 'proposals': proposals, 'id': id}
-        detected_objs, _ = run_inference(model, [obj], model_config, device_str, session)
+        detected_objs, _ = run_inference(model, [obj], model_config, device_str)
         detected_objs = detected_objs[id]
         results.append({'id': id, 'img': img, 'detected_objs': detected_objs, 'proposals': proposals})
-        session.close()
 
     featurized = Parallel(n_jobs=num_processes)(delayed(featurize_obj)(r, xml_dir, classes) for r in results)
     final_features = []
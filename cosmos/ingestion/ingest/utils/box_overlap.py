@@ -0,0 +1,80 @@
+"""
+Vectorized box overlap helpers, shared by detection neighborhoods and postprocess features.
+Boxes are (tl_x, tl_y, br_x, br_y) and every function works on all boxes of a page at once,
+giving the same results as calling calculate_iou pair by pair
+"""
+import numpy as np
+
+
+def as_boxes(boxes):
+    """
+    :param boxes: [N x 4] array like of boxes (list, numpy array or tensor)
+    :return: [N x 4] float64 numpy array
+    """
+    return np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+
+
+def expand_boxes(boxes, expansion_delta, orig_size=1920):
+    """
+    Grow each box by expansion_delta on every side, clipped to the image
+    :param boxes: [N x 4] boxes
+    :param expansion_delta: Neighborhood expansion parameter
+    :param orig_size: original size of the image
+    :return: [N x 4] expanded boxes
+    """
+    boxes = as_boxes(boxes)
+    expanded = np.empty_like(boxes)
+    expanded[:, :2] = np.maximum(0, boxes[:, :2] - expansion_delta)
+    expanded[:, 2:] = np.minimum(orig_size, boxes[:, 2:] + expansion_delta)
+    return expanded
+
+
+def pairwise_iou(boxes1, boxes2):
+    """
+    IoU of every pair of boxes
+    :param boxes1: [N x 4] boxes
+    :param boxes2: [M x 4] boxes
+    :return: [N x M] IoU matrix. Pairs whose union is empty get 0
+    """
+    boxes1 = as_boxes(boxes1)
+    boxes2 = as_boxes(boxes2)
+    x_left = np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+    y_top = np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+    x_right = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+    y_bottom = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
+    disjoint = (x_right < x_left) | (y_bottom < y_top)
+    intersection_area = np.where(disjoint, 0, (x_right - x_left) * (y_bottom - y_top))
+    bb1_area = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    bb2_area = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    union = bb1_area[:, None] + bb2_area[None, :] - intersection_area
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = np.where(union != 0, intersection_area / union, 0.0)
+    return np.where(disjoint, 0.0, iou)
+
+
+def neighborhood_overlaps(boxes, expansion_delta, orig_size=1920):
+    """
+    IoU between each box expanded by expansion_delta and every box on the page
+    :param boxes: [N x 4] boxes of one page
+    :param expansion_delta: Neighborhood expansion parameter
+    :param orig_size: original size of the image
+    :return: [N x N] matrix, entry (i, j) is the IoU of box i expanded and box j.
+    Box j is in the neighborhood of box i when the entry is positive and i != j
+    """
+    return pairwise_iou(expand_boxes(boxes, expansion_delta, orig_size), boxes)
+
+
+def neighbor_index(boxes, expansion_delta, orig_size=1920):
+    """
+    Neighborhoods of every box on a page, in CSR form with neighbors in page order
+    :param boxes: [N x 4] boxes of one page
+    :param expansion_delta: Neighborhood expansion parameter
+    :param orig_size: original size of the image
+    :return: indptr [N+1], indices [nnz] int64 arrays. Neighbors of box i are indices[indptr[i]:indptr[i+1]]
+    """
+    adjacency = neighborhood_overlaps(boxes, expansion_delta, orig_size) > 0
+    np.fill_diagonal(adjacency, False)
+    indptr = np.zeros(adjacency.shape[0] + 1, dtype=np.int64)
+    np.cumsum(adjacency.sum(axis=1), out=indptr[1:])
+    indices = np.nonzero(adjacency)[1].astype(np.int64)
+    return indptr, indices
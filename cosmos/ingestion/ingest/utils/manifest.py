@@ -0,0 +1,134 @@
+"""
+Per-document checkpoints for resumable ingestion
+
+The manifest is an append-only JSON lines log kept next to the checkpointed outputs. Every finished page and
+every finished or failed document is one record, the last record for a document or page wins. A crash can at
+worst leave a truncated last line, which is ignored when the manifest is read back. Records carry the stages and
+flags of the run that wrote them, a run with other settings does not reuse them.
+"""
+import os
+import json
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Manifest:
+    """
+    Progress of one dataset, with the paths of the checkpointed page states and document outputs
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: Checkpoint directory, created if needed. Reopening an existing directory resumes from it
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, 'manifest.jsonl')
+        self.documents = {}
+        self.pages = {}
+        if os.path.exists(self.path):
+            with open(self.path) as rf:
+                for line in rf:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning(f'Skipping truncated manifest record in {self.path}')
+                        continue
+                    self._apply(record)
+        self._fh = open(self.path, 'a')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def _apply(self, record):
+        if 'page' in record:
+            self.pages.setdefault(record['pdf'], {})[record['page']] = record
+        else:
+            self.documents[record['pdf']] = record
+
+    def _append(self, record):
+        self._fh.write(json.dumps(record) + '\n')
+        self._fh.flush()
+        self._apply(record)
+
+    def page_path(self, pdf_name, page_num):
+        """
+        :return: Path where the final state of a page is checkpointed
+        """
+        return os.path.join(self.directory, f'{pdf_name}_{page_num}.pkl')
+
+    def part_path(self, pdf_name, name):
+        """
+        :param name: Output name, 'objects' or an aggregation
+        :return: Path where one output of a document is checkpointed
+        """
+        return os.path.join(self.directory, f'{pdf_name}.{name}.parquet')
+
+    def page_done(self, pdf_name, page_num, path, stages, flags=None):
+        """
+        Record a page that went through every stage
+        :param path: Pickle holding the final state of the page
+        :param stages: Names of the stages the page went through
+        :param flags: {name: value} settings of the run that change the state of the page
+        """
+        self._append({'pdf': pdf_name, 'page': page_num, 'status': 'done', 'path': path, 'stages': stages,
+                      'flags': flags})
+
+    def document_done(self, pdf_name, outputs, npages, flags=None):
+        """
+        Record a document whose pages all finished and whose outputs are written
+        :param outputs: {output name: parquet path}
+        :param npages: Number of pages of the document
+        :param flags: {name: value} settings of the run that change the outputs of the document
+        """
+        self._append({'pdf': pdf_name, 'status': 'done', 'outputs': outputs, 'pages': npages, 'flags': flags,
+                      'attempts': self.attempts(pdf_name) + 1})
+
+    def document_failed(self, pdf_name, reason, outputs=None):
+        """
+        Record a document that could not be finished in this run, it is retried on the next one
+        :param reason: Why the document failed, e.g. 'timeout' or 'error'
+        :param outputs: {output name: parquet path} of the pages that did finish
+        """
+        self._append({'pdf': pdf_name, 'status': 'failed', 'reason': reason, 'outputs': outputs or {},
+                      'attempts': self.attempts(pdf_name) + 1})
+
+    def attempts(self, pdf_name):
+        """
+        :return: Number of runs that already tried the document
+        """
+        return self.documents.get(pdf_name, {}).get('attempts', 0)
+
+    def is_done(self, pdf_name, flags=None):
+        """
+        :param flags: Settings of the current run, see document_done
+        :return: True if the document finished with the same flags and all of its outputs still exist
+        """
+        record = self.documents.get(pdf_name)
+        return record is not None and record['status'] == 'done' and record.get('flags') == flags and \
+            all(os.path.exists(path) for path in record['outputs'].values())
+
+    def outputs(self, pdf_name):
+        """
+        :return: {output name: parquet path} of the last run that wrote the document
+        """
+        return self.documents.get(pdf_name, {}).get('outputs', {})
+
+    def finished_pages(self, pdf_name, stages, flags=None):
+        """
+        :param stages: Names of the stages pages go through in the current run
+        :param flags: Settings of the current run, see page_done
+        :return: {page_num: checkpoint path} of the pages of a document that finished with the same stages and flags,
+        and whose checkpoint still exists
+        """
+        return {page_num: record['path'] for page_num, record in self.pages.get(pdf_name, {}).items()
+                if record['status'] == 'done' and record.get('stages') == stages and record.get('flags') == flags
+                and os.path.exists(record['path'])}
@@ -0,0 +1,248 @@
+"""
+Per-stage timing and throughput metrics
+
+Every pipeline stage runs inside a stage() block, which records its wall time, CPU time of the calling thread,
+the RSS of the process when the stage starts and ends, GPU time for GPU stages, and the object counts the stage
+reports. Stages of a process may overlap, so the RSS is that of the whole process, not of the stage alone.
+process_peak_rss_bytes is the peak RSS over the life of the process so far, it is not reset between stages. Records are
+appended to a JSON lines file per process in the directory named by the METRICS_DIR environment variable,
+so Dask workers, make_parquet and cosmos_service all report the same way as long as the variable is set in
+their environment. read_metrics and metrics_to_parquet collect the files of a run.
+
+If prometheus_client is installed and METRICS_PROMETHEUS_PORT is set, stage durations, objects and errors
+are also exported as Prometheus metrics from every process on that port.
+When neither is configured, stage() does nothing.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import socket
+import logging
+import resource
+import threading
+from contextlib import contextmanager
+logger = logging.getLogger(__name__)
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+METRICS_DIR_ENV = 'METRICS_DIR'
+PROMETHEUS_PORT_ENV = 'METRICS_PROMETHEUS_PORT'
+
+_lock = threading.Lock()
+# labels added to every record of this process, e.g. the cosmos_service job id
+_context = {}
+_state = {'configured': False, 'path': None, 'file': None, 'prometheus': None}
+
+
+def set_context(**labels):
+    """
+    Add labels to every record written by this process
+    """
+    _context.update(labels)
+
+
+def _configure():
+    with _lock:
+        if _state['configured']:
+            return
+        directory = os.environ.get(METRICS_DIR_ENV)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            _state['path'] = os.path.join(directory, f'metrics-{socket.gethostname()}-{os.getpid()}.jsonl')
+        port = os.environ.get(PROMETHEUS_PORT_ENV)
+        if port and prometheus_client is None:
+            logger.warning(f'{PROMETHEUS_PORT_ENV} is set but prometheus_client is not installed')
+        elif port and _state['prometheus'] is None:
+            _state['prometheus'] = {
+                'seconds': prometheus_client.Histogram('cosmos_stage_seconds', 'Wall time of pipeline stages', ['stage']),
+                'objects': prometheus_client.Counter('cosmos_stage_objects', 'Objects produced by pipeline stages', ['stage']),
+                'errors': prometheus_client.Counter('cosmos_stage_errors', 'Failed pipeline stages', ['stage']),
+            }
+            try:
+                prometheus_client.start_http_server(int(port))
+            except OSError as e:
+                # every Dask worker process tries the port, the first one serves it
+                logger.info(f'Not serving Prometheus metrics from this process: {e}')
+        _state['configured'] = True
+
+
+def reset():
+    """
+    Close the metrics file and read the configuration from the environment again on the next record
+    """
+    with _lock:
+        if _state['file'] is not None:
+            _state['file'].close()
+        _state.update(configured=False, path=None, file=None)
+
+
+def enabled():
+    """
+    :return: True if stage records go anywhere
+    """
+    _configure()
+    return _state['path'] is not None or _state['prometheus'] is not None
+
+
+def _peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes everywhere else
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _rss_bytes():
+    """Current RSS of the process, None where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as rf:
+            return int(rf.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _gpu_events(gpu):
+    # only processes that already loaded torch run GPU stages, CPU only processes never import it
+    torch = sys.modules.get('torch')
+    if not gpu or torch is None or not torch.cuda.is_available():
+        return None
+    start = torch.cuda.Event(enable_timing=True)
+    end = torch.cuda.Event(enable_timing=True)
+    start.record()
+    return start, end
+
+
+def emit(record):
+    """
+    Write a finished record
+    :param record: dict with at least 'stage', records whose stage is None are dropped
+    """
+    if record['stage'] is None:
+        return
+    record = {**_context, **record}
+    prometheus = _state['prometheus']
+    if prometheus is not None:
+        prometheus['seconds'].labels(record['stage']).observe(record.get('wall_s', 0))
+        prometheus['objects'].labels(record['stage']).inc(record.get('objects') or 0)
+        if record.get('status') == 'error':
+            prometheus['errors'].labels(record['stage']).inc()
+    if _state['path'] is None:
+        return
+    line = json.dumps(record, default=str) + '\n'
+    with _lock:
+        if _state['file'] is None:
+            _state['file'] = open(_state['path'], 'a')
+        _state['file'].write(line)
+        _state['file'].flush()
+
+
+@contextmanager
+def stage(name, gpu=False, **labels):
+    """
+    Record one run of a pipeline stage. The block may add counts to the yielded record, e.g. record['objects']
+    :param name: Stage name, e.g. 'detect'
+    :param gpu: Whether to also time the CUDA work queued by the block, which waits for it to finish
+    :param labels: Labels of the record, usually pdf_name and page_num, see page_labels
+    :return: the record, a dict
+    """
+    record = {'stage': name, **labels}
+    if not enabled():
+        yield record
+        return
+    events = _gpu_events(gpu)
+    record['start'] = time.time()
+    record['rss_start_bytes'] = _rss_bytes()
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    record['status'] = 'ok'
+    try:
+        yield record
+    except BaseException:
+        record['status'] = 'error'
+        raise
+    finally:
+        record['wall_s'] = time.perf_counter() - wall
+        record['cpu_s'] = time.thread_time() - cpu
+        record['rss_end_bytes'] = _rss_bytes()
+        record['process_peak_rss_bytes'] = _peak_rss_bytes()
+        if events is not None:
+            start, end = events
+            end.record()
+            end.synchronize()
+            record['gpu_s'] = start.elapsed_time(end) / 1000
+        emit(record)
+
+
+def observe(name, start, **fields):
+    """
+    Record a stage that was not timed by a stage() block, e.g. a document whose pages ran on several workers
+    :param name: Stage name
+    :param start: time.time() at the start of the stage
+    :param fields: Labels and counts of the record
+    """
+    if not enabled():
+        return
+    emit({'stage': name, **fields, 'start': start, 'status': fields.get('status', 'ok'),
+          'wall_s': time.time() - start, 'rss_end_bytes': _rss_bytes(), 'process_peak_rss_bytes': _peak_rss_bytes()})
+
+
+def timed_iter(name, iterable, labels=None, item_labels=None):
+    """
+    Record producing each item of an iterator as a run of a stage, for stages that are generators
+    :param name: Stage name
+    :param iterable: Iterable producing one item per page, e.g. PageStore.iter_pages
+    :param labels: Labels of every record
+    :param item_labels: Optional function of an item giving more labels of its record
+    :return: generator of the items
+    """
+    iterator = iter(iterable)
+    while True:
+        with stage(name, **(labels or {})) as record:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                record['stage'] = None
+                return
+            if item_labels is not None:
+                record.update(item_labels(item))
+        yield item
+
+
+def page_labels(obj):
+    """
+    :param obj: Page dict
+    :return: labels identifying the page in records
+    """
+    return {'dataset_id': obj.get('dataset_id'), 'pdf_name': obj.get('pdf_name'), 'page_num': obj.get('page_num')}
+
+
+def read_metrics(directory):
+    """
+    :param directory: Metrics directory of a run
+    :return: Pandas frame with one row per record of every process
+    """
+    import pandas as pd
+    records = []
+    for path in sorted(glob.glob(os.path.join(directory, 'metrics-*.jsonl'))):
+        with open(path) as rf:
+            for line in rf:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    return pd.DataFrame(records)
+
+
+def metrics_to_parquet(directory, path):
+    """
+    Collect the records of a run into a single parquet file
+    :param directory: Metrics directory of a run
+    :param path: Output parquet path
+    :return: the records, see read_metrics
+    """
+    df = read_metrics(directory)
+    df.to_parquet(path, engine='pyarrow', compression='gzip')
+    return df
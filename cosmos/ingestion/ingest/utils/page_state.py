@@ -0,0 +1,33 @@
+"""
+Page state handed from one page stage to the next
+
+A page is either a dict passed between Dask tasks in memory, or the path to a pickle in the tmp dir.
+Stages accept both and return the same kind they were given, so the pickle path remains available
+for runs that need to be inspected or resumed.
+"""
+import pickle
+
+
+def load_page(page):
+    """
+    :param page: Page dict, or path to a page pickle
+    :return: Page dict. A dict is shallow copied, Dask may still hold the input of a finished task
+    """
+    if isinstance(page, dict):
+        return dict(page)
+    with open(page, 'rb') as rf:
+        return pickle.load(rf)
+
+
+def save_page(page, obj):
+    """
+    Hand a page on to the next stage
+    :param page: What the stage was given, a page dict or the path to a page pickle
+    :param obj: Updated page dict
+    :return: obj when passing pages in memory, otherwise the pickle path, after writing obj to it
+    """
+    if isinstance(page, dict):
+        return obj
+    with open(page, 'wb') as wf:
+        pickle.dump(obj, wf)
+    return page
@@ -8,6 +8,7 @@ from pdfminer.layout import LAParams
 from pdfminer.converter import PDFPageAggregator
 import logging
 
+import numpy as np
 import pandas as pd
 
 def update_pos(pos1,pos2):
@@ -23,12 +24,39 @@ def update_pos(pos1,pos2):
     y2 = max(pos1[3],pos2[3])
     return (x1,y1,x2,y2)
 
-def parse_pdf(fp):
+def _page_lines(layout, idx):
     """
-    Parse the pdf with pdfminer to get the unicode representation.
+    Text lines of an analyzed page
+    :param layout: pdfminer LTPage
+    :param idx: 0-indexed page number
+    :return: {column: array} columnar text lines, in layout order, as in split_meta
+    """
+    texts = []
+    positions = []
+    for child in layout:
+        if isinstance(child, LTTextBox):
+            for line in child:
+                positions.append(line.bbox)
+                texts.append(line.get_text().strip())
+    coords = np.asarray(positions, dtype=np.float64).reshape(-1, 4)
+    return {'text': texts,
+            'x1': coords[:, 0],
+            'y1': coords[:, 1],
+            'x2': coords[:, 2],
+            'y2': coords[:, 3],
+            'page': np.full(len(texts), idx, dtype=np.int64)}
+
+def iter_pdf_pages(fp, pages=None):
+    """
+    Parse the pdf with pdfminer one page at a time, only one page layout is held in memory
     :param fp: Input file.
-    :return: Pandas frame containing the tokens and the range of the coordinates
+    :param pages: Optional collection of 0-indexed pages to parse, every page if None. Other pages are not
+    interpreted, and parsing stops after the last requested page, so page ranges can be parsed in parallel
+    :return: generator of (0-indexed page, {column: array} text lines of the page, bounding box of the page layout)
     """
+    last = max(pages) if pages is not None and len(pages) > 0 else None
+    if pages is not None and last is None:
+        return
     with open(fp, "rb") as fh:
         parser = PDFParser(fh)
         doc = PDFDocument(parser)
@@ -36,49 +64,99 @@ def parse_pdf(fp):
         rsrcmgr = PDFResourceManager()
         device = PDFPageAggregator(rsrcmgr=rsrcmgr, laparams=laparams)
         interpreter = PDFPageInterpreter(rsrcmgr, device)
-        texts = []
-        text = ''
-        positions = []
-        pos = (10000,10000,-1,-1)
-        pages = []
         for idx, page in enumerate(PDFPage.create_pages(doc)):
+            if pages is not None and idx not in pages:
+                if idx > last:
+                    break
+                continue
             interpreter.process_page(page)
             layout = device.get_result()
-            for child in layout:
-                #logging.info(type(child))
-                #logging.info(f'{child.width} {child.height}')
-                #logging.info('------')
-                if isinstance(child, LTTextBox):
-                    for line in child:
-                        positions.append(line.bbox)
-                        if line.get_text().strip() == 'SPECIMEN':
-                            import ipdb
-                            ipdb.set_trace()
-                        texts.append(line.get_text().strip())
-                        pages.append(idx)
-                        #for char in line:
-                        #    if isinstance(char, LTChar):
-                        #        text += char.get_text()
-                        #        if 'Fig' in text:
-                        #            print(line)
-                        #            #print(char.bbox)
-                        #        pos = update_pos(char.bbox,pos)
-                        #        page = idx
-                        #    else:
-                        #        texts.append(text)
-                        #        positions.append(pos)
-                        #        pages.append(page)
-                        #        text = ''
-                        #        pos = (10000,10000,-1,-1)
-    if len(positions) == 0:
-        return None, None                      
-    x1, y1, x2, y2 = list(zip(*positions))
-    df = pd.DataFrame({
-        "text": texts,
-        "x1": x1,
-        "y1":y1,
-        "x2": x2,
-        "y2":y2,
-        "page": pages
-                       })
-    return df, layout.bbox
+            yield idx, _page_lines(layout, idx), layout.bbox
+
+def has_text(fp):
+    """
+    Check whether the pdf has any text, parsing stops at the first page with text
+    :param fp: Input file.
+    :return: True if any page of the pdf has a text line
+    """
+    return any(len(lines['text']) > 0 for _, lines, _ in iter_pdf_pages(fp))
+
+def parse_pages(fp, pages=None):
+    """
+    Parse the pdf into per-page columnar text lines and per-page bounding boxes
+    :param fp: Input file.
+    :param pages: Optional collection of 0-indexed pages to parse, see iter_pdf_pages
+    :return: ({page index: {column: array}} text lines of the pages with text, as split_meta returns them,
+    {page index: bounding box} of every parsed page)
+    """
+    pages_meta = {}
+    limits = {}
+    for idx, lines, limit in iter_pdf_pages(fp, pages):
+        limits[idx] = limit
+        if len(lines['text']) > 0:
+            pages_meta[idx] = lines
+    return pages_meta, limits
+
+def parse_pdf(fp, pages=None):
+    """
+    Parse the pdf with pdfminer to get the unicode representation.
+    :param fp: Input file.
+    :param pages: Optional collection of 0-indexed pages to parse, every page if None. Other pages are skipped
+    without being interpreted, so a large document can be parsed in shards and merged with merge_parsed
+    :return: Pandas frame containing the tokens and the range of the coordinates of the last page of the document.
+    Both are None if no text is found, except for a page shard, which still returns the range
+    """
+    frames = []
+    limit = None
+    for _, lines, limit in iter_pdf_pages(fp, pages):
+        if len(lines['text']) > 0:
+            frames.append(pd.DataFrame(lines, columns=['text', 'x1', 'y1', 'x2', 'y2', 'page']))
+    if len(frames) == 0:
+        # a shard without text still reports the page box, the rest of the document may have text
+        return None, (limit if pages is not None else None)
+    return pd.concat(frames, ignore_index=True), limit
+
+def merge_parsed(shards):
+    """
+    Merge the output of parse_pdf over page shards of a document
+    :param shards: list of (frame, limit) from parse_pdf, in page order
+    :return: Pandas frame and limit, as parse_pdf over the whole document would return them
+    """
+    limits = [limit for _, limit in shards if limit is not None]
+    frames = [df for df, _ in shards if df is not None]
+    if len(frames) == 0:
+        return None, None
+    return pd.concat(frames, ignore_index=True), limits[-1]
+
+def split_meta(meta):
+    """
+    Slice the parse_pdf frame by page, once per document
+    :param meta: Pandas frame returned by parse_pdf
+    :return: {page index: {column: array}} columnar metadata of each page, rows in document order
+    """
+    return {page: {'text': page_df['text'].tolist(),
+                   'x1': page_df['x1'].to_numpy(),
+                   'y1': page_df['y1'].to_numpy(),
+                   'x2': page_df['x2'].to_numpy(),
+                   'y2': page_df['y2'].to_numpy(),
+                   'page': page_df['page'].to_numpy()}
+            for page, page_df in meta.groupby('page', sort=False)}
+
+def scale_page_meta(pages_meta, page_num, scale_w, scale_h):
+    """
+    Metadata of a single page, with coordinates scaled to the page image
+    :param pages_meta: Output of split_meta
+    :param page_num: 1-indexed page number
+    :param scale_w: Horizontal scale factor
+    :param scale_h: Vertical scale factor
+    :return: {column: array} columnar metadata, empty columns if the page has no text
+    """
+    page_meta = pages_meta.get(page_num-1)
+    if page_meta is None:
+        return {'text': [], 'x1': np.zeros(0), 'y1': np.zeros(0), 'x2': np.zeros(0), 'y2': np.zeros(0), 'page': np.zeros(0, dtype=np.int64)}
+    return {'text': page_meta['text'],
+            'x1': page_meta['x1'] * scale_w,
+            'y1': page_meta['y1'] * scale_h,
+            'x2': page_meta['x2'] * scale_w,
+            'y2': page_meta['y2'] * scale_h,
+            'page': page_meta['page']}
@@ -0,0 +1,182 @@
+"""
+In-process PDF rasterization
+
+Pages are rendered straight to the resolution the pipeline works at, instead of printing every page at 600 dpi
+with Ghostscript, reading the PNGs back and downsampling them.
+"""
+import threading
+from collections import OrderedDict
+import pypdfium2 as pdfium
+from ingest.utils.preprocess import resize_png
+
+# pdfium is not thread safe, and dask workers may run several tasks in threads
+_pdfium_lock = threading.Lock()
+
+
+def render_page(pdf, page_idx, size=1920):
+    """
+    Render a single page so that its longest side is size pixels
+    :param pdf: pdfium PdfDocument
+    :param page_idx: 0-indexed page number
+    :param size: Target size of the longest side
+    :return: RGB PIL image
+    """
+    with _pdfium_lock:
+        page = pdf[page_idx]
+        try:
+            w, h = page.get_size()
+            img = page.render(scale=size / max(w, h)).to_pil().convert('RGB')
+        finally:
+            page.close()
+    # the renderer rounds the page size, which can leave the longest side a pixel off
+    if max(img.size) != size:
+        img = resize_png(img, size=size)
+    return img
+
+
+def count_pages(filename):
+    """
+    :param filename: Path to the PDF
+    :return: number of pages in the PDF
+    """
+    with _pdfium_lock:
+        pdf = pdfium.PdfDocument(filename)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+
+
+def page_sizes(filename, size=1920):
+    """
+    Size of every page once rendered, without rendering it
+    :param filename: Path to the PDF
+    :param size: Size of the longest side pages are rendered at
+    :return: list of (width, height) in pixels, in page order
+    """
+    with _pdfium_lock:
+        pdf = pdfium.PdfDocument(filename)
+        try:
+            sizes = [pdf.get_page_size(i) for i in range(len(pdf))]
+        finally:
+            pdf.close()
+    return [(round(w * size / max(w, h)), round(h * size / max(w, h))) for w, h in sizes]
+
+
+def page_ranges(npages, pages_per_shard):
+    """
+    Split a document into contiguous shards of 1-indexed page numbers
+    :param npages: Number of pages in the document
+    :param pages_per_shard: Maximum number of pages in a shard, None or 0 for a single shard
+    :return: list of ranges, in page order
+    """
+    if not pages_per_shard:
+        pages_per_shard = max(npages, 1)
+    return [range(start, min(start + pages_per_shard, npages + 1)) for start in range(1, npages + 1, pages_per_shard)]
+
+
+class PageStore:
+    """
+    Rendered pages of a single PDF, keyed by 1-indexed page number.
+    Pages are rendered on first access and a bounded number of them are kept in memory.
+    """
+
+    def __init__(self, filename, size=1920, max_cached=8):
+        """
+        :param filename: Path to the PDF
+        :param size: Target size of the longest side of each page image
+        :param max_cached: Maximum number of rendered pages kept in memory
+        """
+        self.filename = filename
+        self.size = size
+        self.max_cached = max_cached
+        with _pdfium_lock:
+            self.pdf = pdfium.PdfDocument(filename)
+            self.npages = len(self.pdf)
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return self.npages
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """
+        Release the document and any cached pages
+        """
+        self._cache.clear()
+        if self.pdf is not None:
+            with _pdfium_lock:
+                self.pdf.close()
+            self.pdf = None
+
+    def page_nums(self):
+        """
+        :return: 1-indexed page numbers of the document
+        """
+        return list(range(1, self.npages + 1))
+
+    def get(self, page_num):
+        """
+        :param page_num: 1-indexed page number
+        :return: RGB PIL image of the page
+        """
+        if page_num in self._cache:
+            self._cache.move_to_end(page_num)
+            return self._cache[page_num]
+        if page_num < 1 or page_num > self.npages:
+            raise IndexError(f'{self.filename} has no page {page_num}')
+        img = render_page(self.pdf, page_num - 1, self.size)
+        self._cache[page_num] = img
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+        return img
+
+    def __iter__(self):
+        """
+        :return: generator of (page_num, image) in page order
+        """
+        return self.iter_pages()
+
+    def iter_pages(self, page_nums=None):
+        """
+        :param page_nums: 1-indexed page numbers to render, every page if None
+        :return: generator of (page_num, image) in the order of page_nums
+        """
+        if page_nums is None:
+            page_nums = self.page_nums()
+        for page_num in page_nums:
+            yield page_num, self.get(page_num)
+
+    def save_pages(self, out_dir, prefix, page_nums=None):
+        """
+        Write pages to out_dir as {prefix}_{page_num}, PNG encoded
+        :param out_dir: Output directory
+        :param prefix: File name prefix, usually the pdf name
+        :param page_nums: 1-indexed page numbers to write, every page if None
+        :return: list of written paths, in page order
+        """
+        paths = []
+        for page_num, img in self.iter_pages(page_nums):
+            path = f'{out_dir}/{prefix}_{page_num}'
+            img.save(path, format='PNG', compress_level=1)
+            paths.append(path)
+        return paths
+
+
+def save_page_range(filename, out_dir, prefix, page_nums, size=1920):
+    """
+    Render a shard of a document to out_dir. Opens its own document so shards can run in separate processes
+    :param filename: Path to the PDF
+    :param out_dir: Output directory
+    :param prefix: File name prefix, usually the pdf name
+    :param page_nums: 1-indexed page numbers to write
+    :param size: Target size of the longest side of each page image
+    :return: list of written paths, in page order
+    """
+    with PageStore(filename, size=size, max_cached=1) as store:
+        return store.save_pages(out_dir, prefix, page_nums)
@@ -0,0 +1,158 @@
+"""
+Content addressed cache of per-page pipeline outputs
+
+Entries are keyed by the sha1 of the PDF together with the versions of the detection and postprocess models and
+the pipeline configuration, so the same PDF showing up in another dataset reuses its detection and postprocess
+outputs. Each entry is a directory holding one pickle per page. Entries are evicted least recently used first
+once the cache grows past its size limit.
+"""
+import os
+import json
+import pickle
+import shutil
+import hashlib
+import logging
+from collections import OrderedDict
+logger = logging.getLogger(__name__)
+
+# Bump when the page outputs change for the same inputs, e.g. a change to rendering or proposals
+CACHE_VERSION = 1
+
+# Page fields produced by detection and postprocessing, the rest of the page comes from rendering and parsing
+CACHED_FIELDS = ['detected_objs', 'softmax_objs', 'content', 'xgboost_content', 'rules_content']
+
+
+def file_sha1(path, block_size=1 << 20):
+    """
+    :param path: Path to a file
+    :return: hex sha1 of the file contents, read in blocks
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as rf:
+        while True:
+            buffer = rf.read(block_size)
+            if not buffer:
+                break
+            digest.update(buffer)
+    return digest.hexdigest()
+
+
+def files_version(*paths):
+    """
+    Version of a model, given the files it is loaded from
+    :param paths: Paths to weights and config files, None and missing paths are skipped
+    :return: hex sha1 over the sha1 of every file, None if no file exists
+    """
+    hashes = [file_sha1(path) for path in paths if path is not None and os.path.isfile(path)]
+    if len(hashes) == 0:
+        return None
+    return hashlib.sha1(''.join(hashes).encode()).hexdigest()
+
+
+def cache_key(pdf_sha1, detect_version, postprocess_version, config):
+    """
+    :param pdf_sha1: sha1 of the PDF
+    :param detect_version: Version of the detection model, see files_version
+    :param postprocess_version: Version of the postprocess model, None if postprocessing is off
+    :param config: JSON serializable dict of the pipeline options that change page outputs
+    :return: hex key of the cache entry
+    """
+    payload = json.dumps([CACHE_VERSION, pdf_sha1, detect_version, postprocess_version, config], sort_keys=True)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def _dir_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+class ResultCache:
+    """
+    On disk LRU cache of per-page outputs. Writes are atomic renames, so several processes can share a cache,
+    each of them only enforces the size limit over the entries it knows of.
+    """
+
+    def __init__(self, directory, max_bytes=None):
+        """
+        :param directory: Cache directory, created if needed
+        :param max_bytes: Size limit of the cache, None for no limit
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        # entry key -> size in bytes, least recently used first
+        self.entries = OrderedDict()
+        found = []
+        for shard in os.scandir(directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.is_dir():
+                    found.append((entry.stat().st_mtime, entry.name, _dir_size(entry.path)))
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+        self.size = sum(self.entries.values())
+
+    def _entry_dir(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _touch(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        try:
+            os.utime(self._entry_dir(key))
+        except FileNotFoundError:
+            pass
+
+    def get(self, key, page_num):
+        """
+        :param key: Entry key, see cache_key
+        :param page_num: 1-indexed page number
+        :return: dict of the cached fields of the page, None on a miss
+        """
+        path = os.path.join(self._entry_dir(key), f'{page_num}.pkl')
+        try:
+            with open(path, 'rb') as rf:
+                fields = pickle.load(rf)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        self._touch(key)
+        return fields
+
+    def put(self, key, page_num, fields):
+        """
+        Store the outputs of a page, then evict old entries if the cache is over its size limit
+        :param key: Entry key, see cache_key
+        :param page_num: 1-indexed page number
+        :param fields: dict of page fields, only CACHED_FIELDS are kept
+        """
+        fields = {name: fields[name] for name in CACHED_FIELDS if name in fields}
+        entry_dir = self._entry_dir(key)
+        os.makedirs(entry_dir, exist_ok=True)
+        path = os.path.join(entry_dir, f'{page_num}.pkl')
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as wf:
+            pickle.dump(fields, wf)
+        size = os.path.getsize(tmp_path)
+        if os.path.exists(path):
+            size -= os.path.getsize(path)
+        os.replace(tmp_path, path)
+        self.entries[key] = self.entries.get(key, 0) + size
+        self.size += size
+        self._touch(key)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the cache is within its size limit
+        :param keep: Key of an entry that is never evicted, usually the one being written
+        """
+        if self.max_bytes is None:
+            return
+        for key in list(self.entries):
+            if self.size <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self.size -= self.entries.pop(key)
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            logger.debug(f'Evicted cache entry {key}')
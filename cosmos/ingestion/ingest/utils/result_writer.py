@@ -0,0 +1,143 @@
+"""
+Incremental parquet output
+
+Result rows are appended to the output parquet one row group at a time, so the full corpus never has to be
+held in memory. The object level output has a fixed schema, aggregation output takes its schema from the
+first non empty batch.
+"""
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from ingest.utils.normalize_text import normalize_text
+
+ROW_SCHEMA = pa.schema([
+    ('pdf_name', pa.string()),
+    ('dataset_id', pa.string()),
+    ('page_num', pa.int64()),
+    ('img_pth', pa.string()),
+    ('pdf_dims', pa.list_(pa.float64())),
+    ('bounding_box', pa.list_(pa.float64())),
+    ('classes', pa.list_(pa.string())),
+    ('scores', pa.list_(pa.float64())),
+    ('content', pa.string()),
+    ('postprocess_cls', pa.string()),
+    ('postprocess_score', pa.float64()),
+])
+
+RESULT_SCHEMA = ROW_SCHEMA.append(pa.field('detect_cls', pa.string())).append(pa.field('detect_score', pa.float64()))
+
+
+def page_rows(obj, use_text_normalization=False):
+    """
+    Flatten the objects of a finished page into result rows
+    :param obj: Page dict, after pool_text and optionally the postprocess stages
+    :param use_text_normalization: Whether to normalize the text of each object
+    :return: list of result dicts, one per page object
+    """
+    results = []
+    for ind, c in enumerate(obj['content']):
+        bb, cls, text = c
+        if use_text_normalization:
+            text = normalize_text(text)
+        scores, classes = zip(*cls)
+        scores = list(scores)
+        classes = list(classes)
+        postprocess_cls = postprocess_score = None
+        if 'xgboost_content' in obj:
+            _, postprocess_cls, _, postprocess_score = obj['xgboost_content'][ind]
+            if 'rules_content' in obj:
+                _, postprocess_cls, _, postprocess_score = obj['rules_content'][ind]
+        final_obj = {'pdf_name': obj['pdf_name'],
+                     'dataset_id': obj['dataset_id'],
+                     'page_num': obj['page_num'],
+                     'img_pth': obj['pad_img'],
+                     'pdf_dims': list(obj['pdf_limit']),
+                     'bounding_box': list(bb),
+                     'classes': classes,
+                     'scores': scores,
+                     'content': text,
+                     'postprocess_cls': postprocess_cls,
+                     'postprocess_score': postprocess_score
+                    }
+        results.append(final_obj)
+    return results
+
+
+def rows_to_table(rows):
+    """
+    Build an Arrow table with RESULT_SCHEMA from result rows. detect_cls and detect_score are the top ranked
+    class and score of each object, taken from the list columns without touching the rows again
+    :param rows: list of result dicts, see page_rows
+    :return: pyarrow Table
+    """
+    columns = {name: [row[name] for row in rows] for name in ROW_SCHEMA.names}
+    table = pa.Table.from_pydict(columns, schema=ROW_SCHEMA)
+    table = table.append_column(RESULT_SCHEMA.field('detect_cls'), pc.list_element(table['classes'], 0))
+    return table.append_column(RESULT_SCHEMA.field('detect_score'), pc.list_element(table['scores'], 0))
+
+
+def _fill_null_types(schema):
+    """
+    Columns that were all None in the first batch have no type yet, store them as strings
+    """
+    return pa.schema([field.with_type(pa.string()) if pa.types.is_null(field.type) else field for field in schema])
+
+
+class ParquetAppender:
+    """
+    Append tables to a single parquet file, one row group per call.
+    The file is only created once there is something to write.
+    """
+
+    def __init__(self, path, schema=None, compression='gzip'):
+        """
+        :param path: Output parquet path
+        :param schema: Fixed Arrow schema, or None to take it from the first non empty table
+        :param compression: Parquet compression codec
+        """
+        self.path = path
+        self.schema = schema
+        self.compression = compression
+        self.writer = None
+        self.num_rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write_table(self, table):
+        """
+        :param table: pyarrow Table, cast to the schema of the file
+        """
+        if table.num_rows == 0:
+            return
+        if self.writer is None:
+            if self.schema is None:
+                self.schema = _fill_null_types(table.schema.remove_metadata())
+            self.writer = pq.ParquetWriter(self.path, self.schema, compression=self.compression)
+        table = table.select(self.schema.names).cast(self.schema)
+        self.writer.write_table(table)
+        self.num_rows += table.num_rows
+
+    def write_frame(self, df):
+        """
+        :param df: Pandas frame, its index is dropped
+        """
+        if df is None or len(df) == 0:
+            return
+        self.write_table(pa.Table.from_pandas(df, preserve_index=False))
+
+    def write_rows(self, rows):
+        """
+        :param rows: list of result dicts, see page_rows
+        """
+        if len(rows) == 0:
+            return
+        self.write_table(rows_to_table(rows))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
@@ -0,0 +1,56 @@
+"""
+Tests for the vectorized box overlap helpers
+"""
+
+import random
+import pytest
+from ingest.utils.box_overlap import pairwise_iou, neighbor_index
+from ingest.process.detection.src.evaluate.evaluate import calculate_iou
+from ingest.process.postprocess.xgboost_model.featurizer import compute_page_neighbors, load_data_objs
+
+CLASSES = ['Body Text', 'Figure', 'Table']
+
+
+def random_boxes(seed, n=60):
+    rnd = random.Random(seed)
+    boxes = []
+    for _ in range(n):
+        x = rnd.randint(0, 1800)
+        y = rnd.randint(0, 1800)
+        boxes.append([x, y, x + rnd.randint(1, 300), y + rnd.randint(1, 200)])
+    return boxes
+
+
+def reference_neighbors(boxes, expansion_delta=50, orig_size=1920):
+    nbhds = []
+    for i, bb in enumerate(boxes):
+        nbhd_bbox = [max(0, bb[0]-expansion_delta), max(0, bb[1]-expansion_delta), min(orig_size, bb[2]+expansion_delta), min(orig_size, bb[3]+expansion_delta)]
+        nbhds.append([j for j, target in enumerate(boxes) if j != i and calculate_iou(nbhd_bbox, target) > 0])
+    return nbhds
+
+
+def test_pairwise_iou_matches_calculate_iou():
+    boxes = random_boxes(0, 40) + [[10, 10, 20, 20], [20, 10, 30, 20]]
+    ious = pairwise_iou(boxes, boxes)
+    for i, b1 in enumerate(boxes):
+        for j, b2 in enumerate(boxes):
+            assert ious[i, j] == calculate_iou(b1, b2)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_neighbor_index_matches_loops(seed):
+    boxes = random_boxes(seed)
+    indptr, indices = neighbor_index(boxes, 50)
+    nbhds = [indices[indptr[i]:indptr[i+1]].tolist() for i in range(len(boxes))]
+    assert nbhds == reference_neighbors(boxes)
+
+
+def test_page_neighbors_skip_duplicates():
+    boxes = random_boxes(4, 30)
+    predict_list = [(bb, [(0.9, CLASSES[i % 3])], 'text') for i, bb in enumerate(boxes)]
+    predict_list.append(predict_list[0])
+    page_nbhds = compute_page_neighbors(predict_list)
+    for predict, nbhds in zip(predict_list, page_nbhds):
+        assert predict not in [cand for cand, _ in nbhds]
+    features = load_data_objs(predict_list, CLASSES)
+    assert features.shape[0] == len(predict_list)
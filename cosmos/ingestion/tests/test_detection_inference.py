@@ -0,0 +1,113 @@
+"""
+Tests for batched detection inference
+"""
+
+import os
+import random
+import pytest
+import torch
+from PIL import Image, ImageDraw
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from ingest.process.detection.src.infer import run_inference
+from ingest.process.detection.src.torch_model.model.model import MMFasterRCNN
+from ingest.process.detection.src.torch_model.model.utils.config_manager import ConfigManager
+from ingest.process.detection.src.torch_model.model.layers.featurization import segmented_batch_norm
+from ingest.process.detection.src.torch_model.train.data_layer.sql_types import Base
+from ingest.process.detection.src.torch_model.train.data_layer.xml_loader import XMLLoader
+from ingest.process.detection.src.torch_model.inference.data_layer.inference_loader import InferenceLoader
+from ingest.process.detection.src.utils.ingest_images import ImageDB, get_example_for_uuid
+
+MODEL_CONFIG = os.path.join(os.path.dirname(__file__), 'configs', 'test_model_config.yaml')
+
+
+def make_page(page_id, seed):
+    rnd = random.Random(seed)
+    img = Image.new('RGB', (1920, 1920), 'white')
+    draw = ImageDraw.Draw(img)
+    proposals = []
+    for _ in range(rnd.randint(3, 8)):
+        x = rnd.randint(0, 1600)
+        y = rnd.randint(0, 1600)
+        box = [x, y, x + rnd.randint(30, 300), y + rnd.randint(20, 300)]
+        draw.rectangle(box, fill=(rnd.randint(0, 255), rnd.randint(0, 255), 0))
+        proposals.append(box)
+    return {'id': page_id, 'img': img, 'proposals': proposals}
+
+
+@pytest.fixture(scope='module')
+def model():
+    torch.manual_seed(0)
+    model = MMFasterRCNN(ConfigManager(MODEL_CONFIG))
+    model.eval()
+    return model
+
+
+@pytest.fixture(scope='module')
+def pages():
+    return [make_page(str(i), i) for i in range(3)]
+
+
+def infer(model, pages, batch_size, cache_features=False):
+    with torch.no_grad():
+        return run_inference(model, pages, MODEL_CONFIG, 'cpu', batch_size=batch_size, cache_features=cache_features)
+
+
+def assert_same_predictions(expected, actual):
+    assert expected.keys() == actual.keys()
+    for page_id in expected:
+        assert len(expected[page_id]) == len(actual[page_id])
+        for (bb1, preds1), (bb2, preds2) in zip(expected[page_id], actual[page_id]):
+            assert bb1 == bb2
+            assert [cls for _, cls in preds1] == [cls for _, cls in preds2]
+            assert [score for score, _ in preds1] == pytest.approx([score for score, _ in preds2], abs=1e-4)
+
+
+def test_segmented_batch_norm_matches_per_group():
+    torch.manual_seed(0)
+    bn = torch.nn.BatchNorm2d(8)
+    x = torch.randn(5, 8, 6, 6) * 3 + 1
+    segments = torch.tensor([0, 1, 1, 2, 2])
+    with torch.no_grad():
+        expected = torch.cat([bn(x[:1]), bn(x[1:3]), bn(x[3:])])
+        with segmented_batch_norm(bn, segments):
+            actual = bn(x)
+        restored = bn(x)
+    assert torch.allclose(expected, actual, atol=1e-5)
+    assert not torch.allclose(restored, actual, atol=1e-3)
+
+
+def test_batched_inference_matches_per_object(model, pages):
+    per_object, softmax_per_object = infer(model, pages, 1)
+    batched, softmax_batched = infer(model, pages, 5)
+    assert_same_predictions(per_object, batched)
+    assert_same_predictions(softmax_per_object, softmax_batched)
+
+
+def test_cached_features_match_per_object(model, pages):
+    per_object, softmax_per_object = infer(model, pages, 1)
+    cached, softmax_cached = infer(model, pages, 3, cache_features=True)
+    assert_same_predictions(per_object, cached)
+    assert_same_predictions(softmax_per_object, softmax_cached)
+
+
+def test_array_loader_matches_db_loader(pages):
+    cfg = ConfigManager(MODEL_CONFIG)
+    engine = create_engine('sqlite:///:memory:', echo=False)
+    Session = sessionmaker(bind=engine)
+    Base.metadata.create_all(engine)
+    session = Session()
+    ingest_objs = ImageDB.initialize_and_ingest(pages, cfg.WARPED_SIZE, 'test', cfg.EXPANSION_DELTA, session)
+    db_loader = XMLLoader(ingest_objs, cfg.CLASSES, session)
+    loader = InferenceLoader(pages, cfg.WARPED_SIZE, cfg.EXPANSION_DELTA, cfg.CLASSES)
+    assert len(loader) == len(db_loader)
+    for idx in range(len(loader)):
+        expected = XMLLoader.collate([db_loader[idx]])
+        actual, refs, neighbor_mask = InferenceLoader.collate([loader[idx]])
+        assert refs[0].page_id == get_example_for_uuid(ingest_objs.uuids[idx], session).page_id
+        assert neighbor_mask.all()
+        for field in expected._fields:
+            if field == 'labels':
+                continue
+            assert torch.equal(getattr(expected, field), getattr(actual, field)), field
+    session.close()
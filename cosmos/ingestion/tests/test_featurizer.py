@@ -0,0 +1,59 @@
+"""
+Tests for the columnar postprocess featurizer
+"""
+
+import random
+import numpy as np
+import pytest
+from ingest.process.postprocess.xgboost_model.featurizer import load_data_objs, get_feat_vec, get_feat_vec_train, \
+    compute_page_neighbors, page_features, train_columns
+
+CLASSES = ['Section Header', 'Body Text', 'Figure', 'Figure Caption', 'Table', 'Table Caption', 'Other']
+TEXTS = ['Figure 1. Results', 'fig. 2a shows', 'Table 3', 'tbl 4 continued', 'Some body text',
+         'first line\nTable 5 on a later line', 'no caption']
+
+
+def random_page(seed, n):
+    rnd = random.Random(seed)
+    predict_list = []
+    for _ in range(n):
+        x, y = rnd.randint(0, 1700), rnd.randint(0, 1700)
+        bb = [x, y, x + rnd.randint(1, 300), y + rnd.randint(1, 200)]
+        scores = [rnd.random() for _ in CLASSES]
+        cls_scores = sorted(zip(scores, CLASSES), reverse=True)
+        predict_list.append((bb, cls_scores, rnd.choice(TEXTS)))
+    return predict_list
+
+
+def reference_features(predict_list, classes):
+    page_nbhds = compute_page_neighbors(predict_list)
+    return np.asarray([get_feat_vec(predict, predict_list, classes, nbhds)
+                       for predict, nbhds in zip(predict_list, page_nbhds)])
+
+
+@pytest.mark.parametrize('seed,n', [(0, 1), (1, 10), (2, 80), (3, 200)])
+def test_matches_row_featurizer(seed, n):
+    predict_list = random_page(seed, n)
+    features = load_data_objs(predict_list, CLASSES)
+    np.testing.assert_array_equal(features, reference_features(predict_list, CLASSES))
+
+
+def test_duplicate_predictions():
+    predict_list = random_page(4, 30)
+    predict_list += predict_list[:5]
+    features = load_data_objs(predict_list, CLASSES)
+    np.testing.assert_array_equal(features, reference_features(predict_list, CLASSES))
+
+
+def test_train_features():
+    predict_list = []
+    for bb, cls_scores, text in random_page(5, 12):
+        # process_html gives class scores in class order as a string, the score as a string and bytes of text
+        scores = [score for score, _ in sorted(cls_scores, key=lambda ele: CLASSES.index(ele[1]))]
+        predict_list.append((bb, str(scores), str(cls_scores[0][0]), cls_scores[0][1], text.lower().encode('utf-8')))
+    features = page_features(*train_columns(predict_list, CLASSES))
+    page_nbhds = compute_page_neighbors(predict_list)
+    expected = [get_feat_vec_train(predict, predict_list, CLASSES, nbhds)
+                for predict, nbhds in zip(predict_list, page_nbhds)]
+    assert all(len(nbhds) <= 15 for nbhds in page_nbhds)
+    np.testing.assert_array_equal(features, np.asarray(expected, dtype=np.float64))
@@ -0,0 +1,103 @@
+"""
+Tests for grouping table and figure fragments, against the pairwise implementation group_cls replaced
+"""
+
+import random
+import pytest
+from ingest.process.ocr.group_cls import group_cls, calculate_iou, check_overlap
+
+MERGE_OVER = ['Figure', 'Section Header', 'Page Footer', 'Page Header']
+CLASSES = ['Table', 'Figure', 'Body Text', 'Section Header', 'Table Caption']
+
+
+def reference_group_cls(obj_list, g_cls, do_table_merge=False, merge_over_classes=None):
+    nbhds = []
+    for coords, cls_list in obj_list:
+        if cls_list[0][1] == g_cls:
+            if len(nbhds) == 0:
+                nbhds.append((coords, cls_list))
+                continue
+            new_nbhd_list = []
+            added = False
+            for nbhd_bb, cls_list2 in nbhds:
+                new_box = [min(nbhd_bb[0], coords[0]), min(nbhd_bb[1], coords[1]), max(nbhd_bb[2], coords[2]), max(nbhd_bb[3], coords[3])]
+                ccls = [g_cls] + (merge_over_classes or [])
+                if check_overlap(obj_list, new_box, check_cls=ccls):
+                    new_nbhd_list.append((new_box, cls_list2 if cls_list2[0][0] >= cls_list[0][0] and cls_list2[0][1] == g_cls else cls_list))
+                    added = True
+                else:
+                    new_nbhd_list.append((nbhd_bb, cls_list2))
+            if not added:
+                new_nbhd_list.append((coords, cls_list))
+            nbhds = new_nbhd_list
+    if do_table_merge:
+        while True:
+            new_nbhds = []
+            merged_nbhds = []
+            for nbhd, cls_list in nbhds:
+                for nbhd2, cls_list2 in nbhds:
+                    if nbhd2 == nbhd:
+                        continue
+                    if calculate_iou(nbhd, nbhd2) > 0:
+                        new_box = [min(nbhd[0], nbhd2[0]), min(nbhd[1], nbhd2[1]), max(nbhd[2], nbhd2[2]), max(nbhd[3], nbhd2[3])]
+                        merged_nbhds.append(nbhd)
+                        merged_nbhds.append(nbhd2)
+                        new_nbhds.append((new_box, cls_list2 if cls_list2[0][0] >= cls_list[0][0] else cls_list))
+            for nbhd, cls_list in nbhds:
+                if nbhd not in merged_nbhds:
+                    new_nbhds.append((nbhd, cls_list))
+            if new_nbhds == nbhds:
+                break
+            nbhds = new_nbhds
+    filter_objs = [obj for nbhd, _ in nbhds for obj in obj_list if calculate_iou(obj[0], nbhd) > 0]
+    new_obj_list = [o for o in obj_list if o not in filter_objs and o[1][0][1] != g_cls]
+    return new_obj_list + nbhds
+
+
+def random_page(seed, n, table_fraction=0.4):
+    rnd = random.Random(seed)
+    objs = []
+    for _ in range(n):
+        x, y = rnd.randint(0, 1700), rnd.randint(0, 1700)
+        bb = [x, y, x + rnd.randint(5, 250), y + rnd.randint(5, 150)]
+        cls = 'Table' if rnd.random() < table_fraction else rnd.choice(CLASSES[1:])
+        objs.append((bb, [(round(rnd.random(), 2), cls), (0.01, 'Other')]))
+    return objs
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_matches_reference(seed):
+    objs = random_page(seed, 40)
+    assert group_cls(objs, 'Figure') == reference_group_cls(objs, 'Figure')
+    assert group_cls(objs, 'Table', merge_over_classes=MERGE_OVER) == \
+        reference_group_cls(objs, 'Table', merge_over_classes=MERGE_OVER)
+
+
+# the pairwise merge copies merged tables in every round, on pages 8, 13 and 21 it does not finish in reasonable time
+@pytest.mark.parametrize('seed', [seed for seed in range(24) if seed not in (8, 13, 21)])
+def test_table_merge_matches_reference(seed):
+    objs = random_page(seed, 20, table_fraction=0.5)
+    merged = group_cls(objs, 'Table', do_table_merge=True, merge_over_classes=MERGE_OVER)
+    expected = reference_group_cls(objs, 'Table', do_table_merge=True, merge_over_classes=MERGE_OVER)
+    assert [o for o in merged if o[1][0][1] != 'Table'] == [o for o in expected if o[1][0][1] != 'Table']
+    # the pairwise merge could leave several copies of a merged table, each copy is kept once
+    tables = [(bb, cls) for bb, cls in merged if cls[0][1] == 'Table']
+    assert sorted(bb for bb, _ in tables) == sorted({tuple(bb): bb for bb, cls in expected if cls[0][1] == 'Table'}.values())
+    for bb, cls in tables:
+        assert cls[0][0] == max(c[0][0] for b, c in expected if b == bb)
+
+
+def test_fragments_merge_into_one_table():
+    fragments = [([i * 50, 0, i * 50 + 60, 100], [(0.5 + i / 100, 'Table')]) for i in range(30)]
+    blocker = ([0, 40, 200, 60], [(0.9, 'Body Text')])
+    merged = group_cls(fragments + [blocker], 'Table', do_table_merge=True)
+    assert merged == [([0, 0, 29 * 50 + 60, 100], [(0.79, 'Table')])]
+
+
+def test_many_overlapping_tables():
+    objs = random_page(8, 400, table_fraction=0.5)
+    merged = group_cls(objs, 'Table', do_table_merge=True, merge_over_classes=MERGE_OVER)
+    tables = [bb for bb, cls in merged if cls[0][1] == 'Table']
+    assert len(tables) > 0
+    for i, bb in enumerate(tables):
+        assert all(calculate_iou(bb, other) == 0 for other in tables[i + 1:])
@@ -0,0 +1,80 @@
+"""
+Tests for per-stage metrics records
+"""
+
+import os
+import pytest
+import pandas as pd
+from ingest.utils import metrics
+from ingest.utils.pdf_extractor import iter_pdf_pages
+from ingest.ingest import Ingest
+
+PDF = os.path.join(os.path.dirname(__file__), '../../../cosmos_service/test/resources/pdfs/bucky.pdf')
+
+
+@pytest.fixture
+def metrics_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv(metrics.METRICS_DIR_ENV, str(tmp_path / 'metrics'))
+    metrics.reset()
+    yield str(tmp_path / 'metrics')
+    monkeypatch.delenv(metrics.METRICS_DIR_ENV)
+    metrics.reset()
+    metrics._context.clear()
+
+
+def test_disabled_stage_writes_nothing(tmp_path, monkeypatch):
+    monkeypatch.delenv(metrics.METRICS_DIR_ENV, raising=False)
+    metrics.reset()
+    with metrics.stage('detect', page_num=1) as record:
+        record['objects'] = 3
+    assert not metrics.enabled()
+    assert 'wall_s' not in record
+
+
+def test_stage_records(metrics_dir):
+    metrics.set_context(job_id='job')
+    with metrics.stage('regroup', pdf_name='a.pdf', page_num=2) as record:
+        record['objects'] = 3
+    with pytest.raises(ValueError):
+        with metrics.stage('pool_text', pdf_name='a.pdf', page_num=2):
+            raise ValueError()
+    df = metrics.read_metrics(metrics_dir)
+    assert df['stage'].tolist() == ['regroup', 'pool_text']
+    assert df['status'].tolist() == ['ok', 'error']
+    assert (df['job_id'] == 'job').all()
+    assert df.loc[0, 'objects'] == 3
+    assert (df['wall_s'] >= 0).all() and (df['cpu_s'] >= 0).all() and (df['process_peak_rss_bytes'] > 0).all()
+    assert (df['rss_start_bytes'] > 0).all() and (df['rss_end_bytes'] > 0).all()
+
+
+def test_stage_rss_follows_the_stage(metrics_dir):
+    with metrics.stage('allocate'):
+        block = bytearray(256 * 2**20)
+        block[::4096] = b'x' * len(block[::4096])
+    del block
+    with metrics.stage('idle'):
+        pass
+    df = metrics.read_metrics(metrics_dir).set_index('stage')
+    # the stage that allocated grew the process, the one after it does not report the earlier peak as its own
+    assert df.loc['allocate', 'rss_end_bytes'] - df.loc['allocate', 'rss_start_bytes'] > 200 * 2**20
+    assert df.loc['idle', 'rss_end_bytes'] < df.loc['allocate', 'rss_end_bytes'] - 200 * 2**20
+
+
+def test_timed_iter_records_each_item(metrics_dir):
+    pages = list(metrics.timed_iter('parse_pdf', iter_pdf_pages(PDF), {'pdf_name': 'bucky.pdf'},
+                                    item_labels=lambda item: {'page_num': item[0] + 1}))
+    df = metrics.read_metrics(metrics_dir)
+    assert len(df) == len(pages) > 0
+    assert df['page_num'].tolist() == [idx + 1 for idx, _, _ in pages]
+
+
+def test_pdf_to_images_records_stages(metrics_dir, tmp_path):
+    objs = Ingest.pdf_to_images('na', str(tmp_path), PDF, pages=[1, 2], persist=False)
+    df = metrics.read_metrics(metrics_dir)
+    counts = df['stage'].value_counts()
+    assert counts['render'] == counts['parse_pdf'] == counts['get_proposals'] == len(objs) == 2
+    assert counts['pdf_to_images'] == 1
+    proposals = df[df['stage'] == 'get_proposals'].sort_values('page_num')
+    assert proposals['objects'].tolist() == [len(obj['proposals']) for obj in objs]
+    out = metrics.metrics_to_parquet(metrics_dir, str(tmp_path / 'metrics.parquet'))
+    assert len(pd.read_parquet(tmp_path / 'metrics.parquet')) == len(out)
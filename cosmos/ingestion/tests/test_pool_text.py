@@ -0,0 +1,44 @@
+"""
+Tests for pooling pdf text into detected objects
+"""
+
+import json
+import pandas as pd
+from ingest.process.ocr.ocr import _pool_text_meta
+from ingest.utils.pdf_extractor import split_meta, scale_page_meta
+
+
+def test_pool_text_meta_page_and_order():
+    # pdf coordinates, origin at the bottom left of a 1000 high page
+    meta = {'x1': [100, 10, 10, 10, 500],
+            'y1': [880, 880, 850, 880, 100],
+            'x2': [200, 90, 90, 90, 600],
+            'y2': [900, 900, 870, 900, 120],
+            'text': ['world', 'hello', 'again', 'other page', 'far away'],
+            'page': [0, 0, 0, 1, 0]}
+    detect_objs = [([0, 95, 250, 160], [(0.9, 'Body Text')]),
+                   ([700, 700, 800, 800], [(0.8, 'Figure')])]
+    pooled = _pool_text_meta(meta, 1000, detect_objs, 1)
+    assert pooled == [((0, 95, 250, 160), [(0.9, 'Body Text')], 'hello world again'),
+                      ((700, 700, 800, 800), [(0.8, 'Figure')], '')]
+
+
+def test_page_meta_pools_like_document_meta():
+    meta = pd.DataFrame({'text': [f'line {i}' for i in range(12)],
+                         'x1': [10.5 * i for i in range(12)],
+                         'y1': [700.25 - 40 * i for i in range(12)],
+                         'x2': [10.5 * i + 300 for i in range(12)],
+                         'y2': [712.75 - 40 * i for i in range(12)],
+                         'page': [0, 1, 2] * 4})
+    pages_meta = split_meta(meta)
+    detect_objs = [([0, 0, 1000, 1000], [(0.9, 'Body Text')]), ([0, 300, 400, 500], [(0.5, 'Figure')])]
+    for page_num in [1, 2, 3, 4]:
+        # the whole document meta, scaled on this page only, as pages used to carry it
+        doc_meta = meta.copy()
+        on_page = doc_meta.page == page_num - 1
+        doc_meta.loc[on_page, ['x1', 'x2']] = doc_meta.loc[on_page, ['x1', 'x2']] * 1.5
+        doc_meta.loc[on_page, ['y1', 'y2']] = doc_meta.loc[on_page, ['y1', 'y2']] * 2.0
+        doc_meta = json.loads(json.dumps(doc_meta.to_dict()))
+        page_meta = scale_page_meta(pages_meta, page_num, 1.5, 2.0)
+        assert len(page_meta['text']) == int(on_page.sum())
+        assert _pool_text_meta(page_meta, 1600, detect_objs, page_num) == _pool_text_meta(doc_meta, 1600, detect_objs, page_num)
@@ -0,0 +1,64 @@
+"""
+Tests for batched XGBoost postprocessing
+"""
+
+import os
+import yaml
+import numpy as np
+import pytest
+from xgboost import XGBClassifier
+from ingest.process.postprocess.xgboost_model.featurizer import load_data_objs
+from ingest.process.postprocess.xgboost_model.inference import run_inference, run_inference_batch
+from ingest.process_page import _postprocess_contents, batch_page
+
+with open(os.path.join(os.path.dirname(__file__), 'configs/test_model_config.yaml')) as rf:
+    CLASSES = yaml.load(rf, yaml.Loader)['CLASSES']
+
+
+def random_page(rng, nobjs):
+    objs = []
+    for _ in range(nobjs):
+        x, y = rng.integers(0, 1700, size=2)
+        w, h = rng.integers(10, 200, size=2)
+        scores = rng.dirichlet(np.ones(len(CLASSES)))
+        cls_scores = sorted(zip(scores.tolist(), CLASSES), reverse=True)
+        text = rng.choice(['Figure 1. A caption', 'Table 2 results', 'body text'])
+        objs.append(([int(x), int(y), int(x + w), int(y + h)], cls_scores, text))
+    return objs
+
+
+@pytest.fixture
+def model():
+    rng = np.random.default_rng(0)
+    features = load_data_objs(random_page(rng, 200), CLASSES)
+    model = XGBClassifier(n_estimators=5, max_depth=3)
+    model.fit(features, np.arange(len(features)) % len(CLASSES))
+    return model
+
+
+def test_batch_matches_single_pages(model):
+    rng = np.random.default_rng(1)
+    pages = [random_page(rng, n) for n in [12, 1, 0, 30]]
+    batch = run_inference_batch(model, CLASSES, pages)
+    assert len(batch) == len(pages)
+    for page, result in zip(pages, batch):
+        single = run_inference(model, CLASSES, page)
+        assert len(result) == len(single)
+        for (bb, cls, text, score), (s_bb, s_cls, s_text, s_score) in zip(result, single):
+            assert (bb, cls, text) == (s_bb, s_cls, s_text)
+            assert score == pytest.approx(s_score)
+    assert batch[2] == ''
+    assert run_inference_batch(model, CLASSES, [[], []]) == ['', '']
+
+
+def test_failing_page_does_not_fail_batch(model):
+    rng = np.random.default_rng(2)
+    pages = {0: random_page(rng, 5), 1: [('not a box', 'no scores', 'text')], 2: random_page(rng, 3)}
+    results = _postprocess_contents(model, CLASSES, pages)
+    assert sorted(results) == [0, 1, 2]
+    assert isinstance(results[1], Exception)
+    for i in (0, 2):
+        assert results[i] == run_inference_batch(model, CLASSES, [pages[i]])[0]
+    assert batch_page([results[0]], 0) == results[0]
+    with pytest.raises(type(results[1])):
+        batch_page([results[1]], 0)
@@ -3,10 +3,11 @@ Tests for proposal related things
 """
 
 import pytest
-from ingest.process.proposals.connected_components import get_proposals
+from ingest.process.proposals.connected_components import get_proposals, get_blank_rows, balance_margins
 import io
 import base64
-from PIL import Image
+import numpy as np
+from PIL import Image, ImageDraw
 
 
 def test_num_objs():
@@ -43,3 +44,62 @@ def test_no_tiny_objs():
 
 
 
+
+
+def reference_blank_rows(inp_np, blank_row_h):
+    # sliding window scan the projection based get_blank_rows replaced
+    white_rows = []
+    curr_top = 0
+    while curr_top + blank_row_h < inp_np.shape[0]-1:
+        curr_bot = curr_top + blank_row_h
+        if not inp_np[curr_top:curr_bot, :].any():
+            if len(white_rows) > 0 and white_rows[-1] >= curr_top:
+                white_rows[-1] = curr_bot
+            else:
+                white_rows.append(curr_bot)
+        elif curr_top == 0:
+            white_rows.append(0)
+        elif curr_bot == inp_np.shape[0]-2:
+            white_rows.append(inp_np.shape[0]-1)
+        curr_top += 1
+    return white_rows
+
+
+def random_bitmap(seed, shape=(300, 120)):
+    rng = np.random.default_rng(seed)
+    bmap = np.zeros(shape, dtype=np.uint8)
+    for _ in range(rng.integers(0, 12)):
+        y, x = rng.integers(0, shape[0]), rng.integers(0, shape[1])
+        bmap[y:y+rng.integers(1, 30), x:x+rng.integers(1, 40)] = 1
+    return bmap
+
+
+def test_blank_rows_match_sliding_window():
+    for seed in range(50):
+        bmap = random_bitmap(seed)
+        for blank_row_h in [1, 5, 15, 40]:
+            assert get_blank_rows(bmap, blank_row_h) == reference_blank_rows(bmap, blank_row_h)
+
+
+def test_balance_margins():
+    bmap = np.zeros((10, 40), dtype=np.uint8)
+    bmap[2:5, 5:20] = 1
+    img = np.zeros((10, 40, 3), dtype=np.uint8)
+    balanced, balanced_img, l_diff = balance_margins(bmap, img)
+    # 4 blank columns on the left (column 0 is not measured), 20 on the right
+    assert balanced.shape == (10, 24)
+    assert balanced_img.shape == (10, 24, 3)
+    assert l_diff == 0
+    # mirrored: 19 blank columns on the left, 5 on the right
+    balanced, _, l_diff = balance_margins(bmap[:, ::-1], img)
+    assert balanced.shape == (10, 26)
+    assert l_diff == 14
+
+
+def test_proposals_separate_blocks():
+    img = Image.new('RGB', (800, 1000), 'white')
+    draw = ImageDraw.Draw(img)
+    draw.rectangle([100, 100, 700, 300], fill='black')
+    draw.rectangle([100, 500, 700, 800], fill='black')
+    proposals = sorted(get_proposals(img))
+    assert proposals == [(100, 100, 700, 300), (100, 500, 700, 800)]
@@ -0,0 +1,130 @@
+"""
+Tests for in-process page rendering
+"""
+
+import os
+import pickle
+import pytest
+from ingest.utils.rasterize import PageStore, count_pages, page_ranges, page_sizes
+from ingest.utils.pdf_extractor import parse_pdf, parse_pages, iter_pdf_pages, merge_parsed, has_text
+from ingest.ingest import Ingest
+
+PDF = os.path.join(os.path.dirname(__file__), '../../../cosmos_service/test/resources/pdfs/bucky.pdf')
+
+
+def test_pages_render_at_pipeline_size():
+    with PageStore(PDF) as store:
+        assert len(store) > 0
+        for page_num, img in store:
+            assert max(img.size) == 1920
+            assert img.mode == 'RGB'
+
+
+def test_page_cache_is_bounded():
+    with PageStore(PDF, size=400, max_cached=1) as store:
+        first = store.get(1)
+        assert store.get(1) is first
+        if len(store) > 1:
+            store.get(2)
+            assert store.get(1) is not first
+        with pytest.raises(IndexError):
+            store.get(len(store) + 1)
+
+
+def test_page_sizes_match_rendered_pages():
+    sizes = page_sizes(PDF)
+    with PageStore(PDF) as store:
+        assert len(sizes) == len(store)
+        for (page_num, img), size in zip(store, sizes):
+            assert max(size) == 1920
+            assert abs(img.size[0] - size[0]) <= 1 and abs(img.size[1] - size[1]) <= 1
+
+
+def test_pdf_to_images_writes_padded_pages(tmp_path):
+    pages = Ingest.pdf_to_images('na', str(tmp_path), PDF)
+    with PageStore(PDF) as store:
+        assert len(pages) == len(store)
+    for tmp_dir, pdf_name, page_num in pages:
+        with open(f'{os.path.join(tmp_dir, pdf_name)}_{page_num}.pkl', 'rb') as rf:
+            obj = pickle.load(rf)
+        assert os.path.exists(obj['pad_img'])
+        assert max(obj['dims']) == 1920
+        assert len(obj['proposals']) > 0
+
+
+def test_page_ranges_cover_document():
+    assert page_ranges(7, 3) == [range(1, 4), range(4, 7), range(7, 8)]
+    assert page_ranges(7, None) == [range(1, 8)]
+    assert page_ranges(0, 3) == []
+
+
+def test_sharded_parse_matches_whole():
+    meta, limit = parse_pdf(PDF)
+    shards = [parse_pdf(PDF, pages={p - 1 for p in pages}) for pages in page_ranges(count_pages(PDF), 4)]
+    sharded_meta, sharded_limit = merge_parsed(shards)
+    assert sharded_limit == limit
+    assert sharded_meta['page'].tolist() == meta['page'].tolist()
+    # pdfminer breaks ties between equally distant text boxes by object id, so only the rows of a page are comparable
+    key = ['page', 'y1', 'x1', 'text']
+    assert sharded_meta.sort_values(key).reset_index(drop=True).equals(meta.sort_values(key).reset_index(drop=True))
+
+
+def test_pdf_to_images_shards_cover_pages(tmp_path):
+    os.makedirs(tmp_path / 'whole')
+    os.makedirs(tmp_path / 'sharded')
+    whole = Ingest.pdf_to_images('na', str(tmp_path / 'whole'), PDF)
+    sharded = []
+    for pages in Ingest.page_shards(PDF, 5):
+        sharded.extend(Ingest.pdf_to_images('na', str(tmp_path / 'sharded'), PDF, pages=pages))
+    assert [page_num for _, _, page_num in sharded] == [page_num for _, _, page_num in whole]
+    for _, pdf_name, page_num in sharded:
+        with open(tmp_path / 'sharded' / f'{pdf_name}_{page_num}.pkl', 'rb') as rf:
+            s_obj = pickle.load(rf)
+        with open(tmp_path / 'whole' / f'{pdf_name}_{page_num}.pkl', 'rb') as rf:
+            w_obj = pickle.load(rf)
+        assert s_obj['proposals'] == w_obj['proposals']
+        assert s_obj['pdf_limit'] == w_obj['pdf_limit']
+        assert sorted(s_obj['meta']['text']) == sorted(w_obj['meta']['text'])
+
+
+def test_parse_pages_per_page():
+    meta, limit = parse_pdf(PDF)
+    pages_meta, limits = parse_pages(PDF)
+    assert sorted(limits) == list(range(count_pages(PDF)))
+    assert limits[max(limits)] == limit
+    assert sorted(pages_meta) == sorted(meta['page'].unique())
+    for page, page_df in meta.groupby('page'):
+        assert sorted(pages_meta[page]['text']) == sorted(page_df['text'])
+        assert (pages_meta[page]['page'] == page).all()
+    # a page range is parsed on its own, and parsing stops after its last page
+    shard = list(iter_pdf_pages(PDF, pages={2, 3}))
+    assert [idx for idx, _, _ in shard] == [2, 3]
+    assert [limit for _, _, limit in shard] == [limits[2], limits[3]]
+    assert list(iter_pdf_pages(PDF, pages=set())) == []
+
+
+@pytest.fixture
+def scanned_pdf(tmp_path):
+    # a PDF made of page images only, as a scanner writes them
+    with PageStore(PDF, size=400) as store:
+        images = [img for _, img in store][:3]
+    path = str(tmp_path / 'scanned.pdf')
+    images[0].save(path, save_all=True, append_images=images[1:])
+    return path
+
+
+def test_pdf_without_text_is_skipped_or_ocred(scanned_pdf, tmp_path):
+    assert has_text(PDF)
+    assert not has_text(scanned_pdf)
+    # skipping is decided once for the document, not by each shard
+    assert Ingest.page_shards(scanned_pdf, 2, skip_ocr=True) == []
+    assert Ingest.page_shards(scanned_pdf, skip_ocr=False) == [range(1, 4)]
+    shards = Ingest.page_shards(scanned_pdf, 2, skip_ocr=False)
+    assert shards == [range(1, 3), range(3, 4)]
+    # every page is rendered, without metadata so that its text comes from OCR
+    for shards in [[None], shards]:
+        pages = [page for pages in shards for page in Ingest.pdf_to_images('na', str(tmp_path), scanned_pdf, pages=pages)]
+        assert [page_num for _, _, page_num in pages] == [1, 2, 3]
+        for tmp_dir, pdf_name, page_num in pages:
+            with open(f'{os.path.join(tmp_dir, pdf_name)}_{page_num}.pkl', 'rb') as rf:
+                assert pickle.load(rf)['meta'] is None
@@ -0,0 +1,55 @@
+"""
+Tests for the content addressed result cache
+"""
+
+import os
+import time
+from ingest.utils.result_cache import ResultCache, cache_key, file_sha1, files_version
+
+PDF = os.path.join(os.path.dirname(__file__), '../../../cosmos_service/test/resources/pdfs/bucky.pdf')
+
+FIELDS = {'detected_objs': [([0, 0, 10, 10], [(0.9, 'Body Text')])], 'softmax_objs': [[0.9, 0.1]],
+          'content': [([0, 0, 10, 10], [(0.9, 'Body Text')], 'text')], 'page_path': 'not cached'}
+
+
+def test_cache_key():
+    pdf_hash = file_sha1(PDF)
+    assert len(pdf_hash) == 40
+    key = cache_key(pdf_hash, 'a', 'b', {'skip_ocr': True, 'rules_postprocess': False})
+    assert key == cache_key(pdf_hash, 'a', 'b', {'rules_postprocess': False, 'skip_ocr': True})
+    assert key != cache_key(pdf_hash, 'c', 'b', {'skip_ocr': True, 'rules_postprocess': False})
+    assert key != cache_key(pdf_hash, 'a', None, {'skip_ocr': True, 'rules_postprocess': False})
+    assert key != cache_key(pdf_hash, 'a', 'b', {'skip_ocr': False, 'rules_postprocess': False})
+    assert files_version(PDF, None, '/does/not/exist') == files_version(PDF)
+    assert files_version(None) is None
+
+
+def test_get_put(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    assert cache.get('ab' * 20, 1) is None
+    cache.put('ab' * 20, 1, FIELDS)
+    fields = cache.get('ab' * 20, 1)
+    assert 'page_path' not in fields
+    assert fields == {name: value for name, value in FIELDS.items() if name != 'page_path'}
+    assert cache.get('ab' * 20, 2) is None
+    assert ResultCache(str(tmp_path)).get('ab' * 20, 1) == fields
+
+
+def test_lru_eviction(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    keys = [c * 40 for c in 'abc']
+    for key in keys:
+        cache.put(key, 1, FIELDS)
+        time.sleep(0.01)
+    entry_size = cache.size // 3
+
+    # a reopened cache knows the order the entries were last used in
+    cache = ResultCache(str(tmp_path), max_bytes=3 * entry_size)
+    assert list(cache.entries) == keys
+    cache.get(keys[0], 1)
+    cache.max_bytes = 2 * entry_size
+    cache.put('d' * 40, 1, FIELDS)
+    assert cache.get(keys[1], 1) is None and cache.get(keys[2], 1) is None
+    assert cache.get(keys[0], 1) is not None and cache.get('d' * 40, 1) is not None
+    assert cache.size <= cache.max_bytes
+    assert not os.path.exists(os.path.join(str(tmp_path), keys[1][:2], keys[1]))
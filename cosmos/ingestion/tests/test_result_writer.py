@@ -0,0 +1,46 @@
+"""
+Tests for the incremental parquet writer
+"""
+
+import pandas as pd
+import pyarrow.parquet as pq
+from ingest.utils.result_writer import ParquetAppender, RESULT_SCHEMA, page_rows, rows_to_table
+
+
+def make_page(page_num, nobjs):
+    content = [([10 * i, 10, 10 * i + 5, 20], [(0.9 - 0.1 * i, f'cls{i}'), (0.05, 'other')], f'text {i}') for i in range(nobjs)]
+    xgboost_content = [(bb, 'Body Text', text, 0.5) for bb, _, text in content]
+    return {'pdf_name': 'doc.pdf', 'dataset_id': 'na', 'page_num': page_num, 'pad_img': f'doc.pdf_{page_num}_pad',
+            'pdf_limit': (0, 0, 612.0, 792.0), 'content': content, 'xgboost_content': xgboost_content}
+
+
+def test_rows_to_table_matches_frame():
+    rows = page_rows(make_page(1, 3)) + page_rows(make_page(2, 2))
+    table = rows_to_table(rows)
+    assert table.schema.equals(RESULT_SCHEMA)
+    df = pd.DataFrame(rows)
+    assert table['detect_cls'].to_pylist() == df['classes'].apply(lambda x: x[0]).tolist()
+    assert table['detect_score'].to_pylist() == df['scores'].apply(lambda x: x[0]).tolist()
+    assert table['postprocess_cls'].to_pylist() == ['Body Text'] * 5
+
+
+def test_appender_writes_row_groups(tmp_path):
+    path = str(tmp_path / 'out.parquet')
+    with ParquetAppender(path, schema=RESULT_SCHEMA) as writer:
+        for page_num in range(1, 4):
+            writer.write_rows(page_rows(make_page(page_num, page_num)))
+        writer.write_rows([])
+    meta = pq.ParquetFile(path).metadata
+    assert meta.num_row_groups == 3
+    assert meta.num_rows == writer.num_rows == 6
+    assert pq.read_table(path).schema.equals(RESULT_SCHEMA)
+
+
+def test_appender_fixes_schema_from_first_frame(tmp_path):
+    path = str(tmp_path / 'agg.parquet')
+    with ParquetAppender(path) as writer:
+        writer.write_frame(pd.DataFrame({'pdf_name': ['a'], 'caption_content': [None], 'score': [1]}))
+        writer.write_frame(pd.DataFrame({'pdf_name': ['b'], 'caption_content': ['text'], 'score': [2]}))
+    table = pq.read_table(path)
+    assert table['pdf_name'].to_pylist() == ['a', 'b']
+    assert table['caption_content'].to_pylist() == [None, 'text']
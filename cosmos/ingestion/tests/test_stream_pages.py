@@ -0,0 +1,258 @@
+"""
+Tests for the streaming page scheduler in Ingest
+"""
+
+import os
+import json
+import shutil
+import time
+import functools
+import pytest
+import pyarrow.parquet as pq
+from dask.distributed import Client, LocalCluster, wait
+import ingest.ingest as ingest_module
+from ingest.ingest import Ingest
+from ingest.utils.page_state import load_page, save_page
+from ingest.utils.manifest import Manifest
+from ingest.utils.pdf_extractor import iter_pdf_pages
+
+PDFS = [os.path.join(os.path.dirname(__file__), '../../../cosmos_service/test/resources/pdfs/bucky.pdf'),
+        os.path.join(os.path.dirname(__file__), '../../../examples/covid/pdfs/56aa4a00cf58f187a425a4af.pdf')]
+
+
+DETECTED = []
+
+
+def fake_detect(page):
+    obj = load_page(page)
+    DETECTED.append(obj['page_num'])
+    obj['content'] = [([0, 0, 10, 10], [(0.9, 'Body Text')], f'page {obj["page_num"]}')]
+    return save_page(page, obj)
+
+
+def passthrough(page, **kwargs):
+    return page
+
+
+BATCHES = []
+
+
+def fake_postprocess_batch(*pages):
+    BATCHES.append(len(pages))
+    results = []
+    for page in pages:
+        obj = load_page(page)
+        obj['xgboost_content'] = [(bb, 'Body Text', text, 0.5) for bb, _, text in obj['content']]
+        results.append(save_page(page, obj))
+    return results
+
+
+def failing_detect(page):
+    obj = load_page(page)
+    if obj['pdf_name'] == os.path.basename(PDFS[0]) and obj['page_num'] == 2:
+        raise ValueError('detection failed')
+    return fake_detect(page)
+
+
+PARSED = []
+
+
+def failing_parse(fp, pages=None):
+    # the shard holding page 2 of the first pdf cannot be parsed
+    for idx, lines, limit in iter_pdf_pages(fp, pages):
+        if os.path.basename(fp) == os.path.basename(PDFS[0]) and idx == 1:
+            PARSED.append(idx)
+            raise ValueError('parsing failed')
+        yield idx, lines, limit
+
+
+def slow_render(filename, pages=None):
+    time.sleep(5)
+    return []
+
+
+def fake_postprocess_batch_failing_page(*pages):
+    # a page that cannot be postprocessed is returned as the error it failed with
+    results = []
+    for page in fake_postprocess_batch(*pages):
+        obj = load_page(page)
+        failed = obj['pdf_name'] == os.path.basename(PDFS[0]) and obj['page_num'] == 2
+        results.append(ValueError('postprocessing failed') if failed else page)
+    return results
+
+
+def wait_for_all(futures, timeout=None, return_when=None):
+    return wait(futures, timeout=timeout)
+
+
+@pytest.fixture
+def client():
+    with LocalCluster(n_workers=1, threads_per_worker=4, processes=False, resources={'GPU': 1, 'process': 4}) as cluster:
+        with Client(cluster) as client:
+            yield client
+
+
+@pytest.fixture
+def stages(monkeypatch):
+    monkeypatch.setattr(ingest_module, 'detect', fake_detect)
+    monkeypatch.setattr(ingest_module, 'regroup', passthrough)
+    monkeypatch.setattr(ingest_module, 'pool_text', passthrough)
+    DETECTED.clear()
+    return DETECTED
+
+
+@pytest.mark.parametrize('max_in_flight', [1, 2000])
+@pytest.mark.parametrize('persist_pages', [True, False])
+def test_pages_stream_in_order(client, tmp_path, stages, max_in_flight, persist_pages):
+    ingest = Ingest(None, client=client, tmp_dir=str(tmp_path), use_semantic_detection=True, persist_pages=persist_pages)
+    render = functools.partial(Ingest.pdf_to_images, 'na', ingest.images_tmp, persist=persist_pages)
+    documents = [(pdf, Ingest.page_shards(pdf, 5), {}, None) for pdf in PDFS]
+    with Manifest(str(tmp_path / 'checkpoints')) as manifest:
+        streamed = list(ingest._stream_documents(render, documents, True, manifest, max_in_flight=max_in_flight))
+    assert sorted(name for name, _, _, _ in streamed) == sorted(os.path.basename(pdf) for pdf in PDFS)
+    for name, rows, npages, failure in streamed:
+        assert failure is None
+        assert all(row['pdf_name'] == name for row in rows)
+        page_nums = [row['page_num'] for row in rows]
+        assert page_nums == sorted(page_nums)
+        assert len(rows) == len(set(page_nums)) == npages > 0
+        assert all(row['content'] == f'page {row["page_num"]}' for row in rows)
+    pickles = [f for f in os.listdir(ingest.images_tmp) if f.endswith('.pkl')]
+    assert len(pickles) == (sum(npages for _, _, npages, _ in streamed) if persist_pages else 0)
+
+
+def test_rerun_resumes_from_checkpoints(client, tmp_path, stages):
+    pdf_dir = tmp_path / 'pdfs'
+    os.makedirs(pdf_dir)
+    for pdf in PDFS:
+        shutil.copy(pdf, pdf_dir)
+    ingest = Ingest(None, client=client, tmp_dir=str(tmp_path / 'tmp'), use_semantic_detection=True)
+    out = tmp_path / 'out'
+    os.makedirs(out)
+    ingest.ingest(str(pdf_dir), 'na', str(out), str(tmp_path / 'images'), pages_per_task=5)
+    first = pq.read_table(out / 'na.parquet')
+    npages = len(stages)
+    assert first.num_rows == npages > 0
+
+    # a document that only got half way is finished from its page checkpoints
+    manifest_path = tmp_path / 'tmp' / 'checkpoints' / 'na' / 'manifest.jsonl'
+    records = [json.loads(line) for line in open(manifest_path)]
+    bucky = os.path.basename(PDFS[0])
+    keep = [r for r in records if r['pdf'] != bucky or ('page' in r and r['page'] <= 3)]
+    with open(manifest_path, 'w') as wf:
+        wf.writelines(json.dumps(r) + '\n' for r in keep)
+    stages.clear()
+    ingest.ingest(str(pdf_dir), 'na', str(out), str(tmp_path / 'images'), pages_per_task=5)
+    assert len(stages) == len([r for r in records if r['pdf'] == bucky and 'page' in r]) - 3
+    second = pq.read_table(out / 'na.parquet')
+    assert second.equals(first)
+
+    # checkpoints of a run with other flags are not reused
+    stages.clear()
+    ingest.ingest(str(pdf_dir), 'na', str(out), str(tmp_path / 'images'), pages_per_task=5, skip_ocr=False)
+    assert len(stages) == npages
+    assert pq.read_table(out / 'na.parquet').equals(first)
+
+
+def test_failed_documents_are_left_out(client, tmp_path, stages, monkeypatch):
+    monkeypatch.setattr(ingest_module, 'detect', failing_detect)
+    pdf_dir = tmp_path / 'pdfs'
+    os.makedirs(pdf_dir)
+    for pdf in PDFS:
+        shutil.copy(pdf, pdf_dir)
+    ingest = Ingest(None, client=client, tmp_dir=str(tmp_path / 'tmp'), use_semantic_detection=True)
+    out = tmp_path / 'out'
+    os.makedirs(out)
+    ingest.ingest(str(pdf_dir), 'na', str(out), str(tmp_path / 'images'), pages_per_task=5, max_retries=0)
+    # the pages of the failed document that did finish are checkpointed, but not merged
+    with Manifest(str(tmp_path / 'tmp' / 'checkpoints' / 'na')) as manifest:
+        assert manifest.documents[os.path.basename(PDFS[0])]['status'] == 'failed'
+        assert 'objects' in manifest.outputs(os.path.basename(PDFS[0]))
+    table = pq.read_table(out / 'na.parquet')
+    assert set(table.column('pdf_name').to_pylist()) == {os.path.basename(PDFS[1])}
+
+
+def test_failed_shards_fail_their_document(client, tmp_path, stages, monkeypatch):
+    monkeypatch.setattr(ingest_module, 'iter_pdf_pages', failing_parse)
+    PARSED.clear()
+    pdf_dir = tmp_path / 'pdfs'
+    os.makedirs(pdf_dir)
+    for pdf in PDFS:
+        shutil.copy(pdf, pdf_dir)
+    ingest = Ingest(None, client=client, tmp_dir=str(tmp_path / 'tmp'), use_semantic_detection=True)
+    out = tmp_path / 'out'
+    os.makedirs(out)
+    ingest.ingest(str(pdf_dir), 'na', str(out), str(tmp_path / 'images'), pages_per_task=5, max_retries=1)
+    # the failing shard is retried, then its document fails instead of finishing without the shard's pages
+    assert len(PARSED) == 2
+    with Manifest(str(tmp_path / 'tmp' / 'checkpoints' / 'na')) as manifest:
+        record = manifest.documents[os.path.basename(PDFS[0])]
+        assert record['status'] == 'failed' and record['reason'] == 'error'
+        assert manifest.documents[os.path.basename(PDFS[1])]['status'] == 'done'
+    table = pq.read_table(out / 'na.parquet')
+    assert set(table.column('pdf_name').to_pylist()) == {os.path.basename(PDFS[1])}
+
+
+def test_cached_pages_skip_detection(client, tmp_path, stages):
+    ingest = Ingest(None, client=client, tmp_dir=str(tmp_path), use_semantic_detection=True,
+                    cache_dir=str(tmp_path / 'cache'))
+    render = functools.partial(Ingest.pdf_to_images, 'na', ingest.images_tmp, persist=False)
+    documents = [(pdf, Ingest.page_shards(pdf, 5), {}, key) for pdf, key in zip(PDFS, ['a' * 40, 'b' * 40])]
+    with Manifest(str(tmp_path / 'first')) as manifest:
+        first = list(ingest._stream_documents(render, documents, True, manifest))
+    npages = len(stages)
+    assert npages == sum(npages for _, _, npages, _ in first) > 0
+
+    # the same pdfs in another dataset are served from the cache
+    stages.clear()
+    with Manifest(str(tmp_path / 'second')) as manifest:
+        second = list(ingest._stream_documents(render, documents, True, manifest))
+    assert len(stages) == 0
+    assert sorted(first, key=lambda doc: doc[0]) == sorted(second, key=lambda doc: doc[0])
+
+
+def test_postprocess_in_batches(client, tmp_path, stages, monkeypatch):
+    monkeypatch.setattr(ingest_module, 'xgboost_postprocess_batch', fake_postprocess_batch)
+    BATCHES.clear()
+    ingest = Ingest(None, client=client, tmp_dir=str(tmp_path), use_semantic_detection=True,
+                    use_xgboost_postprocess=True)
+    render = functools.partial(Ingest.pdf_to_images, 'na', ingest.images_tmp, persist=False)
+    documents = [(pdf, Ingest.page_shards(pdf, 5), {}, None) for pdf in PDFS]
+    with Manifest(str(tmp_path / 'checkpoints')) as manifest:
+        streamed = list(ingest._stream_documents(render, documents, True, manifest, postprocess_batch_size=3))
+    npages = sum(npages for _, _, npages, _ in streamed)
+    assert sum(BATCHES) == npages
+    assert max(BATCHES) == 3 and len(BATCHES) < npages
+    for _, rows, _, failure in streamed:
+        assert failure is None
+        assert all(row['postprocess_cls'] == 'Body Text' and row['postprocess_score'] == 0.5 for row in rows)
+
+
+def test_slow_shards_time_out(client, tmp_path, stages):
+    ingest = Ingest(None, client=client, tmp_dir=str(tmp_path), use_semantic_detection=True)
+    documents = [(PDFS[0], [range(1, 3)], {}, None)]
+    with Manifest(str(tmp_path / 'checkpoints')) as manifest:
+        streamed = list(ingest._stream_documents(slow_render, documents, True, manifest, render_timeout=0.5, max_retries=0))
+    assert streamed == [(os.path.basename(PDFS[0]), [], 0, 'timeout')]
+
+
+@pytest.mark.parametrize('failing_stage', ['detect', 'postprocess'])
+def test_failing_page_only_fails_its_document(client, tmp_path, stages, monkeypatch, failing_stage):
+    if failing_stage == 'detect':
+        monkeypatch.setattr(ingest_module, 'detect', failing_detect)
+        monkeypatch.setattr(ingest_module, 'xgboost_postprocess_batch', fake_postprocess_batch)
+    else:
+        monkeypatch.setattr(ingest_module, 'xgboost_postprocess_batch', fake_postprocess_batch_failing_page)
+    # both documents are rendered before any page is submitted, so their pages share a postprocessing batch
+    monkeypatch.setattr(ingest_module, 'wait', wait_for_all)
+    ingest = Ingest(None, client=client, tmp_dir=str(tmp_path), use_semantic_detection=True,
+                    use_xgboost_postprocess=True)
+    render = functools.partial(Ingest.pdf_to_images, 'na', ingest.images_tmp, persist=False)
+    documents = [(pdf, [None], {}, None) for pdf in PDFS]
+    with Manifest(str(tmp_path / 'checkpoints')) as manifest:
+        streamed = {name: (rows, failure) for name, rows, _, failure in
+                    ingest._stream_documents(render, documents, True, manifest, max_retries=0,
+                                                     postprocess_batch_size=1000)}
+    assert streamed[os.path.basename(PDFS[0])][1] == 'error'
+    rows, failure = streamed[os.path.basename(PDFS[1])]
+    assert failure is None and len(rows) > 0
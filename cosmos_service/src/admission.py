@@ -0,0 +1,228 @@
+"""
+Memory aware admission of COSMOS jobs to the pipeline workers.
+The memory a job needs is estimated from the number and size of its pages. A job is only handed to a worker
+once its estimate fits in the host and GPU memory left over by the jobs already admitted, and in the memory
+that is actually free, so the number of jobs running on the GPU follows the size of the documents instead
+of a fixed count.
+"""
+from fastapi.logger import logger
+from typing import Dict, List, Optional, Tuple
+from ingest.utils.rasterize import page_sizes
+from worker_pool import PipelineWorker, DETECT_BATCH_PAGES, PROPOSE_AHEAD
+import asyncio
+import torch
+import glob
+import time
+import os
+
+# host memory a job holds whatever its size: its page worker tasks, tables and aggregation frames
+HOST_BYTES_PER_JOB = int(os.environ.get('HOST_BYTES_PER_JOB', 256 * 2**20))
+# host memory per page kept until the job is aggregated: its parsed text, detections and post-processing results
+HOST_BYTES_PER_PAGE = int(os.environ.get('HOST_BYTES_PER_PAGE', 2 * 2**20))
+# host memory per pixel of a page being proposed or detected: the rendered page, its padded copy and windows
+HOST_BYTES_PER_PIXEL = int(os.environ.get('HOST_BYTES_PER_PIXEL', 12))
+# GPU memory per pixel of a page in a detection batch
+DEVICE_BYTES_PER_PIXEL = int(os.environ.get('DEVICE_BYTES_PER_PIXEL', 100))
+# share of the memory free while no job is admitted that admitted jobs may use
+MEMORY_FRACTION = float(os.environ.get('ADMISSION_MEMORY_FRACTION', 0.8))
+# seconds a waiting job goes between checks of free memory, which other processes may release, and of workers
+# that have finished starting
+ADMISSION_POLL = 1
+# times a job that runs out of GPU memory is retried, with its estimate doubled each time
+MAX_OOM_RETRIES = 3
+# seconds a job may wait while smaller jobs queued after it are admitted ahead of it. Past that, no other job is
+# admitted until it is, so the memory it needs frees up as the running jobs finish
+ADMISSION_MAX_WAIT = float(os.environ.get('ADMISSION_MAX_WAIT', 300))
+
+
+class JobEstimate:
+    """Memory a job is expected to need while it runs"""
+
+    def __init__(self, pages: int, host_bytes: int, device_bytes: int):
+        self.pages = pages
+        self.host_bytes = host_bytes
+        self.device_bytes = device_bytes
+
+    def to_dict(self) -> dict:
+        return {'pages': self.pages, 'host_bytes': self.host_bytes, 'device_bytes': self.device_bytes}
+
+
+class WaitingJob:
+    """A job waiting for admission, and the worker it was admitted to once it is"""
+
+    def __init__(self, job_id: str, estimate: JobEstimate):
+        self.job_id = job_id
+        self.estimate = estimate
+        self.since = time.monotonic()
+        self.worker: Optional[PipelineWorker] = None
+
+    def to_dict(self) -> dict:
+        return {'job_id': self.job_id, 'waited_seconds': time.monotonic() - self.since, **self.estimate.to_dict()}
+
+
+def estimate_job(pdf_dir: str, oom_retries: int = 0) -> JobEstimate:
+    """
+    Estimate the memory a job needs from the number of pages of its PDF and the size they are rendered at.
+    Only the largest pages that can be in flight at once count towards the per-pixel terms
+    """
+    pdfs = glob.glob(f'{pdf_dir}/*.pdf')
+    pixels = sorted((w * h for w, h in page_sizes(pdfs[0])), reverse=True) if pdfs else []
+    host_bytes = (HOST_BYTES_PER_JOB + HOST_BYTES_PER_PAGE * len(pixels)
+                  + HOST_BYTES_PER_PIXEL * sum(pixels[:PROPOSE_AHEAD]))
+    device_bytes = DEVICE_BYTES_PER_PIXEL * sum(pixels[:DETECT_BATCH_PAGES])
+    scale = 2 ** oom_retries
+    return JobEstimate(len(pixels), host_bytes * scale, device_bytes * scale)
+
+
+def host_free_bytes() -> int:
+    """Host memory available to new work, MemAvailable where the kernel reports it"""
+    try:
+        with open('/proc/meminfo') as rf:
+            for line in rf:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def device_free_bytes() -> Optional[int]:
+    """Free memory of the GPU the workers run on, including memory used by other processes, None without a GPU"""
+    if not torch.cuda.is_available():
+        return None
+    free, _ = torch.cuda.mem_get_info(0)
+    return free
+
+
+class AdmissionController:
+    """
+    Decides when a queued job may start, and on which worker.
+    Capacity is measured whenever nothing is admitted, and every admission also checks the memory free right now.
+    Waiting jobs are admitted in queue order, but a job that does not fit yet does not hold back the ones behind it
+    until it has waited max_wait seconds
+    """
+
+    def __init__(self, workers: List[PipelineWorker], memory_fraction: float = MEMORY_FRACTION,
+                 max_wait: float = ADMISSION_MAX_WAIT):
+        self.workers = workers
+        self.memory_fraction = memory_fraction
+        self.max_wait = max_wait
+        self.admitted: Dict[str, Tuple[PipelineWorker, JobEstimate]] = {}
+        self.waiting: List[WaitingJob] = []
+        self.oom_retries: Dict[str, int] = {}
+        self.host_capacity: Optional[int] = None
+        self.device_capacity: Optional[int] = None
+        self.changed = asyncio.Condition()
+
+    def _admitted_bytes(self) -> Tuple[int, int]:
+        estimates = [estimate for _, estimate in self.admitted.values()]
+        return sum(e.host_bytes for e in estimates), sum(e.device_bytes for e in estimates)
+
+    def _measure(self):
+        """While nothing is admitted, the memory that is free is what jobs may share"""
+        if self.admitted:
+            return
+        self.host_capacity = int(host_free_bytes() * self.memory_fraction)
+        device_free = device_free_bytes()
+        self.device_capacity = None if device_free is None else int(device_free * self.memory_fraction)
+
+    def _fits(self, estimate: JobEstimate) -> bool:
+        self._measure()
+        if not self.admitted:
+            # a job too large for an idle machine still has to run, it gets the machine to itself
+            return True
+        host_admitted, device_admitted = self._admitted_bytes()
+        if host_admitted + estimate.host_bytes > self.host_capacity or estimate.host_bytes > host_free_bytes():
+            return False
+        if self.device_capacity is not None:
+            if device_admitted + estimate.device_bytes > self.device_capacity or estimate.device_bytes > device_free_bytes():
+                return False
+        return True
+
+    def _pick_worker(self) -> Optional[PipelineWorker]:
+        """The ready worker with the fewest admitted jobs, if any has room for another"""
+        load = {worker.name: 0 for worker in self.workers}
+        for worker, _ in self.admitted.values():
+            load[worker.name] += 1
+        ready = [worker for worker in self.workers if worker.ready and load[worker.name] < worker.max_jobs]
+        return min(ready, key=lambda worker: load[worker.name], default=None)
+
+    def _admit_waiting(self):
+        """
+        Admit every waiting job that fits while a worker can take it, oldest first. A job that has waited longer
+        than max_wait and still does not fit stops the jobs behind it from taking the memory it waits for
+        """
+        for waiting in list(self.waiting):
+            worker = self._pick_worker()
+            if worker is None:
+                break
+            if self._fits(waiting.estimate):
+                self.waiting.remove(waiting)
+                waiting.worker = worker
+                self.admitted[waiting.job_id] = (worker, waiting.estimate)
+                logger.info(f"Admitted COSMOS job {waiting.job_id} ({waiting.estimate.pages} pages) to {worker.name}")
+            elif time.monotonic() - waiting.since > self.max_wait:
+                break
+
+    def estimate(self, pdf_dir: str, job_id: str) -> JobEstimate:
+        return estimate_job(pdf_dir, self.oom_retries.get(job_id, 0))
+
+    async def admit(self, job_id: str, estimate: JobEstimate) -> PipelineWorker:
+        """Wait until the job is admitted, and return the worker it was admitted to"""
+        waiting = WaitingJob(job_id, estimate)
+        async with self.changed:
+            self.waiting.append(waiting)
+            try:
+                while True:
+                    self._admit_waiting()
+                    if waiting.worker is not None:
+                        # other jobs may have been admitted along with this one
+                        self.changed.notify_all()
+                        return waiting.worker
+                    try:
+                        await asyncio.wait_for(self.changed.wait(), ADMISSION_POLL)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                # cancelled while waiting, the job may have been admitted by another job's call meanwhile
+                if waiting in self.waiting:
+                    self.waiting.remove(waiting)
+                elif waiting.worker is not None:
+                    self.admitted.pop(job_id, None)
+                    self.changed.notify_all()
+                raise
+
+    async def release(self, job_id: str):
+        """The job is no longer running, its memory can go to the next one"""
+        async with self.changed:
+            self.admitted.pop(job_id, None)
+            self.changed.notify_all()
+
+    def record_oom(self, job_id: str) -> bool:
+        """
+        Raise the estimate of a job that ran out of GPU memory for its next attempt.
+        Returns False once the job has been retried MAX_OOM_RETRIES times
+        """
+        retries = self.oom_retries.get(job_id, 0) + 1
+        if retries > MAX_OOM_RETRIES:
+            self.oom_retries.pop(job_id, None)
+            return False
+        self.oom_retries[job_id] = retries
+        return True
+
+    def forget(self, job_id: str):
+        self.oom_retries.pop(job_id, None)
+
+    def status(self) -> dict:
+        host_admitted, device_admitted = self._admitted_bytes()
+        return {
+            'admitted_jobs': [{'job_id': job_id, 'worker': worker.name, **estimate.to_dict()}
+                              for job_id, (worker, estimate) in self.admitted.items()],
+            'waiting_jobs': [waiting.to_dict() for waiting in self.waiting],
+            'host_admitted_bytes': host_admitted,
+            'host_capacity_bytes': self.host_capacity,
+            'host_free_bytes': host_free_bytes(),
+            'device_admitted_bytes': device_admitted,
+            'device_capacity_bytes': self.device_capacity,
+            'device_free_bytes': device_free_bytes(),
+        }
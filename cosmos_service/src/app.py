@@ -5,7 +5,7 @@ from fastapi.logger import logger
 import torch
 import asyncio
 from scheduler import init_scheduler
-from work_queue import setup_workers
+from work_queue import setup_workers, stop_workers
 from routers import process, healthcheck
 
 prefix_url = os.environ.get('API_PREFIX','/cosmos_service')
@@ -17,10 +17,8 @@ prefix_router.include_router(process.router)
 prefix_router.include_router(healthcheck.router)
 app.add_middleware(GZipMiddleware)
 
-# Approximate memory consumed by a single cosmos pipeline, used to calculate available
-# concurrency
-# TODO this only works assuming the cosmos api is the only process using the GPU, which
-# is usually not the case
+# Approximate memory held by a single pipeline worker with its models loaded, used to calculate
+# how many workers fit on the GPU. How many jobs run on them is left to the admission controller
 GPU_MEM_PER_WORKER = 4e9 # 4GB
 
 @prefix_router.get("/version_info")
@@ -36,14 +34,12 @@ app.include_router(prefix_router)
 def get_max_processes_per_gpu():
     """
     Approximately calculate the amount of cosmos pipelines that can be run in parallel based on
-    the amount of memory available per GPU.
-    TODO This assumes the COSMOS pipeline will be the only thing running on the GPU, which is
-    not necessarily the case
+    the amount of GPU memory currently free, so memory used by other processes is left alone.
     """
     if not torch.cuda.is_available():
         return 1
-    max_mem = torch.cuda.get_device_properties(0).total_memory
-    return int(max_mem / GPU_MEM_PER_WORKER)
+    free_mem, _ = torch.cuda.mem_get_info(0)
+    return max(1, int(free_mem / GPU_MEM_PER_WORKER))
 
 @app.on_event("startup")
 async def startup_event():
@@ -53,3 +49,10 @@ async def startup_event():
     max_worker_count = get_max_processes_per_gpu()
     setup_workers(max_worker_count)
     init_scheduler()
+
+@app.on_event("shutdown")
+def shutdown_event():
+    """
+    Stop the pipeline worker processes
+    """
+    stop_workers()
@@ -2,17 +2,35 @@
 Simple Sqlite DB for storing cosmos session information
 """
 from typing import BinaryIO
-from sqlalchemy import create_engine, select
+from sqlalchemy import create_engine, select, inspect, text
 from sqlalchemy.orm import sessionmaker
 from fastapi import HTTPException
-from .processing_session_types import Base, CosmosSessionJob
+from .processing_session_types import Base, CosmosSessionJob, CosmosPageResult
 from util.hash_file import hash_file
 import io
 import hashlib
 
 
 engine = create_engine('sqlite:///sessions.db', echo=False)
+
+def add_missing_columns(engine):
+    """
+    create_all only creates missing tables, add the columns that were added to a mapping since
+    an existing database was created
+    """
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
 Base.metadata.create_all(engine)
+add_missing_columns(engine)
 SessionLocal = sessionmaker(bind=engine)
 
 def get_job_details(job_id: str) -> CosmosSessionJob:
@@ -29,6 +47,18 @@ def get_job_details(job_id: str) -> CosmosSessionJob:
         return job
 
 
+def get_page_results(job_id: str, cursor: int = None, limit: int = 100):
+    """
+    Read the page results recorded for a job after the given cursor, the id of the last page result a client has
+    already received, in the order they were recorded
+    """
+    with SessionLocal() as session:
+        query = select(CosmosPageResult).where(CosmosPageResult.job_id == job_id)
+        if cursor is not None:
+            query = query.where(CosmosPageResult.id > cursor)
+        return list(session.scalars(query.order_by(CosmosPageResult.id).limit(limit)))
+
+
 def get_cached_job_for_pdf(pdf_data: BinaryIO) -> CosmosSessionJob:
     """
     Compute the checksum and length of a PDF file, then check the database to see if 
@@ -1,7 +1,7 @@
 """
 SQLAlchemy ORM mappings for the db entity(s) that track COSMOS document processing sessions
 """
-from sqlalchemy import Column, String, TIMESTAMP
+from sqlalchemy import Column, String, Integer, TIMESTAMP
 from sqlalchemy.orm import DeclarativeBase
 from uuid import UUID
 from datetime import datetime
@@ -26,6 +26,8 @@ class CosmosSessionJob(Base):
     started = Column(TIMESTAMP, default=None)
     completed = Column(TIMESTAMP, default=None)
     error = Column(String, default=None)
+    pages_total = Column(Integer, default=None)
+    pages_done = Column(Integer, default=0)
 
 
     def __init__(self, id: UUID, pdf_name: str, pdf_hash: str, pdf_length: int, output_dir: str):
@@ -35,6 +37,7 @@ class CosmosSessionJob(Base):
         self.pdf_length = pdf_length
         self.output_dir = output_dir
         self.created = datetime.now()
+        self.pages_done = 0
 
 
     @property
@@ -69,3 +72,21 @@ class CosmosSessionJob(Base):
         if not self.is_started:
             return None
         return (self.completed - self.started if self.is_completed else datetime.now() - self.started).total_seconds()
+
+
+class CosmosPageResult(Base):
+    """
+    ORM mapping for the text segments of a single page of a job, recorded as soon as the page has been
+    post-processed so they can be streamed before the job completes
+    """
+    __tablename__ = "page_results"
+    id = Column(Integer, primary_key = True, autoincrement = True)
+    job_id = Column(String, index = True)
+    page_num = Column(Integer)
+    segments = Column(String)
+
+
+    def __init__(self, job_id: str, page_num: int, segments: str):
+        self.job_id = job_id
+        self.page_num = page_num
+        self.segments = segments
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, HttpUrl
-from typing import Tuple, Optional
+from typing import Tuple, Optional, List
 from enum import Enum
 
 # Response Models
@@ -16,6 +16,40 @@ class JobStatus(BaseModel):
     error: Optional[str] = Field(..., description="Whether the job has failed with an error", nullable=True)
     time_in_queue: float = Field(...,description="Time the job was queued before running")
     time_processing: Optional[float] = Field(...,description="Time the job has spent running on a GPU")
+    pages_total: Optional[int] = Field(None, description="Number of pages in the document, once it has been rendered", nullable=True)
+    pages_done: int = Field(0, description="Number of pages that have been through detection")
+
+class WorkerStatus(BaseModel):
+    name: str = Field(..., description="Name of the pipeline worker")
+    pid: Optional[int] = Field(..., description="Process ID of the worker, if it is running", nullable=True)
+    alive: bool = Field(..., description="Whether the worker process is running")
+    ready: bool = Field(..., description="Whether the worker has loaded its models and can accept jobs")
+    restarts: int = Field(..., description="Number of times the worker has been restarted after a crash or failed health check")
+    job_ids: List[str] = Field(..., description="IDs of the jobs the worker is currently running")
+
+class AdmittedJob(BaseModel):
+    job_id: str = Field(..., description="ID of the job")
+    worker: str = Field(..., description="Name of the worker the job was admitted to")
+    pages: int = Field(..., description="Number of pages in the job's document")
+    host_bytes: int = Field(..., description="Estimated host memory the job needs")
+    device_bytes: int = Field(..., description="Estimated GPU memory the job needs")
+
+class WaitingJob(BaseModel):
+    job_id: str = Field(..., description="ID of the job")
+    waited_seconds: float = Field(..., description="Seconds the job has been waiting for admission")
+    pages: int = Field(..., description="Number of pages in the job's document")
+    host_bytes: int = Field(..., description="Estimated host memory the job needs")
+    device_bytes: int = Field(..., description="Estimated GPU memory the job needs")
+
+class AdmissionStatus(BaseModel):
+    admitted_jobs: List[AdmittedJob] = Field(..., description="Jobs currently running on a worker")
+    waiting_jobs: List[WaitingJob] = Field(..., description="Jobs waiting for memory or a worker to free up, oldest first")
+    host_admitted_bytes: int = Field(..., description="Estimated host memory needed by the admitted jobs")
+    host_capacity_bytes: Optional[int] = Field(..., description="Host memory admitted jobs may share, measured while none were running", nullable=True)
+    host_free_bytes: int = Field(..., description="Host memory currently available")
+    device_admitted_bytes: int = Field(..., description="Estimated GPU memory needed by the admitted jobs")
+    device_capacity_bytes: Optional[int] = Field(..., description="GPU memory admitted jobs may share, measured while none were running", nullable=True)
+    device_free_bytes: Optional[int] = Field(..., description="GPU memory currently free, null without a GPU", nullable=True)
 
 class CosmosJSONBaseResponse(BaseModel):
     pdf_name: Optional[str] = Field(description="Name of the PDF the item was extracted from")
@@ -33,6 +67,10 @@ class CosmosJSONTextResponse(CosmosJSONBaseResponse):
     detect_cls: Optional[str] = Field(description="Initial label given to the extracted item")
     postprocess_cls: Optional[str] = Field(description="Label given to the extracted item after post-processing")
 
+class PageResult(BaseModel):
+    page_num: int = Field(..., description="Page the text segments were extracted from")
+    segments: List[CosmosJSONTextResponse] = Field(..., description="Text segments extracted from the page, in reading order")
+
 # Request Models
 
 class ExtractionType(Enum):
@@ -0,0 +1,321 @@
+"""
+Page level scheduling of COSMOS jobs inside a pipeline worker.
+A worker runs several jobs at once. The pages of each job are rendered, parsed and proposed in the page
+worker pool, then go through the detection model in batches that are filled with pages from every running
+job, so a short document is not held up behind a long one. Post-processing, aggregation and packaging of
+a job run in a thread once all of its pages have been through detection. Pages are post-processed in a thread as
+soon as they come out of detection, and their text segments recorded, so they can be streamed while the job runs.
+"""
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from collections import deque
+from fastapi.logger import logger
+from typing import Deque, Dict, List, Optional, Tuple
+import tempfile
+import shutil
+import glob
+import os
+import torch
+import process
+import util.make_parquet as mp
+from worker_pool import DETECT_BATCH_PAGES, PROPOSE_AHEAD
+from ingest.utils.metrics import stage
+from ingest.utils.result_writer import page_rows
+from util.cosmos_output_utils import page_rows_to_json
+from ingest.process.detection.src.infer import run_inference
+
+# how detection batches are shared between jobs:
+#   fair      every job with pages ready gets an equal share of each batch
+#   shortest  jobs with the fewest pages left are served first
+PAGE_SCHEDULING = os.environ.get('PAGE_SCHEDULING', 'fair')
+SCHEDULING_POLICIES = ['fair', 'shortest']
+# longest a step waits for page work to complete when no detection batch can be filled
+POLL_INTERVAL = 0.1
+# batches that have to go through without running out of GPU memory before a shrunk batch grows by a page again
+GROW_AFTER = 20
+
+
+class ScheduledJob:
+    """A job running on a worker, and the pages it has left"""
+
+    def __init__(self, job_id: str, pdf_dir: str, compress_images: bool):
+        self.job_id = job_id
+        self.pdf_dir = pdf_dir
+        self.compress_images = compress_images
+        self.page_info_dir = tempfile.mkdtemp()
+        self.cosmos_out_dir = tempfile.mkdtemp()
+        self.filename: Optional[str] = None
+        self.pdf_name: Optional[str] = None
+        self.archive_out_dir: Optional[str] = None
+        # page image paths in page order, set once the job is prepared
+        self.pages: List[str] = []
+        self.pages_meta = None
+        self.limits = None
+        # pages not yet proposed, and pages proposed or being proposed but not yet detected
+        self.unproposed: Deque[str] = deque()
+        self.proposals: Dict[str, Future] = {}
+        self.pages_done = 0
+        # post-processing of detected pages, and its results keyed by page number
+        self.streamed: List[Future] = []
+        self.postprocessed: Dict[int, dict] = {}
+        self.infofiles = {}
+        self.error: Optional[Exception] = None
+        self.prepared: Optional[Future] = None
+        self.finished: Optional[Future] = None
+
+    @property
+    def pages_left(self) -> int:
+        return len(self.unproposed) + len(self.proposals)
+
+    def ready_pages(self) -> List[str]:
+        """Pages, in page order, whose proposals are done and that can go through detection"""
+        ready = []
+        for image_path, future in self.proposals.items():
+            if not future.done():
+                break
+            ready.append(image_path)
+        return ready
+
+    def get(self, key, page_num: int) -> Optional[dict]:
+        """Post-processing results of a page, read by aggregate_pages like a result cache"""
+        return self.postprocessed.get(page_num)
+
+    def put(self, key, page_num: int, obj: dict):
+        """Pages post-processed while aggregating are not streamed, there is nothing to keep"""
+
+    def cleanup(self):
+        shutil.rmtree(self.page_info_dir, ignore_errors=True)
+        shutil.rmtree(self.cosmos_out_dir, ignore_errors=True)
+
+
+class PageScheduler:
+    """
+    Interleaves the pages of the jobs a worker holds. Only the thread that calls step uses the detection model
+    """
+
+    def __init__(self, models: dict, executor, max_jobs: int, policy: str = PAGE_SCHEDULING,
+                 batch_pages: int = DETECT_BATCH_PAGES):
+        if policy not in SCHEDULING_POLICIES:
+            raise ValueError(f'Unknown page scheduling policy {policy}, expected one of {SCHEDULING_POLICIES}')
+        self.models = models
+        self.executor = executor
+        self.policy = policy
+        # shrinks when a batch runs out of GPU memory, and grows back to max_batch_pages
+        self.batch_pages = batch_pages
+        self.max_batch_pages = batch_pages
+        self._good_batches = 0
+        self.pages_per_shard = int(os.environ.get("PAGES_PER_SHARD", 25))
+        self.jobs: List[ScheduledJob] = []
+        # preparing and finishing a job are mostly waiting on the page worker pool, or pandas and xgboost work.
+        # The threads share the postprocess model, make_parquet runs it under postprocess_lock
+        self.threads = ThreadPoolExecutor(max_workers=2 * max_jobs, thread_name_prefix='cosmos-job')
+        self._turn = 0
+
+    def busy(self) -> bool:
+        return len(self.jobs) > 0
+
+    def add(self, job_id: str, pdf_dir: str, compress_images: bool):
+        """Start running a job alongside the ones already running"""
+        job = ScheduledJob(job_id, pdf_dir, compress_images)
+        self.jobs.append(job)
+        job.prepared = self.threads.submit(self._prepare, job)
+
+    def _prepare(self, job: ScheduledJob):
+        """Render and parse the job's PDF"""
+        job.pdf_name, job.archive_out_dir = process.start_job(job.job_id)
+        pdfs = glob.glob(f'{job.pdf_dir}/*.pdf')
+        if len(pdfs) != 1:
+            raise Exception(f'Expected a single PDF in {job.pdf_dir}, found {len(pdfs)}')
+        job.filename = pdfs[0]
+        with stage('render', pdf_name=job.pdf_name, job_id=job.job_id) as record:
+            pages = mp.render_pages(self.executor, job.filename, job.page_info_dir, self.pages_per_shard)
+            record['pages'] = len(pages)
+        pages.sort(key=mp.get_page_key)
+        with stage('parse_pdf', pdf_name=job.pdf_name, job_id=job.job_id) as record:
+            job.pages_meta, job.limits = mp.parse_pdf_sharded(self.executor, job.filename, self.pages_per_shard)
+            record['pages'] = 0 if job.limits is None else len(job.limits)
+        process.record_progress(job.job_id, 0, len(pages))
+        job.pages = pages
+        job.unproposed.extend(pages)
+
+    def _finish(self, job: ScheduledJob) -> bool:
+        """
+        Post-process and aggregate a job whose pages have all been through detection, then package and record
+        its results. Returns True if the job failed due to insufficient GPU memory
+        """
+        cosmos_error = job.error
+        try:
+            if cosmos_error is None:
+                success, _, infofiles = mp.aggregate_pages(job.filename, job.pages, job.page_info_dir,
+                                                           job.cosmos_out_dir, self.models['postprocess_model'],
+                                                           self.models['pp_classes'], self.models['aggregations'],
+                                                           cache=job, key=job.job_id)
+                if not success:
+                    raise Exception(f'failed to aggregate {job.pdf_name}')
+                process.package_results(job.cosmos_out_dir, job.pdf_name, job.archive_out_dir, job.compress_images)
+        except Exception as e:
+            cosmos_error = e
+            logger.exception("Cosmos processing failed")
+        finally:
+            job.cleanup()
+        return process.complete_job(job.job_id, cosmos_error)
+
+    def _fail(self, job: ScheduledJob, error: Exception):
+        """Stop scheduling a job's pages, it is finished with the error"""
+        if job.error is None:
+            job.error = error
+        for future in job.proposals.values():
+            future.cancel()
+        job.proposals.clear()
+        job.unproposed.clear()
+
+    def _stream_pages(self, job: ScheduledJob, objs: List[dict]):
+        """Post-process pages that have been through detection, and record their text segments"""
+        try:
+            mp.postprocess_pages(job.pdf_name, objs, self.models['postprocess_model'], self.models['pp_classes'])
+            process.record_pages(job.job_id, {obj['page_num']: page_rows_to_json(page_rows(obj, True)) for obj in objs})
+        except Exception:
+            # the pages are post-processed again when the job is aggregated
+            logger.exception(f"Cosmos post-processing of pages of job {job.job_id} failed")
+            return
+        for obj in objs:
+            job.postprocessed[obj['page_num']] = {key: obj[key] for key in ('content', 'xgboost_content', 'rules_content')}
+
+    def _propose_ahead(self, job: ScheduledJob):
+        while job.unproposed and len(job.proposals) < PROPOSE_AHEAD:
+            image_path = job.unproposed.popleft()
+            job.proposals[image_path] = self.executor.submit(mp.propose_page, image_path)
+
+    def _select_batch(self) -> List[Tuple[ScheduledJob, str]]:
+        """Pick the pages of the next detection batch according to the scheduling policy"""
+        ready = [(job, job.ready_pages()) for job in self.jobs if job.finished is None]
+        ready = [(job, pages) for job, pages in ready if pages]
+        if not ready:
+            return []
+        batch = []
+        if self.policy == 'shortest':
+            for job, pages in sorted(ready, key=lambda r: r[0].pages_left):
+                batch.extend((job, page) for page in pages[:self.batch_pages - len(batch)])
+                if len(batch) == self.batch_pages:
+                    break
+            return batch
+        # fair, round robin over the jobs with pages ready, starting one job further along every batch
+        self._turn = (self._turn + 1) % len(ready)
+        ready = ready[self._turn:] + ready[:self._turn]
+        depth = 0
+        while len(batch) < self.batch_pages and any(depth < len(pages) for _, pages in ready):
+            for job, pages in ready:
+                if depth < len(pages) and len(batch) < self.batch_pages:
+                    batch.append((job, pages[depth]))
+            depth += 1
+        return batch
+
+    def _detect(self, batch: List[Tuple[ScheduledJob, str]]):
+        """Run a batch of pages from any number of jobs through the detection model in a single call"""
+        loaded = []
+        for job, image_path in batch:
+            if job.error is not None:
+                continue
+            # pages stay with their job until they are detected, so a batch that runs out of memory can be retried
+            future = job.proposals[image_path]
+            try:
+                proposals = future.result()
+                page = mp.load_page(job.filename, image_path, job.page_info_dir, job.pages_meta, job.limits,
+                                    job.infofiles)
+                if proposals is None or page is None:
+                    raise Exception(f'failed to process {job.pdf_name}')
+            except Exception as e:
+                self._fail(job, e)
+                continue
+            obj, _, padded_img = page
+            obj['proposals'] = proposals
+            # pages of different jobs share the batch, the model keys its output by this id
+            obj['id'] = f'{job.job_id}/{obj["page_num"]}'
+            loaded.append((job, obj, padded_img))
+        if not loaded:
+            return
+
+        model = self.models['model']
+        device_str = self.models['device_str']
+        detect_objs = [{'id': obj['id'], 'proposals': obj['proposals'], 'img': padded_img} for _, obj, padded_img in loaded]
+        try:
+            with stage('detect', gpu=device_str != 'cpu', pages=len(loaded),
+                       jobs=len({job.job_id for job, _, _ in loaded})) as record:
+                detected_objs, softmax_detected_objs = run_inference(model, detect_objs, self.models['model_config'], device_str)
+                record['proposals'] = sum(len(obj['proposals']) for _, obj, _ in loaded)
+                record['objects'] = sum(len(detected_objs[obj['id']]) for _, obj, _ in loaded)
+        except Exception as e:
+            if process.is_oom_error(e) and len(loaded) > 1:
+                # retry the pages in smaller batches rather than failing every job in the batch
+                torch.cuda.empty_cache()
+                self.batch_pages = max(1, len(loaded) // 2)
+                self._good_batches = 0
+                logger.warning(f"Detection of {len(loaded)} pages ran out of GPU memory, batches are now {self.batch_pages} pages")
+                return
+            logger.exception("Cosmos detection failed")
+            for job, _, _ in loaded:
+                self._fail(job, e)
+            return
+
+        self._good_batches += 1
+        if self.batch_pages < self.max_batch_pages and self._good_batches >= GROW_AFTER:
+            self.batch_pages += 1
+            self._good_batches = 0
+
+        loaded = [(job, obj, padded_img) for job, obj, padded_img in loaded if job.error is None]
+        for job, obj, _ in loaded:
+            job.proposals.pop(obj['page_path'])
+            mp.save_detections(obj, detected_objs[obj['id']], softmax_detected_objs[obj['id']], job.page_info_dir,
+                               job.infofiles)
+            job.pages_done += 1
+        for job in {job.job_id: job for job, _, _ in loaded}.values():
+            process.record_progress(job.job_id, job.pages_done, len(job.pages))
+            job.streamed.append(self.threads.submit(self._stream_pages, job, [obj for j, obj, _ in loaded if j is job]))
+
+    def step(self) -> List[Tuple[str, bool]]:
+        """
+        Run one round of scheduling: start proposals, run a detection batch, and hand jobs with no pages left to
+        be finished. Returns (job id, out of GPU memory) for each job that finished since the last step
+        """
+        finished = []
+        for job in list(self.jobs):
+            if job.finished is not None and job.finished.done():
+                self.jobs.remove(job)
+                try:
+                    finished.append((job.job_id, job.finished.result()))
+                except Exception as e:
+                    # recording the outcome of the job failed, there is nothing left to retry
+                    logger.exception(f"Cosmos job {job.job_id} could not be completed")
+                    finished.append((job.job_id, False))
+
+        for job in self.jobs:
+            if job.finished is not None or not job.prepared.done():
+                continue
+            if job.prepared.exception() is not None:
+                self._fail(job, job.prepared.exception())
+            self._propose_ahead(job)
+
+        batch = self._select_batch()
+        if batch:
+            self._detect(batch)
+        else:
+            # nothing to detect, wait for any page work to complete instead of spinning
+            pending = [job.prepared for job in self.jobs if not job.prepared.done()]
+            pending += [future for job in self.jobs for future in job.proposals.values()]
+            pending += [future for job in self.jobs for future in job.streamed if not future.done()]
+            pending += [job.finished for job in self.jobs if job.finished is not None]
+            if pending:
+                wait(pending, timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED)
+
+        for job in self.jobs:
+            if (job.finished is None and job.prepared.done() and job.pages_left == 0
+                    and all(future.done() for future in job.streamed)):
+                job.finished = self.threads.submit(self._finish, job)
+        return finished
+
+    def shutdown(self):
+        for job in self.jobs:
+            for future in [job.prepared, job.finished, *job.proposals.values(), *job.streamed]:
+                if future is not None:
+                    future.cancel()
+            job.cleanup()
+        self.threads.shutdown(wait=False)
@@ -6,12 +6,20 @@ which leads to issues with locking the main thread.
 import os
 import tempfile
 import util.make_parquet as mp
-from util.cosmos_output_utils import convert_parquet_to_json_file, PARQUET_SUFFIXES
+from util.cosmos_output_utils import convert_parquet_to_json_file, sort_page_segments, PARQUET_SUFFIXES
+from util.result_store import write_result_store
+from ingest.utils.metrics import set_context, stage
 from fastapi.logger import logger
-from db.processing_session_types import CosmosSessionJob
+from fastapi.encoders import jsonable_encoder
+from model.models import CosmosJSONTextResponse
+from db.processing_session_types import CosmosSessionJob, CosmosPageResult
 from db.db import SessionLocal
+from sqlalchemy import select
+from collections import defaultdict
+from typing import Dict, List
 import torch
 import glob
+import json
 from work_queue import OOM_ERROR_EXIT_CODE
 
 import shutil
@@ -33,45 +41,106 @@ OOM_ERROR_MESSAGES = [
     'CUDNN_STATUS_NOT_INITIALIZED'
 ]
 
+def is_oom_error(error: Exception) -> bool:
+    """Whether an error was caused by insufficient GPU memory"""
+    return error is not None and any([e in str(error) for e in OOM_ERROR_MESSAGES])
+
 def _get_parquet_files_to_convert(cosmos_out_dir, pdf_name):
     return [f'{cosmos_out_dir}/{pdf_name}{suffix}.parquet' for suffix in PARQUET_SUFFIXES]
 
-def process_document(pdf_dir: str, job_id: str, compress_images: bool = True):
+def start_job(job_id: str):
+    """Mark a job as started, and return its PDF name and the path its output archive is written to"""
+    with SessionLocal() as session:
+        job = session.get(CosmosSessionJob, job_id)
+        archive_out_dir = f'{job.output_dir}/{job.pdf_name}_cosmos_output'
+        pdf_name = job.pdf_name
+        job.is_started = True
+        session.commit()
+    return pdf_name, archive_out_dir
+
+def record_progress(job_id: str, pages_done: int, pages_total: int):
+    """Record how many of a job's pages have been through detection"""
+    with SessionLocal() as session:
+        job = session.get(CosmosSessionJob, job_id)
+        job.pages_done = pages_done
+        job.pages_total = pages_total
+        session.commit()
+
+def record_pages(job_id: str, pages: Dict[int, List[dict]]):
+    """
+    Record the text segments of pages that have been post-processed, keyed by page number.
+    Pages recorded by an earlier attempt at the job are not recorded again
+    """
+    with SessionLocal() as session:
+        recorded = set(session.scalars(select(CosmosPageResult.page_num).where(CosmosPageResult.job_id == job_id)))
+        for page_num, segments in sorted(pages.items()):
+            if page_num in recorded:
+                continue
+            segments = [CosmosJSONTextResponse(**s) for s in sort_page_segments(segments)]
+            session.add(CosmosPageResult(job_id, page_num, json.dumps(jsonable_encoder(segments))))
+        session.commit()
+
+def record_pages_from_output(job_id: str, cosmos_out_dir: str, pdf_name: str):
+    """Record the text segments of every page of a job from its JSON output, once the whole job is done"""
+    with open(f'{cosmos_out_dir}/{pdf_name}.json') as f:
+        segments = json.load(f)
+    pages = defaultdict(list)
+    for segment in segments:
+        pages[segment['page_num']].append(segment)
+    record_pages(job_id, pages)
+
+def package_results(cosmos_out_dir: str, pdf_name: str, archive_out_dir: str, compress_images: bool = True):
+    """
+    Convert the parquet output of a job to JSON, zip it up with its images, and store the results
+    that are served by the /result endpoints
+    """
+    if compress_images:
+        mp.resize_files(cosmos_out_dir)
+    with stage('parquet_to_json', pdf_name=pdf_name):
+        for parquet_path in _get_parquet_files_to_convert(cosmos_out_dir, pdf_name):
+            convert_parquet_to_json_file(parquet_path)
+    shutil.make_archive(archive_out_dir, "zip", cosmos_out_dir)
+    with stage('store_results', pdf_name=pdf_name):
+        write_result_store(cosmos_out_dir, pdf_name, os.path.dirname(archive_out_dir))
+
+def complete_job(job_id: str, cosmos_error: Exception = None):
+    """
+    Record the outcome of a job.
+    Returns True if the job failed due to insufficient GPU memory and should be retried
+    """
+    is_oom = is_oom_error(cosmos_error)
+
+    with SessionLocal() as session:
+        job = session.get(CosmosSessionJob, job_id)
+        job.is_completed = not is_oom # retry jobs that failed due to an OOM error
+        job.error = None if is_oom or cosmos_error is None else str(cosmos_error)
+        session.commit()
+
+    return is_oom
+
+def process_document(pdf_dir: str, job_id: str, compress_images: bool = True, models: dict = None, executor = None):
     """
     Run a single document through the COSMOS pipeline.
-    TODO: This adds the significant overhead of loading the model into memory with each run
+    Models and the page worker pool are loaded and started for the document, unless the caller
+    passes in the ones it holds.
+    Returns True if the job failed due to insufficient GPU memory and should be retried
     """
     with tempfile.TemporaryDirectory() as page_info_dir, tempfile.TemporaryDirectory() as cosmos_out_dir:
-        with SessionLocal() as session:
-            job = session.get(CosmosSessionJob, job_id)
-            archive_out_dir = f'{job.output_dir}/{job.pdf_name}_cosmos_output'
-            pdf_name = job.pdf_name
-            job.is_started = True
-            
-            session.commit()
+        pdf_name, archive_out_dir = start_job(job_id)
+        # every metrics record written while running the job carries its id
+        set_context(job_id=job_id)
 
         cosmos_error : Exception = None
         try: 
-            mp.main_process(pdf_dir, page_info_dir, cosmos_out_dir)
-            if compress_images:
-                mp.resize_files(cosmos_out_dir)
-            for parquet_path in _get_parquet_files_to_convert(cosmos_out_dir, pdf_name):
-                convert_parquet_to_json_file(parquet_path)
-            shutil.make_archive(archive_out_dir, "zip", cosmos_out_dir)
+            mp.main_process(pdf_dir, page_info_dir, cosmos_out_dir, models=models, executor=executor)
+            package_results(cosmos_out_dir, pdf_name, archive_out_dir, compress_images)
+            # pages are only post-processed once the whole document has been through detection here
+            record_pages_from_output(job_id, cosmos_out_dir, pdf_name)
         except Exception as e:
             cosmos_error = e
             logger.exception("Cosmos processing failed")
 
-        is_oom_error = cosmos_error and any([e in str(cosmos_error) for e in OOM_ERROR_MESSAGES])
-
-        with SessionLocal() as session:
-            job = session.get(CosmosSessionJob, job_id)
-            job.is_completed = not is_oom_error # retry jobs that failed due to an OOM error
-            job.error = None if is_oom_error or cosmos_error is None else str(cosmos_error)
-            session.commit()
-
-        if is_oom_error:
-            exit(OOM_ERROR_EXIT_CODE)
+        return complete_job(job_id, cosmos_error)
 
 
 if __name__ == '__main__':
@@ -81,4 +150,5 @@ if __name__ == '__main__':
     parser.add_argument("job_id")
     parser.add_argument("compress_images", type=lambda v: v.lower() == 'true', default=True)
     args = parser.parse_args()
-    process_document(args.pdf_dir, args.job_id, args.compress_images)
+    if process_document(args.pdf_dir, args.job_id, args.compress_images):
+        exit(OOM_ERROR_EXIT_CODE)
@@ -2,12 +2,29 @@ from fastapi import APIRouter, Form, File, UploadFile, HTTPException
 from util.cosmos_output_utils import *
 from db.db import get_job_details
 from healthcheck.annotation_metrics import *
+from model.models import WorkerStatus, AdmissionStatus
+import work_queue
 from typing import List
 import shutil
 from tempfile import TemporaryDirectory
 
 router = APIRouter(prefix="/healthcheck")
 
+@router.get("/workers")
+def get_worker_status() -> List[WorkerStatus]:
+    """
+    Return the state of each long-lived COSMOS pipeline worker
+    """
+    return [WorkerStatus(**w.status()) for w in work_queue.pipeline_workers]
+
+@router.get("/admission")
+def get_admission_status() -> AdmissionStatus:
+    """
+    Return the jobs currently admitted to the COSMOS pipeline workers, their estimated memory needs,
+    and the host and GPU memory they are admitted against
+    """
+    return AdmissionStatus(**work_queue.admission.status())
+
 @router.post("/evaluate/{job_id}")
 def evaluate_results(job_id: str, expected_bounds: List[AnnotationBounds]) -> List[DocumentAnnotationComparison]:
     """
@@ -1,16 +1,25 @@
 import tempfile
 import os
 import shutil
-from fastapi import UploadFile, File, Form, HTTPException, Request, APIRouter
-from fastapi.responses import FileResponse, Response
+from fastapi import UploadFile, File, Form, HTTPException, Request, APIRouter, Header, Query
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import run_in_threadpool
+from typing import Optional
+import asyncio
+import json
 import uuid
 from util.cosmos_output_utils import *
-from model.models import JobCreationResponse, JobStatus, CosmosJSONTextResponse, CosmosJSONImageResponse, ExtractionType
-from db.db import SessionLocal, CosmosSessionJob, get_cached_job_for_pdf, get_job_details
+from util.result_store import ResultStore
+from model.models import JobCreationResponse, JobStatus, CosmosJSONTextResponse, CosmosJSONImageResponse, ExtractionType, PageResult
+from db.db import SessionLocal, CosmosSessionJob, get_cached_job_for_pdf, get_job_details, get_page_results
 from work_queue import queue
 
 router = APIRouter(prefix="/process")
 
+# how often a stream of page results checks for newly recorded pages
+PAGE_POLL_INTERVAL = 0.5
+
 def _build_process_response(message, job_id, request_url):
     """Return the ID of a created job alongside the URLs that a client can use to query that job's status"""
     return JobCreationResponse(
@@ -68,6 +77,17 @@ async def process_document(
 
     return _build_process_response("PDF Processing in Background", job_id, request.url)
 
+def _job_status(job: CosmosSessionJob):
+    return JobStatus(
+        job_started=job.is_started,
+        job_completed=job.is_completed,
+        time_in_queue=job.time_in_queue,
+        time_processing=job.time_processing,
+        error=job.error,
+        pages_total=job.pages_total,
+        pages_done=job.pages_done or 0
+    )
+
 @router.get("/{job_id}/status")
 def get_processing_status(job_id: str) -> JobStatus:
     """
@@ -79,13 +99,52 @@ def get_processing_status(job_id: str) -> JobStatus:
         if not job:
             raise HTTPException(status_code=404, detail="Job not found")
         
-        return JobStatus(
-            job_started=job.is_started,
-            job_completed=job.is_completed,
-            time_in_queue=job.time_in_queue,
-            time_processing=job.time_processing,
-            error=job.error
-        )
+        return _job_status(job)
+
+def _read_job_status(job_id: str) -> Optional[JobStatus]:
+    with SessionLocal() as session:
+        job : CosmosSessionJob = session.get(CosmosSessionJob, job_id)
+        return _job_status(job) if job else None
+
+async def _page_events(job_id: str, cursor: Optional[int]):
+    """
+    Server-sent events for the pages of a job, as they are recorded, followed by the status of the job once
+    it has finished. The id of each page event is the cursor to resume the stream from
+    """
+    while True:
+        # the job's status is read first, all of its pages are recorded before it finishes
+        status = await run_in_threadpool(_read_job_status, job_id)
+        pages = await run_in_threadpool(get_page_results, job_id, cursor)
+        for page in pages:
+            yield f'id: {page.id}\nevent: page\ndata: {{"page_num": {page.page_num}, "segments": {page.segments}}}\n\n'
+            cursor = page.id
+        if pages:
+            continue
+        if status is None:
+            yield 'event: error\ndata: {"detail": "Job not found"}\n\n'
+            return
+        if status.job_completed or status.error is not None:
+            yield f'event: complete\ndata: {json.dumps(jsonable_encoder(status))}\n\n'
+            return
+        await asyncio.sleep(PAGE_POLL_INTERVAL)
+
+@router.get("/{job_id}/result/pages", response_model=PageResult, responses={200: {"content": {"text/event-stream": {}}}})
+def stream_processing_result_pages(
+    job_id: str,
+    cursor: Optional[int] = Query(None, description="Cursor of the last page already received, the stream resumes after it"),
+    last_event_id: Optional[int] = Header(None, description="Set by EventSource clients when they reconnect, used as the cursor")
+    ) -> StreamingResponse:
+    """
+    Stream the text segments of each page of a job as [server-sent events](https://html.spec.whatwg.org/multipage/server-sent-events.html)
+    while the job is still running. Each page is sent as a `page` event as soon as it has been processed, in the order pages
+    complete, with the page's cursor as the event id. Once the job has finished, a final `complete` event carries its status.
+    Pages already received can be skipped by passing the cursor of the last of them, or the `Last-Event-ID` header
+    """
+    with SessionLocal() as session:
+        if not session.get(CosmosSessionJob, job_id):
+            raise HTTPException(status_code=404, detail="Job not found")
+    return StreamingResponse(_page_events(job_id, cursor if cursor is not None else last_event_id),
+                             media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 @router.get("/{job_id}/result")
 def get_processing_result(job_id: str) -> FileResponse:
@@ -102,9 +161,8 @@ def get_processing_result_text_segments(job_id: str, request: Request) -> List[C
     """
     Return the text segments extracted by COSMOS and their bounding boxes as a list of JSON objects
     """
-    job = get_job_details(job_id)
-    response_json = convert_parquet_to_json(job, f'{job.pdf_name}.parquet', request)
-    return [ CosmosJSONTextResponse(**p) for p in response_json ]
+    store = ResultStore(get_job_details(job_id))
+    return store.response(store.text(), request)
 
 @router.get("/{job_id}/result/extractions/{extraction_type}")
 def get_processing_result_extraction(job_id: str, extraction_type: ExtractionType, request: Request) -> List[CosmosJSONImageResponse]:
@@ -112,17 +170,17 @@ def get_processing_result_extraction(job_id: str, extraction_type: ExtractionTyp
     Return COSMOS figure/table/equation extractions and their bounding boxes as a list of JSON objects, 
     as well as links to their images
     """
-    job = get_job_details(job_id)
-    response_json = convert_parquet_to_json(job, f'{job.pdf_name}_{extraction_type.value}.parquet', request)
-    return [ CosmosJSONImageResponse(**p) for p in response_json ]
+    store = ResultStore(get_job_details(job_id))
+    return store.response(store.extractions(extraction_type.value, request), request)
 
 
 @router.get("/{job_id}/result/images/{image_path}")
-def get_processing_result_image(job_id: str, image_path: str) -> Response:
+def get_processing_result_image(job_id: str, image_path: str, request: Request) -> FileResponse:
     """
-    Extract a single image from the zip output of the given job and return it with the appropriate mimetype
+    Return a single image extracted from the given job with the appropriate mimetype
     """
-    job = get_job_details(job_id)
-    mime_type = 'image/png' if image_path.endswith('.png') else 'image/jpeg'
-    with extract_file_from_job(job, image_path) as image:
-        return Response(content=image.read(), media_type=mime_type)
+    store = ResultStore(get_job_details(job_id))
+    name = store.image(image_path)
+    if name is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return store.response(name, request)
@@ -1,7 +1,7 @@
 from apscheduler.schedulers.background import BackgroundScheduler
 import shutil
 from datetime import datetime, timedelta
-from db.processing_session_types import CosmosSessionJob
+from db.processing_session_types import CosmosSessionJob, CosmosPageResult
 from db.db import SessionLocal
 from sqlalchemy import select, delete, ScalarResult
 from fastapi.logger import logger
@@ -20,6 +20,10 @@ def clean_all_expired_jobs():
 
         temporary_dirs = [job.output_dir for job in to_delete]
 
+        delete_pages = delete(CosmosPageResult).where(CosmosPageResult.job_id.in_(
+            select(CosmosSessionJob.id).where(CosmosSessionJob.created < expiration_time)
+        ))
+        session.execute(delete_pages)
         delete_jobs = delete(CosmosSessionJob).where(CosmosSessionJob.created < expiration_time)
         session.execute(delete_jobs)
         session.commit()
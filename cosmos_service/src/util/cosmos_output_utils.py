@@ -1,11 +1,10 @@
 """
 Collection of miscellaneous utilities for working with the zipfile output of a COSMOS job.
-Used to serve various /results endpoints
+Used to prepare the output that is served by the /results endpoints
 """
 
 from zipfile import ZipFile
 from .parquet_to_json import parquet_to_json
-from fastapi import Request
 import json
 from os import path
 from typing import List
@@ -26,11 +25,6 @@ def read_job_zip_file(job):
     """ Read the output zip file of a job """
     return ZipFile(f'{job.output_dir}/{job.pdf_name}_cosmos_output.zip')
 
-def extract_file_from_job(job, file_path: str):
-    """ Extract the specified file from the specified completed job """
-    with read_job_zip_file(job) as zipf:
-        return zipf.open(file_path, 'r')
-
 def replace_url_suffix(request_url, suffix):
     """Replace the given request_url after /process/ with the given suffix"""
     return re.sub("/process/.*", f"/process/{suffix}", f"{request_url}")
@@ -62,21 +56,25 @@ def _get_parquet_read_parameters(parquet_path: str):
     
     return DEFAULT_PARQUET_COLUMN_NAMES
 
-def convert_parquet_to_json(job, parquet_path: str, request: Request):
+def page_rows_to_json(rows: List[dict]):
     """
-    Convert a parquet file to JSON using the SKEMA bounding box sorting method, choosing columns
-    to extract based on which parquet file is being parsed, then correct extracted
-    image paths to match the full request URL
+    Convert the result rows of a single page, before they are written to parquet, to the
+    JSON that the text segments of a job are served as
     """
-    
-    image_base_url = replace_url_suffix(request.url, f"{job.id}/result/images")
-    (bb_column, page_column, exclude) = _get_parquet_read_parameters(parquet_path)
-    
-    with extract_file_from_job(job, parquet_path) as parquet:
-        json_data = parquet_to_json(parquet, bb_column, page_column) or []
-
-    return [_update_json_entry(e, image_base_url, bb_column, page_column, exclude) for e in json_data]
-
+    return [{
+        'pdf_name': row['pdf_name'],
+        'page_num': row['page_num'],
+        'bounding_box': row['bounding_box'],
+        'detect_cls': row['classes'][0],
+        'detect_score': row['scores'][0],
+        'content': row['content'],
+        'postprocess_cls': row['postprocess_cls'],
+        'postprocess_score': row['postprocess_score'],
+    } for row in rows]
+
+def sort_page_segments(segments: List[dict]):
+    """Sort the segments of a single page in the order parquet_to_json sorts a whole document"""
+    return sorted(segments, key=lambda s: (s['bounding_box'][0] // 500, s['bounding_box'][1]))
 
 def convert_parquet_to_json_file(parquet_path: str):
     """
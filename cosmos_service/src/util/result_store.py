@@ -0,0 +1,175 @@
+"""
+Store of the results of completed COSMOS jobs, written once when a job completes and served as files
+by the /result endpoints.
+Each job's store holds the JSON of its text segments and of each extraction type, its extracted images,
+and the size and ETag of every file, so repeated requests neither open the job's zip nor re-read its parquet.
+"""
+
+from fastapi import Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import FileResponse, Response
+from model.models import CosmosJSONTextResponse, CosmosJSONImageResponse
+from .cosmos_output_utils import read_job_zip_file, replace_url_suffix, PARQUET_COLUMN_NAMES
+from typing import Optional
+from tempfile import TemporaryDirectory
+import threading
+import hashlib
+import shutil
+import json
+import glob
+import os
+import re
+
+METADATA_FILE = 'metadata.json'
+IMAGE_DIR = 'images'
+TEXT_RESULT = 'text'
+IMAGE_SUFFIXES = ('.png', '.jpg')
+MEDIA_TYPES = {'.json': 'application/json', '.png': 'image/png', '.jpg': 'image/jpeg'}
+
+# stores built from a job's zip, for jobs that completed before results were stored, are built by one request at a time
+_build_lock = threading.Lock()
+
+
+def result_store_dir(output_dir: str, pdf_name: str) -> str:
+    return f'{output_dir}/{pdf_name}_cosmos_results'
+
+
+def _etag(file_path: str) -> str:
+    with open(file_path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _write_json(file_path: str, data):
+    """Write a JSON file in place of any existing one, so a reader never sees it half written"""
+    tmp_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, file_path)
+
+
+def write_result_store(cosmos_out_dir: str, pdf_name: str, output_dir: str):
+    """
+    Materialize the results of a job from its output directory, once the parquet output has been converted to JSON.
+    Text segments are stored as they are returned. Extractions link to their images with a URL that depends on the
+    request, so they are stored with bare image names and completed per base URL when first requested
+    """
+    store_dir = result_store_dir(output_dir, pdf_name)
+    os.makedirs(f'{store_dir}/{IMAGE_DIR}', exist_ok=True)
+
+    with open(f'{cosmos_out_dir}/{pdf_name}.json') as f:
+        text = json.load(f)
+    _write_json(f'{store_dir}/{TEXT_RESULT}.json', jsonable_encoder([CosmosJSONTextResponse(**e) for e in text]))
+    for extraction_type in PARQUET_COLUMN_NAMES.keys():
+        shutil.copyfile(f'{cosmos_out_dir}/{pdf_name}_{extraction_type}.json', f'{store_dir}/{extraction_type}.template.json')
+
+    for image_path in glob.glob(f'{cosmos_out_dir}/*'):
+        if image_path.endswith(IMAGE_SUFFIXES):
+            shutil.copyfile(image_path, f'{store_dir}/{IMAGE_DIR}/{os.path.basename(image_path)}')
+
+    files = {}
+    for file_path in glob.glob(f'{store_dir}/*.json') + glob.glob(f'{store_dir}/{IMAGE_DIR}/*'):
+        name = os.path.relpath(file_path, store_dir)
+        if name != METADATA_FILE:
+            files[name] = {'size': os.path.getsize(file_path), 'etag': _etag(file_path)}
+    # written last, a store without metadata is incomplete
+    _write_json(f'{store_dir}/{METADATA_FILE}', {'files': files})
+
+
+class ResultStore:
+    """The stored results of a single completed job"""
+
+    def __init__(self, job):
+        self.job = job
+        self.store_dir = result_store_dir(job.output_dir, job.pdf_name)
+        metadata_path = f'{self.store_dir}/{METADATA_FILE}'
+        if not os.path.exists(metadata_path):
+            with _build_lock:
+                if not os.path.exists(metadata_path):
+                    self._build_from_archive()
+        with open(metadata_path) as f:
+            self.files = json.load(f)['files']
+
+    def _build_from_archive(self):
+        """Jobs completed before results were stored only have their zip, build their store from it once"""
+        with TemporaryDirectory() as cosmos_out_dir, read_job_zip_file(self.job) as zipf:
+            zipf.extractall(cosmos_out_dir)
+            write_result_store(cosmos_out_dir, self.job.pdf_name, self.job.output_dir)
+
+    def text(self) -> str:
+        return f'{TEXT_RESULT}.json'
+
+    def extractions(self, extraction_type: str, request: Request) -> str:
+        """
+        The stored extractions of the given type with image links under the request's base URL,
+        written the first time that base URL asks for them
+        """
+        template = self.files[f'{extraction_type}.template.json']
+        image_base_url = replace_url_suffix(request.url, f"{self.job.id}/result/images")
+        url_hash = hashlib.sha1(image_base_url.encode()).hexdigest()[:12]
+        name = f'{extraction_type}.{url_hash}.json'
+        if name not in self.files:
+            file_path = f'{self.store_dir}/{name}'
+            if not os.path.exists(file_path):
+                with open(f'{self.store_dir}/{extraction_type}.template.json') as f:
+                    extractions = json.load(f)
+                for e in extractions:
+                    if e.get('img_pth') is not None:
+                        e['img_pth'] = os.path.join(image_base_url, e['img_pth'])
+                _write_json(file_path, jsonable_encoder([CosmosJSONImageResponse(**e) for e in extractions]))
+            # the content follows from the template and the base URL alone
+            self.files[name] = {'size': os.path.getsize(file_path), 'etag': f"{template['etag']}-{url_hash}"}
+        return name
+
+    def image(self, image_path: str) -> Optional[str]:
+        name = f'{IMAGE_DIR}/{image_path}'
+        return name if name in self.files else None
+
+    def response(self, name: str, request: Request) -> Response:
+        """
+        Serve a stored file. Answers a conditional GET whose ETag still matches with 304, and a single
+        byte range with 206
+        """
+        file_path = f'{self.store_dir}/{name}'
+        size = self.files[name]['size']
+        etag = f'"{self.files[name]["etag"]}"'
+        headers = {'ETag': etag, 'Accept-Ranges': 'bytes', 'Cache-Control': 'no-cache'}
+        media_type = MEDIA_TYPES.get(os.path.splitext(name)[1], 'application/octet-stream')
+
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match is not None and (if_none_match.strip() == '*' or etag in [t.strip() for t in if_none_match.split(',')]):
+            return Response(status_code=304, headers=headers)
+
+        byte_range = _parse_range(request.headers.get('range'), size)
+        if_range = request.headers.get('if-range')
+        if byte_range is not None and (if_range is None or if_range.strip() == etag):
+            if byte_range == ():
+                return Response(status_code=416, headers={**headers, 'Content-Range': f'bytes */{size}'})
+            start, end = byte_range
+            with open(file_path, 'rb') as f:
+                f.seek(start)
+                content = f.read(end - start + 1)
+            return Response(content=content, status_code=206, media_type=media_type,
+                            headers={**headers, 'Content-Range': f'bytes {start}-{end}/{size}'})
+
+        return FileResponse(file_path, media_type=media_type, headers=headers)
+
+
+def _parse_range(range_header: Optional[str], size: int):
+    """
+    The inclusive (start, end) of a single byte range, () if it cannot be satisfied, or None if the
+    header is missing or asks for several ranges, in which case the whole file is served
+    """
+    if range_header is None:
+        return None
+    match = re.fullmatch(r'\s*bytes=(\d*)-(\d*)\s*', range_header)
+    if match is None or match.group(1) == match.group(2) == '':
+        return None
+    first, last = match.groups()
+    if first == '':
+        # the last n bytes
+        start, end = max(0, size - int(last)), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        return ()
+    return start, end
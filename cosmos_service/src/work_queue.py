@@ -1,38 +1,113 @@
 from fastapi.logger import logger
-from typing import List
+from typing import List, Set
+from worker_pool import PipelineWorker, WorkerCrashed, page_workers_per_worker
+from admission import AdmissionController, JobEstimate
+from db.processing_session_types import CosmosSessionJob
+from db.db import SessionLocal
 import asyncio
-import sys
 
 queue = asyncio.Queue()
 workers : List[asyncio.Task] = None
+pipeline_workers : List[PipelineWorker] = []
+admission = AdmissionController(pipeline_workers)
+# jobs waiting for admission or running on a worker
+running : Set[asyncio.Task] = set()
 
-COSMOS_SCRIPT = 'process.py'
-
-# if a task fails due to the GPU being out of memory, wait for a while and then try again
-OOM_SLEEP_TIME = 30
+# exit code of process.py when run on its own, for a job that failed due to the GPU being out of memory
 OOM_ERROR_EXIT_CODE = 2
 
-async def _cosmos_worker(work_queue: asyncio.Queue):
+# how often workers are checked for being alive and responsive
+HEALTH_CHECK_INTERVAL = 30
+
+
+def _fail_job(job_id: str, error: str):
+    """Record a job that cannot be run"""
+    with SessionLocal() as session:
+        job = session.get(CosmosSessionJob, job_id)
+        if job is not None:
+            job.is_completed = True
+            job.error = error
+            session.commit()
+
+
+async def _run_job(estimate: JobEstimate, job_output_dir: str, job_id: str, compress_images: bool):
     """
-    Cosmos worker process. Continually poll from the work queue for new parameters to the pipeline,
-    and run the cosmos pipeline in a separate process. A separate process is necessary to avoid I/O 
-    blocking issues in Python's async framework
+    Wait for the job to be admitted, then run it on the worker it was admitted to. A job that runs out of
+    GPU memory goes back on the queue, where it waits for admission with a larger estimate
     """
+    is_oom_error = False
+    try:
+        worker = await admission.admit(job_id, estimate)
+        generation = worker.generation
+        try:
+            is_oom_error = await worker.run(job_output_dir, job_id, compress_images)
+        except WorkerCrashed as e:
+            logger.error(f"COSMOS worker crashed while running job {job_id}: {e}")
+            _fail_job(job_id, f"COSMOS worker crashed: {e}")
+            await worker.restart(generation)
+        finally:
+            await admission.release(job_id)
+
+        if not is_oom_error:
+            admission.forget(job_id)
+        elif admission.record_oom(job_id):
+            logger.warning(f"COSMOS job {job_id} ran out of GPU memory, requeueing it")
+            await queue.put((job_output_dir, job_id, compress_images))
+        else:
+            _fail_job(job_id, "COSMOS job ran out of GPU memory")
+    finally:
+        queue.task_done()
+
+
+async def _dispatch(work_queue: asyncio.Queue):
+    """
+    Cosmos dispatcher. Continually poll from the work queue for new parameters to the pipeline, and
+    start each job on a long-lived worker process once the admission controller has room for it.
+    Every queued job waits for admission on its own, so a job that does not fit yet does not hold back smaller ones
+    """
+    loop = asyncio.get_running_loop()
     while True:
         (job_output_dir, job_id, compress_images) = await work_queue.get()
-        proc = await asyncio.create_subprocess_exec(sys.executable, COSMOS_SCRIPT, job_output_dir, job_id, str(compress_images))
-        result = await proc.wait()
-        queue.task_done()
-        
-        if result == OOM_ERROR_EXIT_CODE:
-            await asyncio.sleep(OOM_SLEEP_TIME)
-            await queue.put((job_output_dir, job_id, compress_images))
+        try:
+            estimate : JobEstimate = await loop.run_in_executor(None, admission.estimate, job_output_dir, job_id)
+        except Exception as e:
+            logger.exception(f"Unable to read the PDF of COSMOS job {job_id}")
+            _fail_job(job_id, f"Unable to read the PDF: {e}")
+            queue.task_done()
+            continue
+        task = asyncio.create_task(_run_job(estimate, job_output_dir, job_id, compress_images))
+        running.add(task)
+        task.add_done_callback(running.discard)
+
+
+async def _health_check(check_interval: float = HEALTH_CHECK_INTERVAL):
+    """Periodically check every worker, and restart the ones that are unresponsive or dead"""
+    while True:
+        await asyncio.sleep(check_interval)
+        for worker in pipeline_workers:
+            generation = worker.generation
+            if not await worker.check():
+                logger.error(f"COSMOS worker {worker.name} failed its health check, restarting it")
+                await worker.restart(generation)
 
 
 def setup_workers(worker_count):
     global workers
     """
-    Initialize FastAPI and add variables
+    Start the long-lived pipeline workers, the dispatcher that feeds them from the queue, and their health check
     """
-    logger.info(f"Creating {worker_count} work queues for COSMOS processing")
-    workers = [asyncio.create_task(_cosmos_worker(queue)) for _ in range(worker_count)]
+    page_workers = page_workers_per_worker(worker_count)
+    logger.info(f"Creating {worker_count} work queues for COSMOS processing, with {page_workers} page workers each")
+    for i in range(worker_count):
+        worker = PipelineWorker(f'cosmos-worker-{i}', page_workers=page_workers)
+        worker.start()
+        pipeline_workers.append(worker)
+    workers = [asyncio.create_task(_dispatch(queue)), asyncio.create_task(_health_check())]
+
+
+def stop_workers():
+    """Cancel the dispatcher and running jobs, and stop the worker processes"""
+    for task in (workers or []) + list(running):
+        task.cancel()
+    for worker in pipeline_workers:
+        worker.stop()
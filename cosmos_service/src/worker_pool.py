@@ -0,0 +1,261 @@
+"""
+Long-lived COSMOS pipeline workers.
+Each worker is a separate process that loads the detection and post-processing models and starts its
+page worker pool once, then runs the jobs it receives over a pipe until it is stopped. A worker runs
+several jobs at once and interleaves their pages (see page_scheduler). Workers are health checked
+periodically, and restarted if they crash or stop answering.
+"""
+from fastapi.logger import logger
+from typing import Dict, List, Optional
+import multiprocessing
+import asyncio
+import time
+import os
+
+# messages sent to a worker
+JOB = 'job'
+PING = 'ping'
+STOP = 'stop'
+# messages sent back by a worker
+READY = 'ready'
+PONG = 'pong'
+DONE = 'done'
+
+# seconds a starting worker may take to load its models
+READY_TIMEOUT = 600
+# seconds an idle worker may take to answer a health check
+PING_TIMEOUT = 10
+# seconds a busy worker may go without sending anything back. It answers pings between the steps of its page
+# scheduler, so only a step that hangs, e.g. on a stuck GPU call, keeps it silent this long
+STALL_TIMEOUT = int(os.environ.get('WORKER_STALL_TIMEOUT', 300))
+# seconds to wait before starting a worker that crashed again, so a broken model does not spin
+RESTART_DELAY = 10
+# most jobs a worker runs at once, the admission controller decides how many it gets
+JOBS_PER_WORKER = int(os.environ.get('JOBS_PER_WORKER', 4))
+# pages per detection batch, filled across the jobs of a worker
+DETECT_BATCH_PAGES = int(os.environ.get('DETECT_BATCH_PAGES', 4))
+# proposals kept in flight per job, so a long job does not fill the page worker pool ahead of newer jobs
+PROPOSE_AHEAD = int(os.environ.get('PROPOSE_AHEAD', 2 * DETECT_BATCH_PAGES))
+
+
+def page_workers_per_worker(worker_count: int) -> int:
+    """
+    Size of each worker's page worker pool. PAGE_WORKERS if it is set, otherwise the workers
+    split the host's CPUs between them, so their pools together do not oversubscribe it
+    """
+    if 'PAGE_WORKERS' in os.environ:
+        return int(os.environ['PAGE_WORKERS'])
+    return max(1, (os.cpu_count() or 1) // max(1, worker_count))
+
+
+class WorkerCrashed(Exception):
+    """A worker process exited, or stopped answering"""
+
+
+def _serve(conn, max_jobs, page_workers):
+    """
+    Body of a worker process. Load the models once, then run jobs until told to stop
+    """
+    # process sets the environment that names the models, so it is imported before they are loaded
+    import process
+    import util.make_parquet as mp
+    import torch
+    from page_scheduler import PageScheduler
+    models = mp.load_models()
+    executor = mp.page_executor(page_workers)
+    scheduler = PageScheduler(models, executor, max_jobs)
+    conn.send((READY, os.getpid()))
+    try:
+        while True:
+            # only block on the pipe when there are no pages to work on
+            while conn.poll(0 if scheduler.busy() else None):
+                message = conn.recv()
+                if message[0] == STOP:
+                    return
+                if message[0] == PING:
+                    conn.send((PONG,))
+                    continue
+                _, job_output_dir, job_id, compress_images = message
+                scheduler.add(job_id, job_output_dir, compress_images)
+            for job_id, is_oom_error in scheduler.step():
+                if is_oom_error and torch.cuda.is_available():
+                    # hand back what the failed job held, the job is retried once memory frees up
+                    torch.cuda.empty_cache()
+                conn.send((DONE, job_id, is_oom_error))
+    except EOFError:
+        # the service went away
+        pass
+    finally:
+        scheduler.shutdown()
+        executor.shutdown()
+
+
+def _recv(conn, proc, name, timeout: Optional[float]):
+    """Blocking receive of the next message, raise WorkerCrashed if the process dies or times out"""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        try:
+            if conn.poll(1):
+                return conn.recv()
+        except (EOFError, OSError):
+            raise WorkerCrashed(f'{name} closed its pipe')
+        if not proc.is_alive():
+            raise WorkerCrashed(f'{name} exited with code {proc.exitcode}')
+        if deadline is not None and time.monotonic() > deadline:
+            raise WorkerCrashed(f'{name} did not answer within {timeout} seconds')
+
+
+class PipelineWorker:
+    """
+    Handle on a single worker process, used from the service's event loop.
+    Messages from the worker are read by a single task, which hands them to whoever is waiting on them
+    """
+
+    def __init__(self, name: str, max_jobs: int = JOBS_PER_WORKER, page_workers: Optional[int] = None):
+        self.name = name
+        self.max_jobs = max_jobs
+        # None sizes the page worker pool as if this were the only worker on the host
+        self.page_workers = page_workers
+        self.process: Optional[multiprocessing.Process] = None
+        self.conn = None
+        self.lock = asyncio.Lock()
+        self.ready = False
+        self.restarts = 0
+        # incremented every time the worker process is replaced, see restart
+        self.generation = 0
+        self.start_time = None
+        # when the current worker process last sent a message, of any kind
+        self.last_message = None
+        self.reader: Optional[asyncio.Task] = None
+        self.pong: Optional[asyncio.Future] = None
+        self.jobs: Dict[str, asyncio.Future] = {}
+
+    def start(self):
+        """Start the worker process, it loads its models in the background"""
+        ctx = multiprocessing.get_context('spawn')
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_serve, args=(child_conn, self.max_jobs, self.page_workers), name=self.name, daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+        self.generation += 1
+        self.start_time = time.monotonic()
+        self.last_message = self.start_time
+        self.reader = asyncio.create_task(self._read(self.conn, self.process))
+
+    def _fail_waiters(self, error: WorkerCrashed):
+        """Fail everything waiting on an answer from the current worker process"""
+        waiters = list(self.jobs.values()) + [self.pong]
+        self.jobs = {}
+        for future in waiters:
+            if future is not None and not future.done():
+                future.set_exception(error)
+                # nobody may be waiting on a ping any more
+                future.exception()
+
+    async def _read(self, conn, proc):
+        """Hand every message from the worker process to whoever is waiting on it, until the process goes away"""
+        try:
+            while True:
+                message = await asyncio.get_running_loop().run_in_executor(None, _recv, conn, proc, self.name, None)
+                self.last_message = time.monotonic()
+                if message[0] == READY:
+                    self.ready = True
+                    logger.info(f"COSMOS worker {self.name} ready (pid {message[1]})")
+                elif message[0] == PONG:
+                    if self.pong is not None and not self.pong.done():
+                        self.pong.set_result(None)
+                elif message[0] == DONE:
+                    _, job_id, is_oom_error = message
+                    future = self.jobs.pop(job_id, None)
+                    if future is not None and not future.done():
+                        future.set_result(is_oom_error)
+        except WorkerCrashed as e:
+            self.ready = False
+            self._fail_waiters(e)
+
+    def stop(self):
+        """Ask the worker process to exit, killing it if it does not"""
+        if self.process is None:
+            return
+        if self.reader is not None:
+            self.reader.cancel()
+        self._fail_waiters(WorkerCrashed(f'{self.name} was stopped'))
+        if self.process.is_alive():
+            try:
+                self.conn.send((STOP,))
+            except (BrokenPipeError, OSError):
+                pass
+            self.process.join(5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+        self.process = None
+        self.ready = False
+
+    def _send(self, message):
+        if self.reader is None or self.reader.done():
+            raise WorkerCrashed(f'{self.name} is not running')
+        try:
+            self.conn.send(message)
+        except (BrokenPipeError, OSError) as e:
+            raise WorkerCrashed(f'{self.name} is not reachable: {e}')
+
+    async def restart(self, generation: int):
+        """
+        Replace the worker process with a new one. Does nothing if the process that failed,
+        identified by the generation it was seen failing in, has already been replaced
+        """
+        async with self.lock:
+            if generation != self.generation:
+                return
+            self.stop()
+            self.restarts += 1
+            await asyncio.sleep(RESTART_DELAY if self.restarts > 1 else 0)
+            self.start()
+
+    async def run(self, job_output_dir: str, job_id: str, compress_images: bool) -> bool:
+        """
+        Run a job on the worker, alongside the other jobs it is running. Returns True if the job failed due
+        to insufficient GPU memory and should be retried, raises WorkerCrashed if the worker died while running it
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.jobs[job_id] = future
+        try:
+            self._send((JOB, job_output_dir, job_id, compress_images))
+        except WorkerCrashed:
+            self.jobs.pop(job_id, None)
+            raise
+        return await future
+
+    async def check(self) -> bool:
+        """
+        Health check. An idle worker has to answer a ping within PING_TIMEOUT, a busy one is pinged too but only
+        fails once nothing has come back from it for STALL_TIMEOUT, and a starting one has to load its models
+        within READY_TIMEOUT
+        """
+        if self.process is None or not self.process.is_alive():
+            return False
+        if not self.ready:
+            return time.monotonic() - self.start_time < READY_TIMEOUT
+        self.pong = asyncio.get_running_loop().create_future()
+        try:
+            self._send((PING,))
+            if self.jobs:
+                # the answer arrives once the current scheduler step is done, and counts towards the next check
+                return time.monotonic() - self.last_message < STALL_TIMEOUT
+            await asyncio.wait_for(asyncio.shield(self.pong), PING_TIMEOUT)
+            return True
+        except (WorkerCrashed, asyncio.TimeoutError):
+            return False
+
+    def status(self) -> dict:
+        return {
+            'name': self.name,
+            'pid': self.process.pid if self.process is not None else None,
+            'alive': self.process is not None and self.process.is_alive(),
+            'ready': self.ready,
+            'restarts': self.restarts,
+            'job_ids': list(self.jobs),
+        }
@@ -0,0 +1,12 @@
+"""
+Unit tests of the service's modules, run against its source tree instead of a running service
+"""
+import os
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# the service runs from its src directory, next to the ingestion package
+sys.path[:0] = [os.path.join(HERE, '../../src'), os.path.join(HERE, '../../../cosmos/ingestion')]
+# db opens sessions.db in the working directory as soon as it is imported, keep it out of the source tree
+os.chdir(tempfile.mkdtemp(prefix='cosmos-service-tests-'))
@@ -0,0 +1,158 @@
+"""
+Tests for memory aware admission of jobs to the pipeline workers, with the free memory of the host and GPU patched
+"""
+import asyncio
+import os
+import shutil
+import pytest
+import admission
+from admission import AdmissionController, JobEstimate, MAX_OOM_RETRIES
+
+PDF = os.path.join(os.path.dirname(__file__), '../resources/pdfs/bucky.pdf')
+
+
+class StubWorker:
+    def __init__(self, name, max_jobs=2, ready=True):
+        self.name = name
+        self.max_jobs = max_jobs
+        self.ready = ready
+
+
+@pytest.fixture
+def memory(monkeypatch):
+    """Free host and GPU memory, in bytes"""
+    memory = {'host': 1000, 'device': 1000}
+    monkeypatch.setattr(admission, 'host_free_bytes', lambda: memory['host'])
+    monkeypatch.setattr(admission, 'device_free_bytes', lambda: memory['device'])
+    monkeypatch.setattr(admission, 'ADMISSION_POLL', 0.01)
+    return memory
+
+
+def estimate(host_bytes, device_bytes=0):
+    return JobEstimate(1, host_bytes, device_bytes)
+
+
+def test_fits_within_capacity_and_free_memory(memory):
+    controller = AdmissionController([StubWorker('w0')], memory_fraction=0.5)
+    # nothing admitted, even a job larger than the machine runs
+    assert controller._fits(estimate(5000, 5000))
+    assert controller.host_capacity == controller.device_capacity == 500
+    controller.admitted['running'] = (StubWorker('w0'), estimate(300, 300))
+    assert controller._fits(estimate(200, 200))
+    assert not controller._fits(estimate(201))
+    assert not controller._fits(estimate(100, 201))
+    # other processes took memory since capacity was measured
+    memory['host'] = 150
+    assert not controller._fits(estimate(200))
+    memory['host'] = 1000
+    memory['device'] = 150
+    assert not controller._fits(estimate(100, 200))
+
+
+def test_fits_without_gpu(memory):
+    memory['device'] = None
+    controller = AdmissionController([StubWorker('w0')], memory_fraction=1.0)
+    controller._measure()
+    assert controller.device_capacity is None
+    controller.admitted['running'] = (StubWorker('w0'), estimate(300))
+    assert controller._fits(estimate(100, 10 ** 12))
+
+
+def test_pick_worker(memory):
+    workers = [StubWorker('w0'), StubWorker('w1'), StubWorker('starting', ready=False)]
+    controller = AdmissionController(workers)
+    controller.admitted['a'] = (workers[0], estimate(1))
+    assert controller._pick_worker() is workers[1]
+    controller.admitted['b'] = (workers[1], estimate(1))
+    controller.admitted['c'] = (workers[1], estimate(1))
+    assert controller._pick_worker() is workers[0]
+    controller.admitted['d'] = (workers[0], estimate(1))
+    # both ready workers are full
+    assert controller._pick_worker() is None
+
+
+def test_oom_retries_double_the_estimate(memory, tmp_path):
+    shutil.copy(PDF, tmp_path)
+    controller = AdmissionController([StubWorker('w0')])
+    first = controller.estimate(str(tmp_path), 'job')
+    assert first.pages > 0 and first.host_bytes > 0 and first.device_bytes > 0
+    for retries in range(1, MAX_OOM_RETRIES + 1):
+        assert controller.record_oom('job')
+        retry = controller.estimate(str(tmp_path), 'job')
+        assert retry.pages == first.pages
+        assert (retry.host_bytes, retry.device_bytes) == (first.host_bytes * 2 ** retries, first.device_bytes * 2 ** retries)
+    assert not controller.record_oom('job')
+    # the job is given up, a new attempt starts from the plain estimate
+    assert controller.estimate(str(tmp_path), 'job').host_bytes == first.host_bytes
+    controller.record_oom('other')
+    controller.forget('other')
+    assert controller.oom_retries == {}
+
+
+def test_smaller_jobs_are_admitted_past_a_large_one(memory):
+    async def run():
+        controller = AdmissionController([StubWorker('w0', max_jobs=4)], memory_fraction=1.0, max_wait=60)
+        admitted = []
+
+        async def job(job_id, host_bytes):
+            await controller.admit(job_id, estimate(host_bytes))
+            admitted.append(job_id)
+
+        tasks = [asyncio.ensure_future(job('running', 600))]
+        await asyncio.sleep(0.05)
+        tasks += [asyncio.ensure_future(job('large', 700)), asyncio.ensure_future(job('small', 300))]
+        await asyncio.sleep(0.05)
+        assert admitted == ['running', 'small']
+        assert [waiting['job_id'] for waiting in controller.status()['waiting_jobs']] == ['large']
+        await controller.release('running')
+        await controller.release('small')
+        await asyncio.gather(*tasks)
+        assert admitted == ['running', 'small', 'large']
+        assert controller.status()['waiting_jobs'] == []
+
+    asyncio.run(run())
+
+
+def test_a_job_waiting_too_long_reserves_the_memory_it_needs(memory):
+    async def run():
+        controller = AdmissionController([StubWorker('w0', max_jobs=4)], memory_fraction=1.0, max_wait=0.1)
+        admitted = []
+
+        async def job(job_id, host_bytes):
+            await controller.admit(job_id, estimate(host_bytes))
+            admitted.append(job_id)
+
+        tasks = [asyncio.ensure_future(job('running', 600))]
+        await asyncio.sleep(0.05)
+        tasks.append(asyncio.ensure_future(job('large', 700)))
+        await asyncio.sleep(0.2)
+        # the large job has waited past max_wait, the small one fits but has to wait behind it
+        tasks.append(asyncio.ensure_future(job('small', 400)))
+        await asyncio.sleep(0.05)
+        assert admitted == ['running']
+        status = controller.status()
+        assert [waiting['job_id'] for waiting in status['waiting_jobs']] == ['large', 'small']
+        assert status['waiting_jobs'][0]['waited_seconds'] > status['waiting_jobs'][1]['waited_seconds']
+        await controller.release('running')
+        await asyncio.sleep(0.05)
+        assert admitted == ['running', 'large']
+        await controller.release('large')
+        await asyncio.gather(*tasks)
+        assert admitted == ['running', 'large', 'small']
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiting_job_leaves_the_queue(memory):
+    async def run():
+        controller = AdmissionController([StubWorker('w0', max_jobs=1)])
+        await controller.admit('running', estimate(1))
+        waiting = asyncio.ensure_future(controller.admit('waiting', estimate(1)))
+        await asyncio.sleep(0.05)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert controller.waiting == []
+        assert list(controller.admitted) == ['running']
+
+    asyncio.run(run())
@@ -0,0 +1,133 @@
+"""
+Tests for the server-sent events stream of the pages of a job, over the service's sqlite database
+"""
+import asyncio
+import json
+import uuid
+import pytest
+from fastapi import HTTPException
+from db.db import SessionLocal, CosmosSessionJob
+from db.processing_session_types import CosmosPageResult
+from routers import process
+
+
+@pytest.fixture(autouse=True)
+def fast_poll(monkeypatch):
+    monkeypatch.setattr(process, 'PAGE_POLL_INTERVAL', 0.01)
+
+
+def create_job() -> str:
+    job_id = str(uuid.uuid4())
+    with SessionLocal() as session:
+        job = CosmosSessionJob(job_id, 'doc.pdf', job_id, 0, '/tmp')
+        job.is_started = True
+        session.add(job)
+        session.commit()
+    return job_id
+
+
+def record_page(job_id: str, page_num: int) -> int:
+    with SessionLocal() as session:
+        page = CosmosPageResult(job_id, page_num, json.dumps([{'page_num': page_num, 'content': f'page {page_num}'}]))
+        session.add(page)
+        session.commit()
+        return page.id
+
+
+def finish_job(job_id: str, error: str = None):
+    with SessionLocal() as session:
+        job = session.get(CosmosSessionJob, job_id)
+        job.is_completed = True
+        job.error = error
+        session.commit()
+
+
+def parse(event: str) -> dict:
+    fields = dict(line.split(': ', 1) for line in event.strip().split('\n'))
+    fields['data'] = json.loads(fields['data'])
+    return fields
+
+
+async def collect(events) -> list:
+    return [parse(event) async for event in events]
+
+
+def stream(job_id: str, cursor=None) -> list:
+    return asyncio.run(collect(process._page_events(job_id, cursor)))
+
+
+def test_pages_then_complete():
+    job_id = create_job()
+    ids = [record_page(job_id, page_num) for page_num in (2, 1, 3)]
+    finish_job(job_id)
+    events = stream(job_id)
+    assert [e['event'] for e in events] == ['page', 'page', 'page', 'complete']
+    # pages come in the order they were recorded, each with its cursor as the event id
+    assert [int(e['id']) for e in events[:3]] == ids
+    assert [e['data']['page_num'] for e in events[:3]] == [2, 1, 3]
+    assert events[0]['data']['segments'] == [{'page_num': 2, 'content': 'page 2'}]
+    assert 'id' not in events[3]
+    assert events[3]['data']['job_completed'] and events[3]['data']['error'] is None
+
+
+def test_resume_from_cursor():
+    job_id = create_job()
+    ids = [record_page(job_id, page_num) for page_num in range(1, 5)]
+    finish_job(job_id)
+    events = stream(job_id, ids[1])
+    assert [int(e['id']) for e in events if e['event'] == 'page'] == ids[2:]
+    assert stream(job_id, ids[-1])[0]['event'] == 'complete'
+
+
+def test_pages_of_other_jobs_are_not_streamed():
+    job_id, other_job_id = create_job(), create_job()
+    record_page(other_job_id, 1)
+    page_id = record_page(job_id, 1)
+    record_page(other_job_id, 2)
+    finish_job(job_id)
+    assert [int(e['id']) for e in stream(job_id) if e['event'] == 'page'] == [page_id]
+
+
+def test_pages_are_streamed_while_the_job_runs():
+    job_id = create_job()
+
+    async def run():
+        events = process._page_events(job_id, None)
+        first = asyncio.ensure_future(events.__anext__())
+        await asyncio.sleep(0.05)
+        assert not first.done()
+        page_id = record_page(job_id, 1)
+        assert parse(await asyncio.wait_for(first, 5))['id'] == str(page_id)
+        finish_job(job_id, error='out of memory')
+        return [parse(event) async for event in events]
+
+    events = asyncio.run(run())
+    assert [e['event'] for e in events] == ['complete']
+    assert events[0]['data']['error'] == 'out of memory'
+
+
+def test_unknown_job():
+    events = stream(str(uuid.uuid4()))
+    assert [e['event'] for e in events] == ['error']
+    assert events[0]['data'] == {'detail': 'Job not found'}
+    with pytest.raises(HTTPException) as e:
+        process.stream_processing_result_pages(str(uuid.uuid4()), None, None)
+    assert e.value.status_code == 404
+
+
+@pytest.mark.parametrize('use_query', [True, False])
+def test_endpoint_cursor_and_last_event_id(use_query):
+    job_id = create_job()
+    ids = [record_page(job_id, page_num) for page_num in range(1, 4)]
+    finish_job(job_id)
+    if use_query:
+        # the query cursor wins over the header an EventSource sends when it reconnects
+        response = process.stream_processing_result_pages(job_id, ids[0], ids[1])
+        expected = ids[1:]
+    else:
+        response = process.stream_processing_result_pages(job_id, None, ids[1])
+        expected = ids[2:]
+    assert response.media_type == 'text/event-stream'
+    events = asyncio.run(collect(response.body_iterator))
+    assert [int(e['id']) for e in events if e['event'] == 'page'] == expected
+    assert events[-1]['event'] == 'complete'
@@ -0,0 +1,123 @@
+"""
+Tests for how the page scheduler shares detection batches between jobs, and shrinks them when the GPU runs out of memory
+"""
+from concurrent.futures import Future
+import pytest
+import page_scheduler
+from page_scheduler import PageScheduler, ScheduledJob
+
+
+def proposed_job(job_id, npages, pages_left=None, done=True):
+    """A job whose first npages pages are being proposed, and are done if done is set"""
+    job = ScheduledJob(job_id, 'pdf_dir', False)
+    job.pdf_name = f'{job_id}.pdf'
+    job.pages = [f'{job_id}/{page_num}' for page_num in range(1, npages + 1)]
+    for page in job.pages:
+        job.proposals[page] = Future()
+        if done:
+            job.proposals[page].set_result([])
+    job.unproposed.extend(f'{job_id}/unproposed/{i}' for i in range((pages_left or npages) - npages))
+    return job
+
+
+@pytest.fixture
+def scheduler():
+    schedulers = []
+
+    def make(policy, batch_pages, jobs):
+        scheduler = PageScheduler({'model': None, 'device_str': 'cpu', 'model_config': None},
+                                  None, len(jobs), policy=policy, batch_pages=batch_pages)
+        scheduler.jobs.extend(jobs)
+        schedulers.append(scheduler)
+        return scheduler
+
+    yield make
+    for scheduler in schedulers:
+        scheduler.shutdown()
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        PageScheduler({}, None, 1, policy='longest')
+
+
+def test_fair_batches_take_a_page_of_every_job_in_turn(scheduler):
+    jobs = [proposed_job('a', 5), proposed_job('b', 1), proposed_job('c', 3)]
+    scheduler = scheduler('fair', 4, jobs)
+    firsts = []
+    for _ in range(3):
+        batch = scheduler._select_batch()
+        assert len(batch) == 4
+        assert {job.job_id for job, _ in batch} == {'a', 'b', 'c'}
+        for job in jobs:
+            # every job's pages go in page order
+            pages = [page for batch_job, page in batch if batch_job is job]
+            assert pages == job.pages[:len(pages)]
+        firsts.append(batch[0][0].job_id)
+    # the job served first moves along every batch
+    assert sorted(firsts) == ['a', 'b', 'c']
+
+
+def test_fair_batches_skip_jobs_without_ready_pages(scheduler):
+    waiting = proposed_job('waiting', 2, done=False)
+    finishing = proposed_job('finishing', 2)
+    finishing.finished = Future()
+    scheduler = scheduler('fair', 4, [waiting, finishing, proposed_job('a', 2)])
+    assert [(job.job_id, page) for job, page in scheduler._select_batch()] == [('a', 'a/1'), ('a', 'a/2')]
+    scheduler.jobs.pop()
+    assert scheduler._select_batch() == []
+
+
+def test_shortest_batches_serve_the_jobs_with_fewest_pages_left(scheduler):
+    jobs = [proposed_job('long', 3, pages_left=10), proposed_job('short', 2), proposed_job('medium', 3, pages_left=5)]
+    scheduler = scheduler('shortest', 4, jobs)
+    assert [page for _, page in scheduler._select_batch()] == ['short/1', 'short/2', 'medium/1', 'medium/2']
+
+
+@pytest.fixture
+def detection(monkeypatch):
+    """Stub out everything around the detection call, which fails for batches larger than detection['fits']"""
+    detection = {'fits': 2, 'batches': []}
+
+    def run_inference(model, objs, model_config, device_str):
+        detection['batches'].append(len(objs))
+        if len(objs) > detection['fits']:
+            raise RuntimeError('CUDA out of memory. Tried to allocate 2.00 GiB')
+        return {obj['id']: [] for obj in objs}, {obj['id']: [] for obj in objs}
+
+    def load_page(filename, image_path, page_info_dir, pages_meta, limits, infofiles):
+        return {'page_path': image_path, 'page_num': int(image_path.split('/')[-1])}, None, 'padded image'
+
+    monkeypatch.setattr(page_scheduler, 'run_inference', run_inference)
+    monkeypatch.setattr(page_scheduler.mp, 'load_page', load_page)
+    monkeypatch.setattr(page_scheduler.mp, 'save_detections', lambda *args: None)
+    monkeypatch.setattr(page_scheduler.process, 'record_progress', lambda *args: None)
+    monkeypatch.setattr(page_scheduler.torch.cuda, 'empty_cache', lambda: None)
+    monkeypatch.setattr(PageScheduler, '_stream_pages', lambda self, job, objs: None)
+    return detection
+
+
+def test_batches_halve_when_detection_runs_out_of_memory(scheduler, detection, monkeypatch):
+    monkeypatch.setattr(page_scheduler, 'GROW_AFTER', 2)
+    jobs = [proposed_job('a', 4), proposed_job('b', 4)]
+    scheduler = scheduler('fair', 4, jobs)
+    scheduler._detect(scheduler._select_batch())
+    # the pages of the failed batch stay with their jobs, and are detected again in smaller batches
+    assert scheduler.batch_pages == 2
+    assert all(job.error is None and job.pages_done == 0 and len(job.proposals) == 4 for job in jobs)
+    for _ in range(2):
+        scheduler._detect(scheduler._select_batch())
+    assert detection['batches'] == [4, 2, 2]
+    # enough batches went through for the batches to grow by a page again
+    assert scheduler.batch_pages == 3
+    assert sum(job.pages_done for job in jobs) == 4
+
+
+def test_a_single_page_out_of_memory_fails_its_job(scheduler, detection):
+    detection['fits'] = 0
+    job = proposed_job('a', 1)
+    scheduler = scheduler('fair', 1, [job])
+    scheduler._detect(scheduler._select_batch())
+    assert scheduler.batch_pages == 1
+    assert 'out of memory' in str(job.error)
+    assert job.proposals == {}
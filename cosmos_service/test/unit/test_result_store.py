@@ -0,0 +1,135 @@
+"""
+Tests for serving the stored results of a job, with conditional and range requests
+"""
+import json
+from types import SimpleNamespace
+import pytest
+from fastapi.responses import FileResponse
+from util.result_store import ResultStore, write_result_store, _parse_range, IMAGE_DIR
+
+PDF_NAME = 'doc'
+IMAGE = b'\x89PNG' + bytes(range(256))
+
+
+def segment(**fields):
+    return {'pdf_name': f'{PDF_NAME}.pdf', 'page_num': 1, 'bounding_box': [0, 0, 10, 10], 'detect_score': 0.9,
+            'content': 'text', 'postprocess_score': 0.8, **fields}
+
+
+@pytest.fixture
+def store(tmp_path):
+    cosmos_out_dir, output_dir = tmp_path / 'cosmos_out', tmp_path / 'output'
+    cosmos_out_dir.mkdir()
+    output_dir.mkdir()
+    (cosmos_out_dir / f'{PDF_NAME}.json').write_text(json.dumps(
+        [segment(detect_cls='Body Text', postprocess_cls='Body Text')]))
+    for extraction_type in ('equations', 'figures', 'tables'):
+        (cosmos_out_dir / f'{PDF_NAME}_{extraction_type}.json').write_text(json.dumps([segment(img_pth='page_1.png')]))
+    (cosmos_out_dir / 'page_1.png').write_bytes(IMAGE)
+    write_result_store(str(cosmos_out_dir), PDF_NAME, str(output_dir))
+    return ResultStore(SimpleNamespace(id='job', output_dir=str(output_dir), pdf_name=PDF_NAME))
+
+
+def request(url='http://cosmos/process/job/result/extractions/figures', **headers):
+    return SimpleNamespace(url=url, headers={k.replace('_', '-'): v for k, v in headers.items()})
+
+
+@pytest.mark.parametrize('header,expected', [
+    (None, None),
+    ('bytes=0-99', (0, 99)),
+    ('bytes=10-', (10, 259)),
+    ('bytes=200-1000', (200, 259)),
+    ('bytes=-20', (240, 259)),
+    ('bytes=-1000', (0, 259)),
+    ('bytes=0-9,20-29', None),
+    ('items=0-9', None),
+    ('bytes=-', None),
+    ('bytes=260-', ()),
+    ('bytes=20-10', ()),
+    ('bytes=-0', ()),
+])
+def test_parse_range(header, expected):
+    assert _parse_range(header, 260) == expected
+
+
+def test_full_response_has_an_etag(store):
+    name = store.image('page_1.png')
+    response = store.response(name, request())
+    assert isinstance(response, FileResponse)
+    assert response.status_code == 200
+    assert response.path.endswith(f'{IMAGE_DIR}/page_1.png')
+    assert response.headers['etag'] == f'"{store.files[name]["etag"]}"'
+    assert response.headers['accept-ranges'] == 'bytes'
+    assert response.media_type == 'image/png'
+    assert store.image('missing.png') is None
+
+
+@pytest.mark.parametrize('if_none_match', ['{etag}', '"other", {etag}', '*'])
+def test_matching_etag_is_not_modified(store, if_none_match):
+    name = store.text()
+    etag = f'"{store.files[name]["etag"]}"'
+    response = store.response(name, request(if_none_match=if_none_match.format(etag=etag)))
+    assert response.status_code == 304
+    assert response.body == b''
+    assert response.headers['etag'] == etag
+
+
+def test_stale_etag_gets_the_file(store):
+    response = store.response(store.text(), request(if_none_match='"stale"'))
+    assert response.status_code == 200
+
+
+def test_range_request(store):
+    name = store.image('page_1.png')
+    response = store.response(name, request(range='bytes=4-13'))
+    assert response.status_code == 206
+    assert response.body == IMAGE[4:14]
+    assert response.headers['content-range'] == f'bytes 4-13/{len(IMAGE)}'
+
+
+def test_suffix_range_request(store):
+    response = store.response(store.image('page_1.png'), request(range='bytes=-16'))
+    assert response.status_code == 206
+    assert response.body == IMAGE[-16:]
+    assert response.headers['content-range'] == f'bytes {len(IMAGE) - 16}-{len(IMAGE) - 1}/{len(IMAGE)}'
+
+
+def test_unsatisfiable_range(store):
+    response = store.response(store.image('page_1.png'), request(range=f'bytes={len(IMAGE)}-'))
+    assert response.status_code == 416
+    assert response.headers['content-range'] == f'bytes */{len(IMAGE)}'
+
+
+def test_if_range(store):
+    name = store.image('page_1.png')
+    etag = f'"{store.files[name]["etag"]}"'
+    response = store.response(name, request(range='bytes=0-3', if_range=etag))
+    assert response.status_code == 206
+    assert response.body == IMAGE[:4]
+    # the file changed since the client's copy, it gets all of it
+    response = store.response(name, request(range='bytes=0-3', if_range='"stale"'))
+    assert response.status_code == 200
+    assert isinstance(response, FileResponse)
+
+
+def test_stored_text(store):
+    with open(f'{store.store_dir}/{store.text()}') as f:
+        text = json.load(f)
+    assert text == [segment(detect_cls='Body Text', postprocess_cls='Body Text')]
+
+
+def test_extraction_image_links_follow_the_base_url(store):
+    name = store.extractions('figures', request())
+    with open(f'{store.store_dir}/{name}') as f:
+        extractions = json.load(f)
+    assert extractions[0]['img_pth'] == 'http://cosmos/process/job/result/images/page_1.png'
+    assert 'content' in extractions[0]
+    assert store.extractions('figures', request()) == name
+
+    other = store.extractions('figures', request(url='http://proxy/cosmos/process/job/result/extractions/figures'))
+    assert other != name
+    with open(f'{store.store_dir}/{other}') as f:
+        assert json.load(f)[0]['img_pth'] == 'http://proxy/cosmos/process/job/result/images/page_1.png'
+    # both are served with ETags derived from the template and the base URL
+    assert store.files[other]['etag'] != store.files[name]['etag']
+    assert store.response(name, request()).headers['etag'].startswith(f'"{store.files["figures.template.json"]["etag"]}-')
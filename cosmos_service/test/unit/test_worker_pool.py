@@ -0,0 +1,185 @@
+"""
+Tests for the pipe protocol and health checks of the pipeline workers, with a thread standing in for the
+worker process
+"""
+import asyncio
+import threading
+import multiprocessing
+import time
+import pytest
+import worker_pool
+from worker_pool import PipelineWorker, WorkerCrashed, READY, PONG, DONE, JOB, PING, STOP
+
+
+class FakeProcess:
+    pid = 1
+
+    def __init__(self):
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+    def join(self, timeout=None):
+        pass
+
+    def kill(self):
+        self.alive = False
+
+
+def attach(worker, serve, *args):
+    """Start a worker the way PipelineWorker.start does, with serve(conn, process, *args) as its process"""
+    worker.conn, child_conn = multiprocessing.Pipe()
+    worker.process = FakeProcess()
+    threading.Thread(target=serve, args=(child_conn, worker.process, *args), daemon=True).start()
+    worker.ready = False
+    worker.generation += 1
+    worker.start_time = worker.last_message = time.monotonic()
+    worker.reader = asyncio.ensure_future(worker._read(worker.conn, worker.process))
+
+
+async def until_ready(worker):
+    while not worker.ready:
+        await asyncio.sleep(0.01)
+
+
+def serve_out_of_order(conn, process):
+    # both jobs run at once, the second one finishes first
+    conn.send((READY, process.pid))
+    jobs = [conn.recv() for _ in range(2)]
+    assert all(message[0] == JOB for message in jobs)
+    conn.send((DONE, jobs[1][2], True))
+    conn.send((DONE, jobs[0][2], False))
+    while conn.recv()[0] != STOP:
+        pass
+
+
+def serve_then_exit(conn, process):
+    conn.send((READY, process.pid))
+    conn.recv()
+    process.alive = False
+    conn.close()
+
+
+def serve_pings(conn, process, answering):
+    # answers pings while answering is set, and never finishes a job
+    conn.send((READY, process.pid))
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return
+        if message[0] == STOP:
+            return
+        if message[0] == PING and answering.is_set():
+            conn.send((PONG,))
+
+
+def test_jobs_finish_out_of_order():
+    async def run():
+        worker = PipelineWorker('worker')
+        attach(worker, serve_out_of_order)
+        await until_ready(worker)
+        results = await asyncio.gather(worker.run('out', 'first', False), worker.run('out', 'second', False))
+        assert worker.status()['job_ids'] == []
+        worker.stop()
+        return results
+
+    assert asyncio.run(run()) == [False, True]
+
+
+def test_worker_exit_fails_its_jobs():
+    async def run():
+        worker = PipelineWorker('worker')
+        attach(worker, serve_then_exit)
+        await until_ready(worker)
+        with pytest.raises(WorkerCrashed):
+            await worker.run('out', 'job', False)
+        assert not worker.ready
+        assert not await worker.check()
+        with pytest.raises(WorkerCrashed):
+            await worker.run('out', 'another', False)
+
+    asyncio.run(run())
+
+
+def test_idle_worker_has_to_answer_pings(monkeypatch):
+    monkeypatch.setattr(worker_pool, 'PING_TIMEOUT', 0.2)
+
+    async def run():
+        answering = threading.Event()
+        answering.set()
+        worker = PipelineWorker('worker')
+        attach(worker, serve_pings, answering)
+        await until_ready(worker)
+        assert await worker.check()
+        answering.clear()
+        assert not await worker.check()
+        worker.stop()
+
+    asyncio.run(run())
+
+
+def test_busy_worker_fails_once_it_stops_making_progress(monkeypatch):
+    monkeypatch.setattr(worker_pool, 'STALL_TIMEOUT', 0.5)
+
+    async def run():
+        answering = threading.Event()
+        answering.set()
+        worker = PipelineWorker('worker')
+        attach(worker, serve_pings, answering)
+        await until_ready(worker)
+        job = asyncio.ensure_future(worker.run('out', 'job', False))
+        # the job never finishes, but the worker keeps answering between its steps
+        for _ in range(4):
+            assert await worker.check()
+            await asyncio.sleep(0.2)
+        answering.clear()
+        await asyncio.sleep(0.6)
+        assert not await worker.check()
+        worker.stop()
+        with pytest.raises(WorkerCrashed):
+            await job
+
+    asyncio.run(run())
+
+
+def test_starting_worker_has_to_load_its_models(monkeypatch):
+    monkeypatch.setattr(worker_pool, 'READY_TIMEOUT', 0.2)
+
+    async def run():
+        worker = PipelineWorker('worker')
+        attach(worker, lambda conn, process: conn.recv())
+        assert await worker.check()
+        await asyncio.sleep(0.3)
+        assert not await worker.check()
+        worker.stop()
+
+    asyncio.run(run())
+
+
+def test_restarts_are_deduplicated_by_generation(monkeypatch):
+    monkeypatch.setattr(worker_pool, 'RESTART_DELAY', 0)
+    starts = []
+
+    def start(self):
+        self.generation += 1
+        starts.append(self.generation)
+
+    monkeypatch.setattr(PipelineWorker, 'start', start)
+    monkeypatch.setattr(PipelineWorker, 'stop', lambda self: None)
+
+    async def run():
+        worker = PipelineWorker('worker')
+        worker.start()
+        generation = worker.generation
+        # the health check and two crashed jobs all see the same process fail
+        await asyncio.gather(*[worker.restart(generation) for _ in range(3)])
+        assert worker.generation == generation + 1
+        assert worker.restarts == 1
+        # a failure seen in the replaced process does not restart the new one
+        await worker.restart(generation)
+        assert worker.restarts == 1
+
+    asyncio.run(run())
+    assert starts == [1, 2]
@@ -12,9 +12,11 @@ import sys
 import pickle
 import json
 import io
-import subprocess
 import glob
 import time
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
 import yaml # for xgboost classes
 
 # for sleep
@@ -22,20 +24,20 @@ import yaml # for xgboost classes
 
 from PIL import Image
 from pathlib import Path
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 
 # for logging
 from datetime import datetime
 
 from ingest.utils.visualize import write_regions
 from ingest.process.proposals.connected_components import get_proposals
-from ingest.utils.pdf_extractor import parse_pdf
+from ingest.utils.pdf_extractor import parse_pages, scale_page_meta
 from ingest.utils.preprocess import resize_png
+from ingest.utils.rasterize import count_pages, page_ranges, save_page_range
+from ingest.utils.result_cache import ResultCache, cache_key, file_sha1, files_version
+from ingest.utils.metrics import stage, observe
 from ingest.utils.table_extraction import TableLocationProcessor
 from ingest.process.detection.src.preprocess import pad_image
 from ingest.process.detection.src.infer import get_model, run_inference
-from ingest.process.detection.src.torch_model.train.data_layer.sql_types import Base
 
 #for my_run_inference
 #from ingest.process.detection.src.torch_model.model.utils.config_manager import ConfigManager
@@ -48,20 +50,23 @@ from ingest.process.detection.src.torch_model.train.data_layer.sql_types import
 from ingest.process.ocr.ocr import group_cls, _pool_text_meta, _placeholder_map
 
 # for post processing
-from ingest.process.postprocess.xgboost_model.inference import run_inference as postprocess
+from ingest.process.postprocess.xgboost_model.inference import run_inference_batch as postprocess_batch
 from ingest.process.postprocess.pp_rules import apply_rules as postprocess_rules
 
 # for ConfigManager class
 from ingest.process.detection.src.torch_model.model.utils.config_manager import ConfigManager
 
 # aggregation
-from ingest.utils.normalize_text import normalize_text
+from ingest.utils.result_writer import ParquetAppender, RESULT_SCHEMA, page_rows, rows_to_table
 import pandas as pd
 from ingest.process.aggregation.aggregate import aggregate_router
 
 # for xgboost_postprocess
 from xgboost import XGBClassifier
 
+# XGBClassifier.predict_proba is not thread-safe, threads postprocessing pages share one model through this lock
+postprocess_lock = threading.Lock()
+
 def tlog(msg):
     now = datetime.now().strftime('%X.%f')
     print(f'{now} {msg}')
@@ -115,20 +120,198 @@ def load_image(image_path):
         return None
     return img
 
-# copy metadata and scale data in the copy the given page by the given scale factors
-def pull_meta(meta, limit, page_num, scale_w, scale_h):
+# load a page image, resize it the way process_pages does and return its proposals.
+# runs in the page worker pool, so the proposals of a large pdf are computed in parallel
+def propose_page(image_path):
+    img = load_image(image_path)
+    if img is None:
+        return None
+    img = resize_png(img)
+    with stage('get_proposals', image=os.path.basename(image_path)) as record:
+        proposals = get_proposals(img)
+        record['objects'] = len(proposals)
+    return proposals
+
+# render the pages of a pdf, in page range shards spread over the pool
+def render_pages(executor, filename, page_info_dir, pages_per_shard):
+    pdf_name = os.path.basename(filename)
+    shards = page_ranges(count_pages(filename), pages_per_shard)
+    futures = [executor.submit(save_page_range, filename, page_info_dir, pdf_name, pages) for pages in shards]
+    return [path for f in futures for path in f.result()]
+
+# parse a pdf in page range shards spread over the pool, into per-page text lines and per-page sizes.
+# both are None if the pdf has no text
+def parse_pdf_sharded(executor, filename, pages_per_shard):
+    shards = page_ranges(count_pages(filename), pages_per_shard)
+    if len(shards) == 1:
+        pages_meta, limits = parse_pages(filename)
+    else:
+        pages_meta, limits = {}, {}
+        futures = [executor.submit(parse_pages, filename, {p - 1 for p in pages}) for pages in shards]
+        for f in futures:
+            shard_meta, shard_limits = f.result()
+            pages_meta.update(shard_meta)
+            limits.update(shard_limits)
+    if len(pages_meta) == 0:
+        return None, None
+    return pages_meta, limits
+
+# pull the metadata of the given page out of the per-page metadata and scale it by the given scale factors
+def pull_meta(pages_meta, limit, page_num, scale_w, scale_h):
     meta2 = None
-    if meta is not None:
-        meta2 = meta.copy()
-        meta2.loc[meta2.page == (page_num-1), 'x1'] = meta2.x1 * scale_w
-        meta2.loc[meta2.page == (page_num-1), 'x2'] = meta2.x2 * scale_w
-        meta2.loc[meta2.page == (page_num-1), 'y1'] = meta2.y1 * scale_h
-        meta2.loc[meta2.page == (page_num-1), 'y2'] = meta2.y2 * scale_h
-        meta2 = meta2.to_dict()
-        meta2 = json.dumps(meta2)
-        meta2 = json.loads(meta2)
+    if pages_meta is not None:
+        meta2 = scale_page_meta(pages_meta, page_num, scale_w, scale_h)
     return meta2
 
+"""
+    Load the per-page dict of a page PNG file, or create it, and the resized and padded image the inference
+    model looks at.  The padded image is saved next to the page as {image_path}_pad for aggregation, and
+    the page limits and metadata are refreshed from the parse_pdf results when they are supplied.
+
+    args:
+        filename      - relative path the the PDF file being processed, typically {pdf_dir)/{dataset_id}.pdf
+        image_path    - relative path to the page PNG file, typically {page_info_dir}/{dataset_id}_{page_num}.png
+        page_info_dir - relative path to intermediate directory for pickles, padded images and other infofiles
+        pages_meta    - per-page PDF metadata, keyed by 0-indexed page, or None
+        limits        - per-page PDF page size in pixels, keyed by 0-indexed page, or None
+        infofiles     - dict of temporary files, the files created for the page are added to it
+
+    return: (obj, img, padded_img) or None if the page cannot be processed
+        obj           - the page dict, with 'id' set to the key the inference model uses for the page
+        img           - the resized page image, None if the padded image was loaded from disk instead
+        padded_img    - the resized and padded page image
+"""
+def load_page(filename, image_path, page_info_dir, pages_meta, limits, infofiles):
+
+    just_propose = os.environ.get("JUST_PROPOSE") is not None
+
+    infofiles[image_path] = 'page'
+
+    pdf_name = os.path.basename(filename)
+    dataset_id = Path(filename).stem
+    image_name = os.path.basename(image_path)
+    try:
+        page_num = get_page_num(image_name)
+    except ValueError:
+        raise Exception(f'cannot extract page number from {image_path}')
+
+    page_name = f'pdf_{page_num}'
+    tlog(f'processing {page_name} from {image_path}')
+
+    # load or create the per-page dict
+    pkl_path = f'{image_path}.pkl'
+    if (os.path.isfile(pkl_path)):
+        with open(pkl_path, 'rb') as rf:
+            obj = pickle.load(rf)
+    else:
+        obj = {'dataset_id': dataset_id, 'pdf_name': pdf_name, 'page_num': page_num, 'page_id': image_name}
+
+    # the inference model uses this as a key for the output data
+    model_id = '0'
+    obj['id'] = model_id
+    obj['page_path'] = image_path
+
+    # the processing looks a resized-padded image.
+    # but the proposal step only looks at the resized image
+    pad_img_path = f'{image_path}_pad'
+
+    make_proposals = obj.get('proposals') is None or just_propose
+
+    # if we already have proposals, then we don't need to load the non-padded image
+    # we can just load the padded image.  If there is no padded image then we
+    # load the page image and resize/pad it.
+    img = None
+    if os.path.isfile(pad_img_path) and not make_proposals:
+        padded_img = load_image(pad_img_path)
+        if padded_img is None:
+            tlog_flush(f'ERROR: failed to read padded image {pad_img_path} - aborting this pdf')
+            return None
+
+        orig_w = obj['orig_w']
+        orig_h = obj['orig_h']
+    else:
+        # get the page image
+        img = load_image(image_path)
+        if img is None:
+            tlog(f'ERROR: failed to read image {image_path} - aborting this pdf')
+            return None
+
+        tlog(f'{image_name} is {img.size} resizing to 1920')
+        orig_w, orig_h = img.size
+        obj['orig_w'] = orig_w
+        obj['orig_h'] = orig_h
+
+        # the model wants square images of size 1920, so we resize and square it now
+        img, img_size = resize_png(img, return_size=True)
+        tlog(f'{page_name} is now {img_size}')
+        padded_img = pad_image(img)
+        tlog(f'{page_name} padded to {padded_img.size}')
+        # the padding operation is
+        #want_image_size = 1920
+        #d_w = want_image_size - w
+        #d_h = want_image_size - h
+        #padding = (0,0,d_w, d_h)
+        #padded_img = ImageOps.expand(img, padding, fill="#fff")
+
+        # the aggregation code also needs access to the padded image
+        # so save this file for later
+        padded_img.save(pad_img_path, "PNG")
+        infofiles[pad_img_path] = 'pad'
+
+    # refresh the path to the padded image in case we are resuming on a different machine
+    obj['pad_img'] = pad_img_path
+
+    # if meta/limit is supplied, store/refresh the page relevent meta info
+    limit = limits.get(page_num - 1) if limits is not None else None
+    if limit is not None:
+        obj['pdf_limit'] = limit
+    else:
+        limit = obj.get('pdf_limit')
+
+    if limit is not None:
+        orig_w = limit[2]
+        orig_h = limit[3]
+    else:
+        tlog(f'ERROR: parsing of {pdf_name} was unsuccessful - aborting this pdf')
+        return None
+
+    if pages_meta is not None:
+        w,h = img.size
+        scale_w = w / orig_w
+        scale_h = h / orig_h
+        meta2 = pull_meta(pages_meta, limit, page_num, scale_w, scale_h)
+        dims = [0, 0, w, h]
+
+        obj['meta'] = meta2
+        obj['dims'] = dims
+
+    return obj, img, padded_img
+
+"""
+    Store the inference results of a page in its page dict and save the dict as a pickle in {page_info_dir}.
+    Any lingering post-processing data is cleared to indicate post-processing is still needed.
+
+    args:
+        obj           - the page dict, see load_page
+        detected      - detected objects of the page returned by the inference model
+        softmax       - softmax scored objects of the page returned by the inference model
+        page_info_dir - relative path to intermediate directory for pickles
+        infofiles     - dict of temporary files, the pickle is added to it
+"""
+def save_detections(obj, detected, softmax, page_info_dir, infofiles):
+    obj['detected_objs'] = detected
+    obj['softmax_objs'] = softmax
+    obj.pop('content', None)
+    obj.pop('xgboost_content', None)
+    obj.pop('rules_content', None)
+
+    # put output pickles into an ouput directory
+    pkl_path = f'{page_info_dir}/{os.path.basename(obj["page_path"])}.pkl'
+    tlog_flush(f'writing pdf_{obj["page_num"]} model results to {pkl_path}')
+    with open(pkl_path, 'wb') as wf:
+        pickle.dump(obj, wf)
+    infofiles[pkl_path] = 'pickle'
+
 """
     Main processing function for the pages in a single PDF file.
 
@@ -148,11 +331,12 @@ def pull_meta(meta, limit, page_num, scale_w, scale_h):
         filename      - relative path the the PDF file being processed, typically {pdf_dir)/{dataset_id}.pdf
         pages         - list of relative paths to the page PNG files for the PDF, typically {page_info_dir}/{dataset_id}_{page_num}.png
         page_info_dir - relative path to intermediate directory for pickles, padded images and other infofiles
-        meta          - PDF metadata or None
-        limit         - PDF page size in pixels or None
+        pages_meta    - per-page PDF metadata, keyed by 0-indexed page, or None
+        limits        - per-page PDF page size in pixels, keyed by 0-indexed page, or None
         model         - GPU inference model or None
         model_config  - GPU inference model or None
         device_str    - the value 'cpu', 'cuda' or None
+        executor      - optional process pool, proposals of all pages are then computed in parallel up front
 
     return: (success, objs, infofiles)
         success       - a boolean value that indicates overall success or failure
@@ -164,23 +348,23 @@ def pull_meta(meta, limit, page_num, scale_w, scale_h):
                            'pickle' - contents of a page dict saved as a pickle file
                            'json'   - selected page processing results saved as json data
 
-    The meta, and limit values can be None if the processing is skipping the propose step
+    The pages_meta, and limits values can be None if the processing is skipping the propose step
     The model, model_config and device_str values can be None if processing is just doing the propose step
 
 """
-def process_pages(filename, pages, page_info_dir, meta, limit, model, model_config, device_str):
+def process_pages(filename, pages, page_info_dir, pages_meta, limits, model, model_config, device_str, executor=None,
+                  cache=None, key=None):
 
     just_propose = os.environ.get("JUST_PROPOSE") is not None
 
-    tlog(f"create database engine")
-    engine = create_engine('sqlite:///:memory:', echo=False)
-    Session = sessionmaker()
-    Session.configure(bind=engine)
-    Base.metadata.create_all(engine)
-    session = Session()
+    # start proposals for every page that will need them, they are collected in page order below
+    proposal_futures = {}
+    if executor is not None:
+        for image_path in pages:
+            if just_propose or not os.path.isfile(f'{image_path}.pkl'):
+                proposal_futures[image_path] = executor.submit(propose_page, image_path)
 
     pdf_name = os.path.basename(filename)
-    dataset_id = Path(filename).stem
     objs = []    # working dict, saved as pickle
     infofiles = {} # files we may want to delete before we exit.
 
@@ -188,107 +372,24 @@ def process_pages(filename, pages, page_info_dir, meta, limit, model, model_conf
 
     for image_path in pages:
 
-        infofiles[image_path] = 'page'
-
-        image_name = os.path.basename(image_path)
-        try:
-            page_num = get_page_num(image_name)
-        except ValueError:
-            raise Exception(f'cannot extract page number from {image_path}')
-
-        page_name = f'pdf_{page_num}'
-        tlog(f'processing {page_name} from {image_path}')
-
-        # load or create the per-page dict
-        pkl_path = f'{image_path}.pkl'
-        if (os.path.isfile(pkl_path)):
-            with open(pkl_path, 'rb') as rf:
-                obj = pickle.load(rf)
-        else:
-            obj = {'dataset_id': dataset_id, 'pdf_name': pdf_name, 'page_num': page_num, 'page_id': image_name}
-
-        # the inference model uses this as a key for the output data
-        model_id = '0'
-        obj['id'] = model_id
-        obj['page_path'] = image_path
-
-        # the processing looks a resized-padded image.
-        # but the proposal step only looks at the resized image
-        pad_img_path = f'{image_path}_pad'
-
-        proposals = obj.get('proposals')
-        make_proposals = proposals is None or just_propose
-
-        # if we already have proposals, then we don't need to load the non-padded image
-        # we can just load the padded image.  If there is no padded image then we
-        # load the page image and resize/pad it.
-        if os.path.isfile(pad_img_path) and not make_proposals:
-            padded_img = load_image(pad_img_path)
-            if padded_img is None:
-                tlog_flush(f'ERROR: failed to read padded image {pad_img_path} - aborting this pdf')
-                return (False, objs, infofiles)
-
-            orig_w = obj['orig_w']
-            orig_h = obj['orig_h']
-        else:
-            # get the page image
-            img = load_image(image_path)
-            if img is None:
-                tlog(f'ERROR: failed to read image {image_path} - aborting this pdf')
-                return (False, objs, infofiles)
-
-            tlog(f'{image_name} is {img.size} resizing to 1920')
-            orig_w, orig_h = img.size
-            obj['orig_w'] = orig_w
-            obj['orig_h'] = orig_h
-
-            # the model wants square images of size 1920, so we resize and square it now
-            img, img_size = resize_png(img, return_size=True)
-            tlog(f'{page_name} is now {img_size}')
-            padded_img = pad_image(img)
-            tlog(f'{page_name} padded to {padded_img.size}')
-            # the padding operation is
-            #want_image_size = 1920
-            #d_w = want_image_size - w
-            #d_h = want_image_size - h
-            #padding = (0,0,d_w, d_h)
-            #padded_img = ImageOps.expand(img, padding, fill="#fff")
-
-            # the aggregation code also needs access to the padded image
-            # so save this file for later
-            padded_img.save(pad_img_path, "PNG")
-            infofiles[pad_img_path] = 'pad'
-
-        # refresh the path to the padded image in case we are resuming on a different machine
-        obj['pad_img'] = pad_img_path
-
-        # if meta/limit is supplied, store/refresh the page relevent meta info
-        if limit is not None:
-            obj['pdf_limit'] = limit
-        else:
-            limit = obj.get('pdf_limit')
-
-        if limit is not None:
-            orig_w = limit[2]
-            orig_h = limit[3]
-        else:
-            tlog(f'ERROR: parsing of {pdf_name} was unsuccessful - aborting this pdf')
+        loaded = load_page(filename, image_path, page_info_dir, pages_meta, limits, infofiles)
+        if loaded is None:
             return (False, objs, infofiles)
-
-        if meta is not None:
-            w,h = img.size
-            scale_w = w / orig_w
-            scale_h = h / orig_h
-            meta2 = pull_meta(meta, limit, page_num, scale_w, scale_h)
-            dims = [0, 0, w, h]
-
-            obj['meta'] = meta2
-            obj['dims'] = dims
+        obj, img, padded_img = loaded
+        page_num = obj['page_num']
+        page_name = f'pdf_{page_num}'
+        image_name = os.path.basename(image_path)
 
         # get proposed coords for use by the inference model
-        if make_proposals:
+        proposals = obj.get('proposals')
+        if proposals is None or just_propose:
             tlog(f'{page_name} get proposals')
-            proposals = get_proposals(img)
+            if image_path in proposal_futures:
+                proposals = proposal_futures.pop(image_path).result()
+            else:
+                with stage('get_proposals', pdf_name=pdf_name, page_num=page_num) as record:
+                    proposals = get_proposals(img)
+                    record['objects'] = len(proposals)
             obj['proposals'] = proposals
             if just_propose:
                 pkl_path = f'{page_info_dir}/{image_name}.pkl'
@@ -301,31 +402,30 @@ def process_pages(filename, pages, page_info_dir, meta, limit, model, model_conf
 
                 continue
 
-        tlog(f'{page_name} invoke inference model')
-        tlog(f'   proposals: {proposals}')
+        # the same pdf may have been run through the same model before, possibly as part of another dataset
+        cached = cache.get(key, page_num) if cache is not None else None
+        if cached is not None and 'detected_objs' in cached:
+            tlog(f'{page_name} inference results found in the result cache')
+            detected = cached['detected_objs']
+            softmax = cached['softmax_objs']
+        else:
+            tlog(f'{page_name} invoke inference model')
+            tlog(f'   proposals: {proposals}')
 
-        detect_obj = {'id': model_id, 'proposals': proposals, 'img': padded_img}
-        detected_objs, softmax_detected_objs = run_inference(model, [detect_obj], model_config, device_str, session)
+            detect_obj = {'id': obj['id'], 'proposals': proposals, 'img': padded_img}
+            with stage('detect', gpu=device_str != 'cpu', pdf_name=pdf_name, page_num=page_num) as record:
+                detected_objs, softmax_detected_objs = run_inference(model, [detect_obj], model_config, device_str)
+                record['proposals'] = len(proposals)
+                record['objects'] = len(detected_objs[obj['id']])
 
-        tlog(f'{page_name} inference complete')
+            tlog(f'{page_name} inference complete')
 
-        detected = detected_objs[model_id]
-        softmax = softmax_detected_objs[model_id]
+            detected = detected_objs[obj['id']]
+            softmax = softmax_detected_objs[obj['id']]
+            if cache is not None:
+                cache.put(key, page_num, {'detected_objs': detected, 'softmax_objs': softmax})
 
-        # save results and clear any lingering post-processing data
-        # to indicate post-processing is still needed
-        obj['detected_objs'] = detected
-        obj['softmax_objs'] = softmax
-        obj.pop('content', None)
-        obj.pop('xgboost_content', None)
-        obj.pop('rules_content', None)
-
-        # put output pickles into an ouput directory
-        pkl_path = f'{page_info_dir}/{image_name}.pkl'
-        tlog_flush(f'writing {page_name} model results to {pkl_path}')
-        with open(pkl_path, 'wb') as wf:
-            pickle.dump(obj, wf)
-        infofiles[pkl_path] = 'pickle'
+        save_detections(obj, detected, softmax, page_info_dir, infofiles)
 
         # tj's debugging stuff - also write model results to json files
         #infofiles[debug_file(obj, f'{page_info_dir}/{image_name}.json')] = 'json'
@@ -335,12 +435,61 @@ def process_pages(filename, pages, page_info_dir, meta, limit, model, model_conf
 
         objs.append(obj)
 
-    tlog(f'close database session')
-    session.close()
-
     # return a list of temprary files to be returned or deleted
     return (True, objs, infofiles)
 
+"""
+    Post-process pages whose detections are done: regroup their detected objects, pool the text of each object,
+    then classify the objects with the xgboost model and the post-processing rules.  The pages go through the
+    xgboost model in a single call.  Each page dict gets 'content', 'xgboost_content' and 'rules_content'.
+
+    args:
+        pdf_name          - name of the PDF file the pages belong to
+        objs              - list of page dicts holding 'detected_objs', see save_detections
+        postprocess_model - xgboost posprocessing model
+        pp_classes        - 'CLASSES' from the model config
+"""
+def postprocess_pages(pdf_name, objs, postprocess_model, pp_classes):
+
+    for obj in objs:
+        page_name = f'pdf_{obj["page_num"]}'
+        # regroup
+        with stage('regroup', pdf_name=pdf_name, page_num=obj['page_num']) as record:
+            detected = group_cls(obj['detected_objs'], 'Table', do_table_merge=True, merge_over_classes=['Figure', 'Section Header', 'Page Footer', 'Page Header'])
+            detected = group_cls(detected, 'Figure')
+            record['objects'] = len(detected)
+        tlog(f'{page_name} regroup complete')
+
+        # pool_text
+        with stage('pool_text', pdf_name=pdf_name, page_num=obj['page_num']) as record:
+            if "meta" in obj and obj['meta'] is not None:
+                text_map = _pool_text_meta(obj['meta'], obj['dims'][3], detected, obj['page_num'])
+            #elif not skip_ocr:
+            #    text_map = _pool_text_ocr(image_path, detected)
+            else:
+                text_map = _placeholder_map(detected)
+            record['objects'] = len(text_map)
+        obj['content'] = text_map
+        tlog(f'{page_name} pool_text complete')
+
+    # xgboost_postprocess, the pages go through the model in a single call
+    with postprocess_lock, stage('xgboost_postprocess_batch', pdf_name=pdf_name) as record:
+        batch = postprocess_batch(postprocess_model, pp_classes, [obj['content'] for obj in objs])
+        record['pages'] = len(objs)
+        record['objects'] = sum(len(obj['content']) for obj in objs)
+    tlog(f'xgboost_postprocess complete for {len(objs)} pages')
+    for obj, xgboost_content in zip(objs, batch):
+        # remove empty strings returned from postprocess
+        xgboost_content = [c for c in xgboost_content if c != '']
+        obj['xgboost_content'] = xgboost_content
+
+        # rules postprocess
+        with stage('rules_postprocess', pdf_name=pdf_name, page_num=obj['page_num']) as record:
+            rules_content = postprocess_rules(xgboost_content)
+            record['objects'] = len(rules_content)
+        obj['rules_content'] = rules_content
+        tlog(f'pdf_{obj["page_num"]} rules_postprocess complete')
+
 """
     Post inference aggregation of the page metadata and creation of parquet files and png files needed by them
 
@@ -357,6 +506,8 @@ def process_pages(filename, pages, page_info_dir, meta, limit, model, model_conf
         postprocess_model - xgboost posprocessing model
         pp_classes        - 'CLASSES' from the model config
         aggregations      - list of aggregation categories, one parquet file is created for each entry in this list
+        cache             - optional ResultCache holding post-processing results of earlier runs
+        key               - cache key of the PDF, see main_process
 
     return: (success, objs, infofiles)
         success       - a boolean value that indicates overall success or failure
@@ -367,7 +518,8 @@ def process_pages(filename, pages, page_info_dir, meta, limit, model, model_conf
                            'pickle' - contents of a page dict saved as a pickle file
 
 """
-def aggregate_pages(filename, pages, page_info_dir, out_dir, postprocess_model, pp_classes, aggregations):
+def aggregate_pages(filename, pages, page_info_dir, out_dir, postprocess_model, pp_classes, aggregations,
+                    cache=None, key=None):
 
     use_text_normalization = True
 
@@ -375,6 +527,8 @@ def aggregate_pages(filename, pages, page_info_dir, out_dir, postprocess_model,
     dataset_id = Path(filename).stem
     results = [] # result list, saved as parquet
     objs = []    # intermediate page dicts
+    pkl_paths = [] # where each of the page dicts is saved
+    pending = []   # page dicts that still need post-processing
     infofiles = {} # files we may want to delete before we exit.
 
     tlog(f'post-processing {pdf_name} and files matching it from {page_info_dir}')
@@ -404,9 +558,7 @@ def aggregate_pages(filename, pages, page_info_dir, out_dir, postprocess_model,
         obj['page_path'] = image_path
 
         # we need the result of the inference model in order to proceed
-        if 'detected_objs' in obj.keys():
-            detected = obj['detected_objs']
-        else:
+        if 'detected_objs' not in obj.keys():
             tlog_flush(f'ERROR: no detected_objs in {pkl_path} - aborting this pdf')
             return (False, objs, infofiles)
 
@@ -427,88 +579,142 @@ def aggregate_pages(filename, pages, page_info_dir, out_dir, postprocess_model,
         obj['pad_img'] = pad_img_path
         infofiles[pad_img_path] = 'pad'
 
-        # --- post-processing work ---
-        # regroup
-        detected = group_cls(detected, 'Table', do_table_merge=True, merge_over_classes=['Figure', 'Section Header', 'Page Footer', 'Page Header'])
-        detected = group_cls(detected, 'Figure')
-        tlog(f'{page_name} regroup complete')
-
-        # pool_text
-        if "meta" in obj and obj['meta'] is not None:
-            text_map = _pool_text_meta(obj['meta'], obj['dims'][3], detected, obj['page_num'])
-        #elif not skip_ocr:
-        #    text_map = _pool_text_ocr(image_path, detected)
+        cached = cache.get(key, page_num) if cache is not None else None
+        if cached is not None and 'rules_content' in cached:
+            tlog(f'{page_name} post-processing results found in the result cache')
+            obj['content'] = cached['content']
+            obj['xgboost_content'] = cached['xgboost_content']
+            obj['rules_content'] = cached['rules_content']
         else:
-            text_map = _placeholder_map(detected)
-        obj['content'] = text_map
-        tlog(f'{page_name} pool_text complete')
+            pending.append(obj)
 
-        # xgboost_postprocess
-        xgboost_content = postprocess(postprocess_model, pp_classes, text_map)
-        # remove empty strings returned from postprocess
-        xgboost_content = [i for i in xgboost_content if i != '']
-        obj['xgboost_content'] = xgboost_content
-        tlog(f'{page_name} xgboost_postprocess complete')
+        # add to the list of intermediate objects that we return
+        objs.append(obj)
+        pkl_paths.append(pkl_path)
 
-        # rules postprocess
-        rules_content = postprocess_rules(xgboost_content)
-        obj['rules_content'] = rules_content
-        tlog(f'{page_name} rules_postprocess complete')
+    postprocess_pages(pdf_name, pending, postprocess_model, pp_classes)
+    if cache is not None:
+        for obj in pending:
+            cache.put(key, obj['page_num'], obj)
 
+    for obj, pkl_path in zip(objs, pkl_paths):
         # put output pickles into an ouput directory
-        tlog_flush(f'writing {page_name} post-processing results to {pkl_path}')
+        tlog_flush(f'writing pdf_{obj["page_num"]} post-processing results to {pkl_path}')
         with open(pkl_path, 'wb') as wf:
             pickle.dump(obj, wf)
         infofiles[pkl_path] = 'pickle'
 
-        # add to the list of intermediate objects that we return
-        objs.append(obj)
-
         # aggregate
-        for ind, c in enumerate(obj['content']):
-            bb, cls, text = c
-            if use_text_normalization:
-                text = normalize_text(text)
-            scores, classes = zip(*cls)
-            scores = list(scores)
-            classes = list(classes)
-            postprocess_cls = postprocess_score = None
-            if 'xgboost_content' in obj:
-                _, postprocess_cls, _, postprocess_score = obj['xgboost_content'][ind]
-                if 'rules_content' in obj:
-                    _, postprocess_cls, _, postprocess_score = obj['rules_content'][ind]
-            final_obj = {'pdf_name': obj['pdf_name'],
-                         'dataset_id': obj['dataset_id'],
-                         'page_num': obj['page_num'],
-                         'img_pth': obj['pad_img'],
-                         'pdf_dims': list(obj['pdf_limit']),
-                         'bounding_box': list(bb),
-                         'classes': classes,
-                         'scores': scores,
-                         'content': text,
-                         'postprocess_cls': postprocess_cls,
-                         'postprocess_score': postprocess_score
-                        }
-            results.append(final_obj)
-
+        results.extend(page_rows(obj, use_text_normalization))
 
         tlog(f'done post-processing {pkl_path}\n')
 
     if len(results) > 0:
         tlog(f'creating parquet files')
         # create a parquet file
+        with stage('write_parquet', pdf_name=pdf_name, output='objects') as record:
+            table = rows_to_table(results)
+            with ParquetAppender(os.path.join(out_dir, f'{dataset_id}.parquet'), schema=RESULT_SCHEMA) as writer:
+                writer.write_table(table)
+            record['objects'] = table.num_rows
         result_df = pd.DataFrame(results)
-        result_df['detect_cls'] = result_df['classes'].apply(lambda x: x[0])
-        result_df['detect_score'] = result_df['scores'].apply(lambda x: x[0])
-        result_df.to_parquet(os.path.join(out_dir, f'{dataset_id}.parquet'), engine='pyarrow', compression='gzip')
+        result_df['detect_cls'] = table['detect_cls'].to_numpy(zero_copy_only=False)
+        result_df['detect_score'] = table['detect_score'].to_numpy()
         for aggregation in aggregations:
-            aggregate_df = aggregate_router(result_df, aggregate_type=aggregation, write_images_pth=out_dir)
+            with stage('aggregate', pdf_name=pdf_name, aggregation=aggregation) as record:
+                aggregate_df = aggregate_router(result_df, aggregate_type=aggregation, write_images_pth=out_dir)
+                record['objects'] = len(aggregate_df)
             name = f'{dataset_id}_{aggregation}.parquet'
-            aggregate_df.to_parquet(os.path.join(out_dir, name), engine='pyarrow', compression='gzip')
+            with stage('write_parquet', pdf_name=pdf_name, output=aggregation):
+                aggregate_df.to_parquet(os.path.join(out_dir, name), engine='pyarrow', compression='gzip')
 
     # return a list of temprary files to be returned or deleted
     return (True, objs, infofiles)
 
+"""
+    start the process pool that renders, parses and proposes pages.
+    spawn, so the workers do not inherit an initialized CUDA context.
+
+    args:
+        page_workers  - size of the pool, PAGE_WORKERS or one process per CPU if None.  Callers
+                        that start several pools on one host give each its share of the CPUs
+"""
+def page_executor(page_workers=None):
+    if page_workers is None:
+        page_workers = int(os.environ.get("PAGE_WORKERS", os.cpu_count() or 1))
+    return ProcessPoolExecutor(max_workers=page_workers, mp_context=multiprocessing.get_context('spawn'))
+
+"""
+    load the detection and post-processing models named by the environment variables MODEL_CONFIG,
+    WEIGHTS_PTH, PP_WEIGHTS_PTH and AGGREGATIONS.  Models the JUST_PROPOSE, SKIP_AGGREGATION and
+    JUST_AGGREGATION options do not need are not loaded.
+
+    returns
+        models        - dict of the loaded models and the paths they were loaded from, model and
+                        postprocess_model are None when they are not needed, aggregations is None
+                        when aggregation is skipped
+"""
+def load_models():
+    just_propose = os.environ.get("JUST_PROPOSE") is not None
+    skip_aggregation = os.environ.get("SKIP_AGGREGATION") is not None
+    just_aggregation = os.environ.get("JUST_AGGREGATION") is not None
+
+    # inference model config
+    model_config = os.environ.get("MODEL_CONFIG")
+    weights_pth = os.environ.get("WEIGHTS_PTH")
+    device_str = 'cpu'
+    if model_config is None or weights_pth is None:
+        if not just_propose and not just_aggregation:
+            tlog('abort because environment has no MODEL_CONFIG or WEIGHTS_PTH')
+            sys.exit(1)
+    else:
+        # use a gpu for the model if we have one and we are actually doing the model
+        cuda_visible_dev = os.environ.get("CUDA_VISIBLE_DEVICES")
+        if cuda_visible_dev is not None:
+            tlog(f'using gpu={cuda_visible_dev}')
+            device_str = 'cuda'
+
+    # xgboost post-processing config
+    pp_weights_path = os.environ.get("PP_WEIGHTS_PTH")
+    aggregation_list = os.environ.get("AGGREGATIONS")
+    if pp_weights_path is None or aggregation_list is None:
+        if not skip_aggregation and not just_propose:
+            tlog('abort because environment has no PP_WEIGHTS_PATH or AGGREGATIONS')
+            sys.exit(1)
+        skip_aggregation = True
+
+    aggregations = None
+    postprocess_model = None
+    pp_classes = None
+    model = None
+    if not just_propose:
+        if not skip_aggregation:
+            aggregations = aggregation_list.split(",")
+            tlog(f"--- aggregations={aggregations} ---")
+
+            tlog(f'loading xgboost model weights={pp_weights_path}')
+            postprocess_model = XGBClassifier()
+            postprocess_model.load_model(pp_weights_path)
+
+            #cfg = ConfigManager(model_config)
+            with open(model_config) as stream:
+                pp_classes = yaml.load(stream, yaml.Loader)["CLASSES"]
+            tlog(f'--- pp_classes={pp_classes} ---')
+
+        if just_aggregation:
+            model = None
+        else:
+            tlog(f'loading inference model config={model_config} weights={weights_pth}, {device_str}')
+            tlog(os.environ["LD_LIBRARY_PATH"])
+            import torch
+            tlog(torch.__file__)
+            tlog(torch.cuda.is_available())
+            model = get_model(model_config, weights_pth, device_str)
+
+    return {'model': model, 'model_config': model_config, 'weights_pth': weights_pth, 'device_str': device_str,
+            'postprocess_model': postprocess_model, 'pp_weights_path': pp_weights_path, 'pp_classes': pp_classes,
+            'aggregations': aggregations}
+
 """
     main processing loop for PDF files, called by main after command line parsing.
 
@@ -517,19 +723,25 @@ def aggregate_pages(filename, pages, page_info_dir, out_dir, postprocess_model,
     SKIP_AGGREGATION, and JUST_AGGREGATION, and on the presence or absence of *.complete files
     in the intermediate processing directory.
 
+    The detection and post-processing models are loaded by load_models, unless already loaded models are passed
+    in, and pages are rendered, parsed and proposed in a pool of processes, unless one is passed in. Long running
+    callers such as cosmos_service pass both so they are only loaded and started once.
+
     Args:
         pdf_dir       - directory for input PDF files
         page_info_dir - in/out directory for intermediate files such as page PNGs and pickles
         out_dir       - directory for output parquet files and the png files used therein
+        models        - optional dict returned by load_models
+        executor      - optional process pool for page work, it is left running
 
     returns
         stats         - dict of counts of processing successes and failures
 
 """
-def main_process(pdf_dir, page_info_dir, out_dir):
+def main_process(pdf_dir, page_info_dir, out_dir, models=None, executor=None):
     resume_mode = False # True if may be resuming from an previous run
     # counts of stuff we do or failed to do
-    stats = {'gs':0, 'gs_error':0,
+    stats = {'render':0, 'render_error':0,
              'process':0, 'process_error':0,
              'aggregate':0, 'aggregate_error':0,
              'pdfs':0, 'attempted':0, 'succeeded':0, 'finished':0, 'already':0 }
@@ -546,6 +758,20 @@ def main_process(pdf_dir, page_info_dir, out_dir):
     skip_aggregation = os.environ.get("SKIP_AGGREGATION") is not None
     just_aggregation = os.environ.get("JUST_AGGREGATION") is not None
 
+    # large pdfs are rendered, parsed and proposed in page range shards spread over a pool of processes.
+    pages_per_shard = int(os.environ.get("PAGES_PER_SHARD", 25))
+    own_executor = executor is None
+    if own_executor:
+        executor = page_executor()
+
+    # detection and post-processing results can be shared between runs and datasets through a result cache
+    cache_dir = os.environ.get("RESULT_CACHE_DIR")
+    cache_max_bytes = os.environ.get("RESULT_CACHE_MAX_BYTES")
+    cache = None
+    if cache_dir is not None:
+        cache = ResultCache(cache_dir, max_bytes=int(cache_max_bytes) if cache_max_bytes is not None else None)
+        tlog(f'--- result cache {cache_dir} max_bytes={cache_max_bytes} ---')
+
     # create our output and page_info directory if they do not already exist
     # if the page_info directory exists, we will check for {pdf}.*.complete files
     # to know what parts of the processing we can skip
@@ -559,70 +785,33 @@ def main_process(pdf_dir, page_info_dir, out_dir):
         pi.mkdir(parents=True, exist_ok=True)
     tlog(f'--- requested keep={keep} ---')
 
-    # inference model config
-    model_config = os.environ.get("MODEL_CONFIG")
-    weights_pth = os.environ.get("WEIGHTS_PTH")
-    device_str = 'cpu'
-    if model_config is None or weights_pth is None:
-        if not just_propose and not just_aggregation:
-            tlog('abort because environment has no MODEL_CONFIG or WEIGHTS_PTH')
-            sys.exit(1)
-    else:
-        # use a gpu for the model if we have one and we are actually doing the model
-        cuda_visible_dev = os.environ.get("CUDA_VISIBLE_DEVICES")
-        if cuda_visible_dev is not None:
-            tlog(f'using gpu={cuda_visible_dev}')
-            device_str = 'cuda'
-
-    # xgboost post-processing config
-    pp_weights_path = os.environ.get("PP_WEIGHTS_PTH")
-    aggregation_list = os.environ.get("AGGREGATIONS")
-    if pp_weights_path is None or aggregation_list is None:
-        if not skip_aggregation and not just_propose:
-            tlog('abort because environment has no PP_WEIGHTS_PATH or AGGREGATIONS')
-            sys.exit(1)
-        skip_aggregation = True
+    if models is None:
+        models = load_models()
+    model = models['model']
+    model_config = models['model_config']
+    weights_pth = models['weights_pth']
+    device_str = models['device_str']
+    postprocess_model = models['postprocess_model']
+    pp_weights_path = models['pp_weights_path']
+    pp_classes = models['pp_classes']
+    aggregations = models['aggregations']
+    skip_aggregation = skip_aggregation or aggregations is None
 
     # interpret the partial processing options, just_propose, skip_aggregation and just_aggregation
     if just_propose:
         skip_aggregation = True
-        aggregations = None
-        postprocess_model = None
-        pp_classes = None
-        model = None
         keep['pickle'] = True
         keep['page'] = True
         stats['partial'] = 'proposed'
-    else:
-        if skip_aggregation:
-            aggregations = None
-            postprocess_model = None
-            pp_classes = None
-            keep['pickle'] = True
-            keep['page'] = True
-            stats['partial'] = 'processed'
-        else:
-            aggregations = aggregation_list.split(",")
-            tlog(f"--- aggregations={aggregations} ---")
-
-            tlog(f'loading xgboost model weights={pp_weights_path}')
-            postprocess_model = XGBClassifier()
-            postprocess_model.load_model(pp_weights_path)
-
-            #cfg = ConfigManager(model_config)
-            with open(model_config) as stream:
-                pp_classes = yaml.load(stream, yaml.Loader)["CLASSES"]
-            tlog(f'--- pp_classes={pp_classes} ---')
+    elif skip_aggregation:
+        keep['pickle'] = True
+        keep['page'] = True
+        stats['partial'] = 'processed'
 
-        if just_aggregation:
-            model = None
-        else:
-            tlog(f'loading inference model config={model_config} weights={weights_pth}, {device_str}')
-            tlog(os.environ["LD_LIBRARY_PATH"])
-            import torch
-            tlog(torch.__file__)
-            tlog(torch.cuda.is_available())
-            model = get_model(model_config, weights_pth, device_str)
+    # the cache key covers the model weights and configs, so a new model never reads stale results
+    if cache is not None:
+        detect_version = files_version(weights_pth, model_config)
+        postprocess_version = files_version(pp_weights_path, model_config)
 
     # ------- main PDF processing loop --------
     # we will process all of the *.pdf files from the input dir
@@ -633,6 +822,7 @@ def main_process(pdf_dir, page_info_dir, out_dir):
 
         success = True
         stats['pdfs'] += 1
+        started = time.time()
 
         pdf_name = os.path.basename(filename)
         dataset_id = Path(filename).stem
@@ -649,6 +839,10 @@ def main_process(pdf_dir, page_info_dir, out_dir):
 
         stats['attempted'] += 1
 
+        key = None
+        if cache is not None:
+            key = cache_key(file_sha1(filename), detect_version, postprocess_version, {'pipeline': 'make_parquet'})
+
         create_pages = not resume_mode
         pages = glob.glob(f'{page_info_dir}/{pdf_name}_*[0-9]')
         if len(pages) == 0:
@@ -664,30 +858,19 @@ def main_process(pdf_dir, page_info_dir, out_dir):
             clear_progress(progress_filename_process)
             clear_progress(progress_filename_parquet)
 
-            timelimit = 10*60 # wait no longer than 10 minutes
-            tlog(f'print pages for {pdf_name} with timeout={timelimit}')
-            args = ['gs', '-dBATCH',
-                          '-dNOPAUSE',
-                          '-sDEVICE=png16m',
-                          '-dGraphicsAlphaBits=4',
-                          '-dTextAlphaBits=4',
-                          '-r600',
-                          f'-sOutputFile="{page_info_dir}/{pdf_name}_%d"',
-                          filename]
+            tlog(f'render pages for {pdf_name}')
             try:
-                result = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT,
-                                        timeout=timelimit, check=True)
-                pages = glob.glob(f'{page_info_dir}/{pdf_name}_*[0-9]')
+                # pages are rendered at the resolution the pipeline works at, there is nothing to resize later
+                with stage('render', pdf_name=pdf_name) as record:
+                    pages = render_pages(executor, filename, page_info_dir, pages_per_shard)
+                    record['pages'] = len(pages)
                 num = len(pages)
                 set_progress(progress_filename_pages, f'printed {num} pages for {pdf_name}')
-                stats['gs'] += 1
-            except subprocess.SubprocessError as e:
+                stats['render'] += 1
+            except Exception as e:
                 pages = []
-                stats['gs_error'] += 1
-                if isinstance(e, subprocess.TimeoutExpired):
-                    tlog_flush(f'ERROR: timeout printing {pdf_name} pages - skipping this pdf')
-                else:
-                    tlog_flush(f'ERROR: ghostscript error: {e.returncode} for {pdf_name}')
+                stats['render_error'] += 1
+                tlog_flush(f'ERROR: rendering error: {e} for {pdf_name} - skipping this pdf')
                 success = False
 
         # lets process the pages in page number order, does it matter? probably not...
@@ -709,17 +892,20 @@ def main_process(pdf_dir, page_info_dir, out_dir):
                 # page in a single job, and also the workflow where we propose
                 # in a separate job, and process in a later job.  In the second case
                 # the inference processing step does not need to re-parse the pdf.
-                meta = None
-                limit = None
+                pages_meta = None
+                limits = None
                 if not just_propose and check_progress(progress_filename_propose):
                     tlog(f'skipping parse_pdf because {progress_filename_propose} exists')
                 else:
                     tlog(f'parse pdf {filename}')
-                    meta, limit = parse_pdf(filename)
+                    with stage('parse_pdf', pdf_name=pdf_name) as record:
+                        pages_meta, limits = parse_pdf_sharded(executor, filename, pages_per_shard)
+                        record['pages'] = 0 if limits is None else len(limits)
 
                 success, objs, infofiles = process_pages(filename, pages, page_info_dir,
-                                                            meta, limit,
-                                                            model, model_config, device_str)
+                                                            pages_meta, limits,
+                                                            model, model_config, device_str, executor,
+                                                            cache, key)
                 if success:
                     num = len(objs)
                     if just_propose:
@@ -733,7 +919,8 @@ def main_process(pdf_dir, page_info_dir, out_dir):
 
         if success and not skip_aggregation:
             success, objs, moar_infofiles = aggregate_pages(filename, pages, page_info_dir, out_dir,
-                                                            postprocess_model, pp_classes, aggregations)
+                                                            postprocess_model, pp_classes, aggregations,
+                                                            cache, key)
             infofiles.update(moar_infofiles)
             if success:
                 stats['aggregate'] += 1
@@ -753,7 +940,10 @@ def main_process(pdf_dir, page_info_dir, out_dir):
 
         if success:
             stats['succeeded'] += 1
+        observe('document', started, pdf_name=pdf_name, pages=len(pages), status='ok' if success else 'error')
 
+    if own_executor:
+        executor.shutdown()
     tlog_flush(f'Succeeded in processing {stats["succeeded"]} documents')
     return stats
 